@@ -1,2 +1,2 @@
 from version import __version__
-__all__ = ["tdvp_gen", "tdvp_uniform", "matmul", "nullspace", "version"]
+__all__ = ["tdvp_gen", "tdvp_uniform", "twosite", "matmul", "nullspace", "rk", "version"]
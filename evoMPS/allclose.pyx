@@ -9,19 +9,20 @@ import cython as cy
 import numpy as np
 cimport numpy as np
 
-ctypedef np.complex128_t DTYPE_t
-
-from libc.math cimport sqrt
-
-cdef double abs_cmp(complex X):
-    return sqrt(X.real**2 + X.imag**2)
+ctypedef fused DTYPE_t:
+    np.float32_t
+    np.float64_t
+    np.complex64_t
+    np.complex128_t
 
 @cy.boundscheck(False)
 @cy.wraparound(False)
 cpdef allclose_mat(np.ndarray[DTYPE_t, ndim=2, mode="c"] A,
                    np.ndarray[DTYPE_t, ndim=2, mode="c"] B, 
                    double rtol, double atol):
-    
+    """Like numpy.allclose() for two matrices of the same data type 
+    (float32, float64, complex64 or complex128).
+    """
     assert A.shape[0] == B.shape[0] and A.shape[1] == B.shape[1]
     
     cdef int D1 = A.shape[0]
@@ -29,7 +30,7 @@ cpdef allclose_mat(np.ndarray[DTYPE_t, ndim=2, mode="c"] A,
     
     for i in range(D1):
         for j in range(D2):
-            if abs_cmp(A[i, j] - B[i, j]) > atol + rtol * abs_cmp(B[i, j]):
+            if abs(A[i, j] - B[i, j]) > atol + rtol * abs(B[i, j]):
                 return False
     
     return True
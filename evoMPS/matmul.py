@@ -15,6 +15,11 @@ import scipy.linalg as la
 #import scipy.sparse as spa
 
 class eyemat(object):
+    """An identity matrix.
+    
+    Products with other matrices (see mmul()) cost nothing. Scalar
+    (elementwise) multiplication gives a simple_diag_matrix.
+    """
     __array_priority__ = 10.1 #makes right-ops work, ala sparse
     
     def __init__(self, D, dtype=sp.float64):
@@ -22,8 +27,8 @@ class eyemat(object):
         self.dtype = dtype
         self.data = None
         
-    def __array__(self):
-        return self.toarray()
+    def __array__(self, dtype=None):
+        return sp.asarray(self.toarray(), dtype=dtype)
     
     def toarray(self):
         return sp.eye(self.shape[0], dtype=self.dtype)
@@ -31,63 +36,41 @@ class eyemat(object):
     def __mul__(self, other):
         if sp.isscalar(other):
             return simple_diag_matrix(sp.ones(self.shape[0], self.dtype) * other)
-        
-        try:
-            if other.shape == self.shape:
-                return simple_diag_matrix(other.diagonal())
-        except:
-            return NotImplemented
+        elif isinstance(other, eyemat):
+            return eyemat(self.shape[0], dtype=self.dtype)
+        elif isinstance(other, simple_diag_matrix):
+            return other.copy()
+        elif isinstance(other, sp.ndarray) and other.shape == self.shape:
+            return simple_diag_matrix(other.diagonal())
         
         return self.toarray() * other
         
     def __rmul__(self, other):
-        return self.__mul__(self, other)
+        return self.__mul__(other)
         
     def __add__(self, other):
-        try:
-            return self.toarray() + other
-        except:
-            return NotImplemented
+        return self.toarray() + other
             
     def __radd__(self, other):
-        try:
-            return other + self.toarray()
-        except:
-            return NotImplemented
+        return other + self.toarray()
             
     def __sub__(self, other):
-        try:
-            return self.toarray() - other
-        except:
-            return NotImplemented
+        return self.toarray() - other
             
     def __rsub__(self, other):
-        try:
-            return other - self.toarray()
-        except:
-            return NotImplemented
-        
-    def __coerce__(self, other):
-        try:
-            other = sp.asanyarray(other)
-            if other.shape == self.shape or sp.isscalar(other):
-                return (self.toarray(), other)
-            else:
-                return NotImplemented
-        except:
-            return NotImplemented
+        return other - self.toarray()
         
     def dot(self, other):
         if self.shape[1] == other.shape[0]:
             return other
         else:
-            raise BaseException
+            raise ValueError("matrices are not aligned")
             
     def dot_left(self, other):
         if self.shape[0] == other.shape[1]:
             return other
         else:
-            raise BaseException
+            raise ValueError("matrices are not aligned")
             
     def conj(self):
         return self
@@ -113,16 +96,21 @@ class eyemat(object):
     def copy(self, order='C'):
         return eyemat(self.shape[0], dtype=self.dtype)
         
-    def __getattr__(self, attr):
-        if attr == 'A':
-            return self.toarray()
-        elif attr == 'T':
-            return self.transpose()
-        else:
-            raise AttributeError(attr + " not found")
+    @property
+    def A(self):
+        return self.toarray()
+        
+    @property
+    def T(self):
+        return self
     
 
-class simple_diag_matrix:
+class simple_diag_matrix(object):
+    """A diagonal matrix, stored as its diagonal.
+    
+    Products with other matrices (see mmul()) are computed by scaling rows
+    or columns.
+    """
     __array_priority__ = 10.1 #makes right-ops work, ala sparse
     
     diag = None
@@ -130,23 +118,27 @@ class simple_diag_matrix:
     dtype = None
     
     def __init__(self, diag, dtype=None):
-        self.dtype = dtype
         diag = sp.asanyarray(diag, dtype=dtype)
         assert diag.ndim == 1
         self.diag = diag
+        self.dtype = diag.dtype
         self.shape = (diag.shape[0], diag.shape[0])
         
-    def __array__(self):
-        return self.toarray()
+    def __array__(self, dtype=None):
+        return sp.asarray(self.toarray(), dtype=dtype)
         
     def dot(self, b):
-        if isinstance(b, simple_diag_matrix):
+        if isinstance(b, eyemat):
+            return self
+        elif isinstance(b, simple_diag_matrix):
             return simple_diag_matrix(self.diag * b.diag)
             
         return mmul_diag(self.diag, b)
         
     def dot_left(self, a):
-        if isinstance(a, simple_diag_matrix):
+        if isinstance(a, eyemat):
+            return self
+        elif isinstance(a, simple_diag_matrix):
             return simple_diag_matrix(self.diag * a.diag)
             
         return mmul_diag(self.diag, a, act_right=False)
@@ -184,61 +176,112 @@ class simple_diag_matrix:
     def __mul__(self, other):
         if sp.isscalar(other):
             return simple_diag_matrix(self.diag * other)
-        
-        try:
-            other = sp.asanyarray(other)
-    
-            if other.shape == self.shape:
-                return simple_diag_matrix(self.diag * other.diagonal())
+        elif isinstance(other, eyemat):
+            return self.copy()
+        elif isinstance(other, simple_diag_matrix):
+            return simple_diag_matrix(self.diag * other.diag)
+        elif isinstance(other, sp.ndarray) and other.shape == self.shape:
+            return simple_diag_matrix(self.diag * other.diagonal())
             
-            return self.toarray() * other
-        except:
-            return NotImplemented
+        return self.toarray() * other
         
     def __rmul__(self, other):
-        return self.__mul__(self, other)
+        return self.__mul__(other)
         
     def __add__(self, other):
-        try:
-            return self.toarray() + other
-        except:
-            return NotImplemented
+        return self.toarray() + other
             
     def __radd__(self, other):
-        try:
-            return other + self.toarray()
-        except:
-            return NotImplemented
+        return other + self.toarray()
             
     def __sub__(self, other):
-        try:
-            return self.toarray() - other
-        except:
-            return NotImplemented
+        return self.toarray() - other
             
     def __rsub__(self, other):
-        try:
-            return other - self.toarray()
-        except:
-            return NotImplemented
-    
-    def __coerce__(self, other):
-        try:
-            other = sp.asanyarray(other)
-            if other.shape == self.shape:
-                return (self.toarray(), other)
-            else:
-                return None
-        except:
-            return None
+        return other - self.toarray()
+    
+    @property
+    def A(self):
+        return self.toarray()
+        
+    @property
+    def T(self):
+        return self
+
+def _dot2(a, b):
+    if isinstance(b, (eyemat, simple_diag_matrix)):
+        return b.dot_left(a)
+    else:
+        return a.dot(b)
+
+def _mmul_kind(x):
+    if isinstance(x, eyemat):
+        return 0
+    elif isinstance(x, simple_diag_matrix):
+        return 1
+    else:
+        return 2
+
+_mmul_plans = {}
+
+def _mmul_plan(sig):
+    """Finds the cheapest parenthesization of a matrix chain.
+    
+    This is the standard dynamic-programming solution of the matrix chain 
+    ordering problem, except that products involving an identity are free 
+    and products involving a diagonal matrix cost only a scaling.
+    
+    Parameters
+    ----------
+    sig : tuple of (kind, rows, cols)
+        The kind of each matrix (0 for eyemat, 1 for simple_diag_matrix, 2
+        for a dense matrix) and its shape.
+
+    Returns
+    -------
+    plan : int or tuple
+        Either the index of a single matrix, or a pair of sub-plans to be 
+        multiplied together.
+    """
+    N = len(sig)
+    cost = {}
+    kind = {}
+    split = {}
+    for i in xrange(N):
+        cost[i, i] = 0
+        kind[i, i] = sig[i][0]
+        
+    for length in xrange(2, N + 1):
+        for i in xrange(N - length + 1):
+            j = i + length - 1
+            for k in xrange(i, j):
+                kl = kind[i, k]
+                kr = kind[k + 1, j]
+                if kl == 0 or kr == 0:
+                    c = 0
+                elif kl == 1 or kr == 1:
+                    c = sig[i][1] * sig[j][2]
+                else:
+                    c = sig[i][1] * sig[k][2] * sig[j][2]
+                c += cost[i, k] + cost[k + 1, j]
+                if not (i, j) in cost or c <= cost[i, j]: #ties: left to right
+                    cost[i, j] = c
+                    split[i, j] = k
+            kind[i, j] = max(kind[i, split[i, j]], kind[split[i, j] + 1, j])
             
-    def __getattr__(self, attr):
-        if attr == 'A':
-            return self.toarray()
-        elif attr == 'T':
-            return self.transpose()
-        else:
-            raise AttributeError(attr + " not found")
+    def build(i, j):
+        if i == j:
+            return i
+        k = split[i, j]
+        return (build(i, k), build(k + 1, j))
+        
+    return build(0, N - 1)
+    
+def _mmul_exec(plan, args):
+    if isinstance(plan, tuple):
+        return _dot2(_mmul_exec(plan[0], args), _mmul_exec(plan[1], args))
+    else:
+        return args[plan]
 
 def mmul(*args):
     """Multiplies a chain of matrices (2-d ndarrays)
@@ -248,12 +291,18 @@ def mmul(*args):
     as arguments. It thus handles any object that provides a dot() method
     that accepts 2D ndarrays.
     
-    We also try to call dot_left(), in case an optimized left-acting
-    dot operation is available.
+    If the right-hand factor is an eyemat or simple_diag_matrix, its 
+    dot_left() method is used instead, so that the special structure is
+    exploited on either side of a product.
     
     This function is intended to work nicely with the above defined "sparse"
     matrix objects.
     
+    For chains of more than two matrices, the order in which the products 
+    are taken is chosen to minimize the number of operations, based on
+    the shapes of the matrices and treating eyemat and simple_diag_matrix
+    factors as (almost) free. The chosen orderings are cached.
+    
     Parameters
     ----------
     *args : ndarray
@@ -267,17 +316,21 @@ def mmul(*args):
     #if not out is None and (args.count == 2 and out in args or args[-1] is out):
     #    raise
 
-    res = args[0]
+    if len(args) == 2:
+        return _dot2(args[0], args[1])
+    elif len(args) < 2:
+        return args[0]
     
-    for x in args[1:]:
-        try:
-            res = x.dot_left(res)
-        except:
-            res = res.dot(x)
+    sig = tuple([(_mmul_kind(x), x.shape[0], x.shape[-1]) for x in args])
+    try:
+        plan = _mmul_plans[sig]
+    except KeyError:
+        plan = _mmul_plan(sig)
+        _mmul_plans[sig] = plan
     
     #Since, for some reason, the method version of dot() does not generally
     #take an "out" argument, I ignored this (for now, minor) optimization.
-    return res
+    return _mmul_exec(plan, args)
 
 #        if out is None:
 #            return res.dot(args[-1])
@@ -318,10 +371,143 @@ def H(m, out=None):
     else:
         out = sp.conjugate(m.T, out)
         return out
+
+_gemm_funcs = {}
+
+def _get_gemm(dtype):
+    try:
+        return _gemm_funcs[dtype]
+    except KeyError:
+        gemm = la.get_blas_funcs('gemm', dtype=dtype)
+        _gemm_funcs[dtype] = gemm
+        return gemm
+
+def _gemm_arg(a, trans):
+    """Returns a Fortran-ordered array a_F and a BLAS transpose flag t_F
+    such that op_t_F(a_F) is the transpose of op_trans(a).
+
+    No copy is made if a is C-contiguous (or, unless conjugation is
+    required, F-contiguous).
+    """
+    if a.flags.c_contiguous:
+        return a.T, trans
+    elif a.flags.f_contiguous and trans != 2:
+        return a, 1 - trans
+    else:
+        return sp.ascontiguousarray(a).T, trans
+
+def _op(a, trans):
+    if trans == 0:
+        return a
+    elif trans == 1:
+        return a.transpose()
+    else:
+        return a.conj().transpose()
+
+def gemm(a, b, trans_a=0, trans_b=0, out=None, beta=0):
+    """Matrix product of a and b with optional (conjugate) transposition.
+
+    Computes op(a).op(b), where op is the identity (trans = 0), the
+    transpose (trans = 1) or the conjugate transpose (trans = 2), with a
+    single BLAS gemm call. Unlike a.dot(H(b)), no conjugated copies of the
+    arguments are made. If beta is nonzero, beta * out is added to the
+    result, which allows accumulating products in out.
+
+    Arguments that are not plain 2D ndarrays (such as eyemat and
+    simple_diag_matrix) are handled by mmul().
+
+    Parameters
+    ----------
+    a : ndarray
+        First matrix.
+    b : ndarray
+        Second matrix.
+    trans_a : int
+        The operation to apply to a (0, 1 or 2).
+    trans_b : int
+        The operation to apply to b (0, 1 or 2).
+    out : ndarray
+        A C-contiguous matrix to hold the result. May be None.
+    beta : scalar
+        The factor for the initial contents of out. Ignored if out is None.
+
+    Returns
+    -------
+    out : ndarray
+        The result.
+    """
+    if out is None:
+        beta = 0
+        
+    if not (type(a) is sp.ndarray and type(b) is sp.ndarray
+            and a.ndim == 2 and b.ndim == 2 and a.size > 0 and b.size > 0):
+        res = mmul(_op(a, trans_a), _op(b, trans_b))
+        return _gemm_out(res, out, beta)
+
+    typ = sp.result_type(a, b)
+    if not typ.char in 'fdFD':
+        typ = sp.dtype(sp.float64)
+    if a.dtype != typ:
+        a = a.astype(typ)
+    if b.dtype != typ:
+        b = b.astype(typ)
+
+    #op(a).op(b) = (op(b)^T op(a)^T)^T, where the transposes are free for
+    #C-ordered arrays, since BLAS expects Fortran ordering.
+    a_F, ta = _gemm_arg(a, trans_a)
+    b_F, tb = _gemm_arg(b, trans_b)
+
+    f = _get_gemm(typ)
+
+    if (out is None or not out.flags.c_contiguous or out.dtype != typ):
+        res = f(1.0, b_F, a_F, trans_a=tb, trans_b=ta).T
+        return _gemm_out(res, out, beta)
+    else:
+        f(1.0, b_F, a_F, beta=beta, c=out.T, trans_a=tb, trans_b=ta,
+          overwrite_c=True)
+        return out
+        
+def _gemm_out(res, out, beta):
+    if out is None:
+        return res
+    if beta == 0:
+        out[:] = res
+    else:
+        out *= beta
+        out += res
+    return out
+
+def dot_nh(a, b, out=None):
+    """Computes a.H(b) without copying b. See gemm().
+    """
+    return gemm(a, b, trans_b=2, out=out)
+
+def dot_hn(a, b, out=None):
+    """Computes H(a).b without copying a. See gemm().
+    """
+    return gemm(a, b, trans_a=2, out=out)
+
+def dot_nnh(a, x, b, out=None):
+    """Computes a.x.H(b) without copying b. See gemm().
+    """
+    return gemm(mmul(a, x), b, trans_b=2, out=out)
+
+def dot_hnn(a, x, b, out=None):
+    """Computes H(a).x.b without copying a. See gemm().
+    """
+    return gemm(a, mmul(x, b), trans_a=2, out=out)
+
+def randomize_cmplx(x, a=-0.5, b=0.5, aj=-0.5, bj=0.5):
+    """Fills x with uniformly distributed random numbers, with real parts
+    in [a, b) and imaginary parts in [aj, bj).
     
-def randomize_cmplx(x, a=-0.5, b=0.5, aj=-0.5, bj=0.5):        
-    x[:] = (((b - a) * sp.random.ranf(x.shape) + a) 
-            + 1.j * ((bj - aj) * sp.random.ranf(x.shape) + aj))
+    If x is real, only the real parts are set.
+    """
+    if sp.iscomplexobj(x):
+        x[:] = (((b - a) * sp.random.ranf(x.shape) + a) 
+                + 1.j * ((bj - aj) * sp.random.ranf(x.shape) + aj))
+    else:
+        x[:] = (b - a) * sp.random.ranf(x.shape) + a
     return x
 
 def sqrtmh(A, ret_evd=False, evd=None):
@@ -483,7 +669,14 @@ def invpo(A, out=None, lower=False):
                                                                     % -info)    
     return inv_A
     
-def bicgstab_iso(A, x, b, MVop, VVop, max_itr=500, atol=1E-14, rtol=1E-14):
+#Allowed ratio of the true residual to the tolerance at the end of Bi-CGSTAB
+_TRUE_RES_FAC = 100
+
+def _norm_iso(x, VVop):
+    return abs(VVop(x, x))**0.5
+
+def bicgstab_iso(A, x, b, MVop, VVop, max_itr=500, atol=1E-14, rtol=1E-14, 
+                 M=None, brk_tol=None):
     """Implements the Bi-CGSTAB method for isomorphic operations.
     
     The Bi-CGSTAB method is used to solve linear equations Ax = b.
@@ -502,69 +695,569 @@ def bicgstab_iso(A, x, b, MVop, VVop, max_itr=500, atol=1E-14, rtol=1E-14):
     A : ndarray
         The A matrix, or equivalent.        
     x : ndarray
-        An initial value for the unknown vector, or equivalent.
+        An initial value for the unknown vector, or equivalent. This is 
+        modified in place.
     b : ndarray
         The b vector, or equivalent.
     MVop : function(ndarray, ndarray)
         The matrix-vector multiplication operation.
     VVop : function(ndarray, ndarray)
-        The vector-vector multiplication operation.
+        The vector-vector multiplication operation (the scalar product,
+        conjugate-linear in the first argument).
     max_itr : int
         Maximum number of iterations.
     atol : float
-        Absolute tolerance for solution.
+        Absolute tolerance for the norm of the residual.
     rtol : float
-        Relative tolerance for solution.
+        Relative tolerance for the norm of the residual (relative to the
+        norm of b).
+    M : function(ndarray)
+        Applies the (right) preconditioner, an approximation to the inverse
+        of A. May be None.
+    brk_tol : float
+        Relative tolerance used to detect breakdown: The iteration stops if 
+        a scalar product that is divided by is smaller than brk_tol times 
+        the norms of its arguments. Defaults to the machine epsilon of the 
+        data type of b.
 
     Returns
     -------
     x : ndarray
         The final value for the unknown vector x.
     convg : bool
-        Whether the algorithm converged within max_itr iterations.
+        Whether the algorithm converged within max_itr iterations. This is
+        False if the iteration broke down, or if the true residual at the
+        end is much larger than the updated one.
+    itr : int
+        The number of iterations performed (each requires two 
+        matrix-vector multiplications).
     """
-    r_prv = b - MVop(A, x)
+    if brk_tol is None:
+        brk_tol = _brk_tol(b)
     
-    r0 = r_prv.copy()
+    tol = atol + rtol * _norm_iso(b, VVop)
+    
+    r = b - MVop(A, x)
+    
+    r0 = r.copy()
     
     rho_prv = 1
     alpha = 1
-    omega_prv = 1
+    omega = 1
     
-    v_prv = sp.zeros_like(x)
-    p_prv = sp.zeros_like(x)
+    v = sp.zeros_like(r)
+    p = sp.zeros_like(r)
     
-    for i in xrange(max_itr):
-        rho = sp.trace(sp.dot(r0, r_prv))
+    nr0 = _norm_iso(r0, VVop)
+    nr = nr0
+    
+    convg = nr < tol
+    itr = 0
+    while not convg and itr < max_itr:
+        itr += 1
+        
+        rho = VVop(r0, r)
+        if not abs(rho) > brk_tol * nr0 * nr: #breakdown
+            break
+        
+        beta = (rho / rho_prv) * (alpha / omega)
         
-        beta = (rho / rho_prv) * (alpha / omega_prv)
+        p = r + beta * (p - omega * v)
         
-        p = r_prv + beta * (p_prv - omega_prv * v_prv)
+        if M is None:
+            ph = p
+        else:
+            ph = M(p)
+        
+        v = MVop(A, ph)
+        
+        r0v = VVop(r0, v)
+        if not abs(r0v) > brk_tol * nr0 * _norm_iso(v, VVop): #breakdown
+            break
         
-        v = MVop(A, p)
+        alpha = rho / r0v
         
-        alpha = rho / VVop(r0, v)
+        s = r - alpha * v
         
-        s = r_prv - alpha * v
+        x += alpha * ph
         
-        t = MVop(A, s)
+        ns = _norm_iso(s, VVop)
+        if ns < tol:
+            convg = True
+            break
             
-        omega = VVop(t, s) / VVop(t, t)
+        if M is None:
+            sh = s
+        else:
+            sh = M(s)
         
-        x += alpha * p + omega * s
+        t = MVop(A, sh)
         
-        #Test x
-        if sp.allclose(MVop(A, x), b, atol=atol, rtol=rtol):
+        tt = VVop(t, t).real
+        ts = VVop(t, s)
+        if not abs(ts) > brk_tol * tt**0.5 * ns: #breakdown (omega ~ 0)
             break
+            
+        omega = ts / tt
+        
+        x += omega * sh
         
-        r_prv = s - omega * t
+        r = s - omega * t
+        
+        nr = _norm_iso(r, VVop)
+        convg = nr < tol
         
         rho_prv = rho
-        omega_prv = omega
         
-        v_prv[:] = v
-        p_prv[:] = p
+    if convg and itr > 0:
+        #The updated residual can drift away from the true one.
+        convg = _norm_iso(b - MVop(A, x), VVop) < _TRUE_RES_FAC * tol
+    
+    return x, convg, itr
+    
+def _brk_tol(b):
+    """The default relative breakdown tolerance for Krylov solvers.
+    """
+    try:
+        return sp.finfo(b.dtype).eps
+    except (AttributeError, ValueError):
+        return sp.finfo(float).eps
+
+def _vv_batch(u, v):
+    """The Euclidean inner products of each pair u[i], v[i] in two stacks.
+    """
+    k = u.shape[0]
+    return (u.conj() * v).reshape((k, -1)).sum(axis=1)
+    
+def _bcast(c, x):
+    """Reshapes the batch coefficients c to broadcast against the stack x.
+    """
+    return c.reshape((c.shape[0],) + (1,) * (x.ndim - 1))
+
+def bicgstab_iso_batch(A, x, b, MVop, max_itr=500, atol=1E-14, rtol=1E-14, 
+                       M=None, brk_tol=None):
+    """Solves a batch of linear systems A x[i] = b[i] using Bi-CGSTAB.
+    
+    This is bicgstab_iso() run in lockstep on the independent systems 
+    defined by the stacks x and b, using the Euclidean inner product. MVop 
+    is applied to a stack of the systems still active, so that it can 
+    use matrix-matrix operations. Systems that have converged, or broken 
+    down, are dropped from the active set.
+    
+    Parameters
+    ----------
+    A : ndarray
+        The A matrix, or equivalent.        
+    x : ndarray
+        Stack of initial values for the unknowns. This is modified in place.
+    b : ndarray
+        Stack of right-hand sides.
+    MVop : function(ndarray, ndarray)
+        Applies A to each element of a stack.
+    max_itr : int
+        Maximum number of iterations.
+    atol : float
+        Absolute tolerance for the norm of the residual.
+    rtol : float
+        Relative tolerance for the norm of the residual (relative to the
+        norm of b[i]).
+    M : function(ndarray)
+        Applies the (right) preconditioner to each element of a stack. 
+        May be None.
+    brk_tol : float
+        Relative tolerance used to detect breakdown, as in bicgstab_iso().
+
+    Returns
+    -------
+    x : ndarray
+        The final values for the unknowns.
+    convg : ndarray of bool
+        Whether each system converged within max_itr iterations. This is
+        False for systems that broke down.
+    itr : ndarray of int
+        The number of iterations performed for each system.
+    """
+    if brk_tol is None:
+        brk_tol = _brk_tol(b)
+    
+    k = b.shape[0]
+    
+    tol = atol + rtol * sp.sqrt(_vv_batch(b, b).real)
+    
+    r = b - MVop(A, x)
+    r0 = r.copy()
+    
+    typ = r.dtype
+    rho_prv = sp.ones((k,), dtype=typ)
+    alpha = sp.ones((k,), dtype=typ)
+    omega = sp.ones((k,), dtype=typ)
+    
+    v = sp.zeros_like(r)
+    p = sp.zeros_like(r)
+    
+    nr0 = sp.sqrt(_vv_batch(r0, r0).real)
+    nr = nr0.copy()
+    
+    convg = nr < tol
+    active = ~convg
+    itr = sp.zeros((k,), dtype=int)
+    
+    for i in xrange(max_itr):
+        idx = sp.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        
+        rho = _vv_batch(r0[idx], r[idx])
+        ok = abs(rho) > brk_tol * nr0[idx] * nr[idx] #breakdown otherwise
+        active[idx[~ok]] = False
+        idx = idx[ok]
+        rho = rho[ok]
+        if len(idx) == 0:
+            break
+        
+        itr[idx] += 1
+        
+        beta = (rho / rho_prv[idx]) * (alpha[idx] / omega[idx])
+        
+        p_i = r[idx] + _bcast(beta, r) * (p[idx] - _bcast(omega[idx], r) * v[idx])
+        p[idx] = p_i
+        
+        if M is None:
+            ph = p_i
+        else:
+            ph = M(p_i)
+        
+        v_i = MVop(A, ph)
+        v[idx] = v_i
+        
+        r0v = _vv_batch(r0[idx], v_i)
+        ok = abs(r0v) > brk_tol * nr0[idx] * sp.sqrt(_vv_batch(v_i, v_i).real)
+        if not ok.all(): #breakdown
+            active[idx[~ok]] = False
+            idx = idx[ok]
+            if len(idx) == 0:
+                continue
+            rho = rho[ok]
+            r0v = r0v[ok]
+            ph = ph[ok]
+            v_i = v_i[ok]
+        
+        a = rho / r0v
         
-    convg = i < max_itr - 1
+        s = r[idx] - _bcast(a, r) * v_i
+        
+        x[idx] += _bcast(a, r) * ph
+        
+        ns = sp.sqrt(_vv_batch(s, s).real)
+        done = ns < tol[idx]
+        if done.any():
+            j = idx[done]
+            convg[j] = True
+            active[j] = False
+            
+            keep = ~done
+            idx = idx[keep]
+            if len(idx) == 0:
+                continue
+            rho = rho[keep]
+            a = a[keep]
+            s = s[keep]
+            ns = ns[keep]
+        
+        if M is None:
+            sh = s
+        else:
+            sh = M(s)
+        
+        t = MVop(A, sh)
+        
+        tt = _vv_batch(t, t).real
+        ts = _vv_batch(t, s)
+        ok = abs(ts) > brk_tol * sp.sqrt(tt) * ns
+        if not ok.all(): #breakdown (omega ~ 0)
+            active[idx[~ok]] = False
+            idx = idx[ok]
+            if len(idx) == 0:
+                continue
+            rho = rho[ok]
+            a = a[ok]
+            s = s[ok]
+            sh = sh[ok]
+            t = t[ok]
+            tt = tt[ok]
+            ts = ts[ok]
+        
+        w = ts / tt
+        
+        x[idx] += _bcast(w, r) * sh
+        
+        r_i = s - _bcast(w, r) * t
+        r[idx] = r_i
+        
+        nr[idx] = sp.sqrt(_vv_batch(r_i, r_i).real)
+        convg[idx] = nr[idx] < tol[idx]
+        active[idx] = ~convg[idx]
+        
+        alpha[idx] = a
+        omega[idx] = w
+        rho_prv[idx] = rho
+        
+    j = sp.flatnonzero(convg & (itr > 0))
+    if len(j) > 0:
+        #The updated residuals can drift away from the true ones.
+        r_j = b[j] - MVop(A, x[j])
+        convg[j] = sp.sqrt(_vv_batch(r_j, r_j).real) < _TRUE_RES_FAC * tol[j]
+    
+    return x, convg, itr
+    
+def _givens(a, b):
+    """Returns c, s such that [[c, s], [-s*, c]] maps (a, b) to (g, 0).
+    """
+    if b == 0:
+        return 1, 0
+    elif a == 0:
+        return 0, 1
+    
+    abs_a = abs(a)
+    t = (abs_a**2 + abs(b)**2)**0.5
+    
+    return abs_a / t, (a / abs_a) * b.conjugate() / t
+    
+def gmres_iso(A, x, b, MVop, max_itr=500, restart=30, atol=1E-14, 
+              rtol=1E-14, M=None):
+    """Implements the restarted GMRES method for isomorphic operations.
+    
+    The GMRES method is used to solve linear equations Ax = b. It requires
+    one matrix-vector multiplication per iteration, but memory for up to
+    restart + 1 vectors.
+    
+    See bicgstab_iso() for a description of the isomorphic form. Here, the
+    scalar product is the Euclidean one on the entries of x and b, which 
+    allows the Krylov basis to be stored as a single array and 
+    orthogonalized using matrix-vector products (classical Gram-Schmidt, 
+    repeated once for stability).
+    
+    Parameters
+    ----------
+    A : ndarray
+        The A matrix, or equivalent.        
+    x : ndarray
+        An initial value for the unknown vector, or equivalent. This is
+        modified in place.
+    b : ndarray
+        The b vector, or equivalent.
+    MVop : function(ndarray, ndarray)
+        The matrix-vector multiplication operation.
+    max_itr : int
+        Maximum number of iterations (matrix-vector multiplications, 
+        excluding those used to compute the residual at each restart).
+    restart : int
+        The number of iterations between restarts.
+    atol : float
+        Absolute tolerance for the norm of the residual.
+    rtol : float
+        Relative tolerance for the norm of the residual (relative to the
+        norm of b).
+    M : function(ndarray)
+        Applies the (right) preconditioner, an approximation to the inverse
+        of A. May be None.
+
+    Returns
+    -------
+    x : ndarray
+        The final value for the unknown vector x.
+    convg : bool
+        Whether the algorithm converged within max_itr iterations.
+    itr : int
+        The number of iterations performed.
+    """
+    tol = atol + rtol * la.norm(b.ravel())
+    
+    itr = 0
+    while True:
+        r = b - MVop(A, x)
+        beta = la.norm(r.ravel())
+        
+        if beta < tol:
+            return x, True, itr
+        elif itr >= max_itr:
+            return x, False, itr
+        
+        n = min(restart, max_itr - itr)
+        
+        V = sp.empty((n + 1, r.size), dtype=r.dtype)
+        V[0] = r.ravel() / beta
+        if M is None:
+            Z = V
+        else:
+            Z = sp.empty((n, r.size), dtype=r.dtype)
+        
+        #The triangular factor of the Hessenberg matrix, by columns, and
+        #the Givens rotations, as Python scalars to keep the overhead low.
+        R = []
+        cs = []
+        sn = []
+        g = [beta]
+        
+        for j in xrange(n):
+            if not M is None:
+                Z[j] = M(V[j].reshape(r.shape)).ravel()
+            
+            w = MVop(A, Z[j].reshape(r.shape)).ravel()
+            itr += 1
+            
+            Vj = V[:j + 1]
+            h = Vj.conj().dot(w)
+            w = w - h.dot(Vj)
+            h2 = Vj.conj().dot(w)
+            w -= h2.dot(Vj)
+            
+            h_nxt = la.norm(w)
+            col = (h + h2).tolist() + [h_nxt]
+            
+            for k in xrange(j):
+                tmp = cs[k] * col[k] + sn[k] * col[k + 1]
+                col[k + 1] = -sn[k].conjugate() * col[k] + cs[k] * col[k + 1]
+                col[k] = tmp
+            
+            c, s = _givens(col[j], col[j + 1])
+            cs.append(c)
+            sn.append(s)
+            col[j] = c * col[j] + s * col[j + 1]
+            R.append(col[:j + 1])
+            g.append(-s.conjugate() * g[j])
+            g[j] = c * g[j]
+            
+            if abs(g[j + 1]) < tol or h_nxt == 0:
+                break
+                
+            V[j + 1] = w / h_nxt
+        
+        Rm = sp.zeros((j + 1, j + 1), dtype=r.dtype)
+        for k in xrange(j + 1):
+            Rm[:k + 1, k] = R[k]
+        
+        y = la.solve_triangular(Rm, sp.array(g[:j + 1], dtype=r.dtype))
+        
+        x += y.dot(Z[:j + 1]).reshape(x.shape)
+    
+def block_davidson(A, V0, MMop, k=1, M=None, tol=1E-10, max_itr=300, 
+                   max_basis=None, which='SA'):
+    """Finds extremal eigenvalues of a Hermitian operator using block-Davidson.
+    
+    At each iteration, the operator is projected onto the search space, 
+    whose k Ritz pairs selected by which are the current approximations. The 
+    (preconditioned) residuals of the unconverged pairs are orthogonalized 
+    and added to the search space as a block, so that MMop is applied to
+    several vectors at once. When the search space exceeds max_basis 
+    vectors, it is restarted from the selected Ritz vectors.
+    
+    For which='SM', the Ritz values of smallest magnitude are selected. 
+    These are interior Ritz values if A is indefinite, which converge less
+    reliably than the extremal ones ('SA', 'LA'). If A is positive 
+    semi-definite, 'SM' is equivalent to 'SA'.
+    
+    Parameters
+    ----------
+    A : ndarray
+        The operator, or equivalent.
+    V0 : ndarray
+        The initial search space, as columns. This sets the block size.
+    MMop : function(ndarray, ndarray)
+        Applies A to each column of a matrix.
+    k : int
+        The number of eigenvalues to compute.
+    M : function(ndarray, ndarray)
+        Applies the preconditioner, an approximation to the inverse of
+        (A - theta[j]), to each column j of a matrix of residuals, given 
+        the Ritz values theta. May be None.
+    tol : float
+        Tolerance for the norm of the residual of each Ritz pair.
+    max_itr : int
+        Maximum number of iterations (at least 1).
+    max_basis : int
+        Maximum size of the search space.
+    which : str
+        Which eigenvalues to find: 'SA' (smallest algebraic), 'LA' 
+        (largest algebraic) or 'SM' (smallest magnitude).
+
+    Returns
+    -------
+    ev : ndarray
+        The k selected Ritz values, in ascending order.
+    eV : ndarray
+        The corresponding Ritz vectors, as columns.
+    convg : bool
+        Whether all k pairs converged within max_itr iterations.
+    itr : int
+        The number of iterations performed.
+    """
+    if max_itr < 1:
+        raise ValueError("block_davidson requires max_itr >= 1")
+    if not which in ('SA', 'LA', 'SM'):
+        raise ValueError("Invalid which for block_davidson: " + str(which))
+        
+    n, b = V0.shape
+    b = max(b, k)
+    if V0.shape[1] < b:
+        V0 = sp.hstack((V0, sp.random.randn(n, b - V0.shape[1])))
+    
+    if max_basis is None:
+        max_basis = max(8 * b, 24)
+    max_basis = min(max(max_basis, 2 * b + k), n)
+    
+    V, Rq = la.qr(V0, mode='economic')
+    AV = MMop(A, V)
+    
+    convg = False
+    itr = 0
+    while itr < max_itr:
+        itr += 1
+        
+        Hs = H(V).dot(AV)
+        Hs = 0.5 * (Hs + H(Hs))
+        w, S = la.eigh(Hs)
+        if which == 'LA':
+            w, S = w[::-1], S[:, ::-1]
+        elif which == 'SM':
+            srt = sp.argsort(abs(w), kind='mergesort')
+            w, S = w[srt], S[:, srt]
+        
+        theta = w[:k]
+        X = V.dot(S[:, :k])
+        AX = AV.dot(S[:, :k])
+        
+        R = AX - X * theta
+        nc = sp.sqrt((abs(R)**2).sum(axis=0)) > tol
+        if not nc.any():
+            convg = True
+            break
+            
+        if V.shape[1] == n: #the search space is complete
+            break
+        
+        T = R[:, nc]
+        if not M is None:
+            T = M(T, theta[nc])
+            
+        if V.shape[1] + T.shape[1] > max_basis: #restart
+            m = min(2 * b, V.shape[1])
+            V = V.dot(S[:, :m])
+            AV = AV.dot(S[:, :m])
+        
+        T_nrm = sp.sqrt((abs(T)**2).sum(axis=0)).max()
+        for i in xrange(2):
+            T = T - V.dot(H(V).dot(T))
+        
+        Q, Rq = la.qr(T, mode='economic')
+        keep = abs(sp.diagonal(Rq)) > 1E-10 * T_nrm
+        if not keep.any(): #stagnation
+            break
+        Q = Q[:, keep]
+        
+        V = sp.hstack((V, Q))
+        AV = sp.hstack((AV, MMop(A, Q)))
+    
+    srt = sp.argsort(theta)
     
-    return x, convg
\ No newline at end of file
+    return theta[srt], X[:, srt], convg, itr
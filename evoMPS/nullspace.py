@@ -122,4 +122,286 @@ def nullspace_qr(A):
     
     ns = Q[:, R.shape[1]:].conj()
     
-    return ns
\ No newline at end of file
+    return ns
+
+def _complement(Q, V0=None):
+    """Compute an orthonormal basis for the orthogonal complement of the 
+    range of Q, which must have orthonormal columns.
+    
+    If V0 is given and has the right shape, it is used as a starting guess:
+    It is projected onto the complement and re-orthonormalized, which 
+    avoids a full QR decomposition of Q and keeps the result close to V0.
+    If V0 is (nearly) rank deficient after the projection, it is ignored.
+    """
+    k, r = Q.shape
+    
+    if r == k:
+        return np.zeros((k, 0), dtype=Q.dtype)
+    
+    if not V0 is None and V0.shape == (k, k - r):
+        V = V0
+        for i in xrange(2): #twice is enough
+            V = V - Q.dot(Q.conj().T.dot(V))
+        V, R = qr(V, mode='economic')
+        
+        d = R.diagonal()
+        if abs(d).min() > np.sqrt(np.finfo(R.dtype).eps):
+            return V * (d / abs(d)) #fix the phases, so that V is close to V0
+        
+    return qr(Q)[0][:, r:]
+
+def nullspace_qrp(A, atol=1e-13, rtol=0, V0=None):
+    """Compute an approximate basis for the nullspace of A.
+
+    The algorithm used by this function is based on the QR decomposition 
+    of A.conj().T with column pivoting, which reveals the rank of A. Unlike
+    nullspace_qr(), this handles rank-deficient A.
+
+    Parameters
+    ----------
+    A : ndarray
+        A should be at most 2-D.  A 1-D array with length k will be treated
+        as a 2-D with shape (1, k)
+    atol : float
+        The absolute tolerance for a zero diagonal entry of the triangular 
+        factor.
+    rtol : float
+        The relative tolerance, with respect to the largest diagonal entry.
+    V0 : ndarray
+        A previous nullspace basis, used as a starting guess (optional).
+        In this case, only the economic QR decomposition is needed.
+
+    Return value
+    ------------
+    ns : ndarray
+        If `A` is an array with shape (m, k), then `ns` will be an array
+        with shape (k, n), where n is the estimated dimension of the
+        nullspace of `A`.  The columns of `ns` are an orthonormal basis 
+        for the nullspace.
+    """
+    A = np.atleast_2d(A)
+    
+    if V0 is None:
+        Q, R, P = qr(A.conj().T, pivoting=True)
+    else:
+        Q, R, P = qr(A.conj().T, mode='economic', pivoting=True)
+    
+    d = abs(R.diagonal())
+    if d.shape[0] == 0:
+        r = 0
+    else:
+        tol = max(atol, rtol * d[0])
+        r = int((d > tol).sum())
+    
+    if V0 is None:
+        return Q[:, r:]
+    else:
+        return _complement(Q[:, :r], V0=V0)
+    
+def nullspace_rand(A, atol=1e-13, rtol=0, V0=None, rank=None, oversample=10,
+                   n_iter=1):
+    """Compute an approximate basis for the nullspace of A.
+
+    The algorithm used by this function is a randomized range finder
+    (Halko, Martinsson and Tropp, SIAM Rev. 53, 217 (2011)) applied to 
+    A.conj().T, followed by a singular value decomposition of A projected
+    onto the sampled subspace.
+    
+    This only pays off if an upper bound for the rank of A is known that is
+    much smaller than min(m, k): With rank + oversample >= min(m, k), the 
+    whole range is sampled and nullspace_qrp() is cheaper. An estimate of
+    the rank is therefore required.
+
+    Parameters
+    ----------
+    A : ndarray
+        A should be at most 2-D.  A 1-D array with length k will be treated
+        as a 2-D with shape (1, k)
+    atol : float
+        The absolute tolerance for a zero singular value.
+    rtol : float
+        The relative tolerance, with respect to the largest singular value.
+    V0 : ndarray
+        A previous nullspace basis, used as a starting guess (optional).
+    rank : int
+        An upper bound for the rank of A (required). Only rank + oversample 
+        random vectors are used to sample the range of A.conj().T. If the 
+        sampled subspace turns out to be too small, the full range is used.
+    oversample : int
+        The number of additional random vectors.
+    n_iter : int
+        The number of power iterations used to improve the sample.
+
+    Return value
+    ------------
+    ns : ndarray
+        If `A` is an array with shape (m, k), then `ns` will be an array
+        with shape (k, n), where n is the estimated dimension of the
+        nullspace of `A`.  The columns of `ns` are an orthonormal basis 
+        for the nullspace.
+    """
+    A = np.atleast_2d(A)
+    m, k = A.shape
+    Ah = A.conj().T
+    
+    if rank is None:
+        raise ValueError("nullspace_rand() requires an estimate of the rank.")
+    
+    lmax = min(m, k)
+    l = min(rank + oversample, lmax)
+    
+    while True:
+        G = np.random.standard_normal((m, l))
+        if np.iscomplexobj(A):
+            G = G + 1.j * np.random.standard_normal((m, l))
+        
+        Q = qr(Ah.dot(G), mode='economic')[0]
+        for i in xrange(n_iter):
+            Q = qr(A.dot(Q), mode='economic')[0]
+            Q = qr(Ah.dot(Q), mode='economic')[0]
+        
+        U, sv, Wh = svd(A.dot(Q), full_matrices=False)
+        
+        if sv.shape[0] == 0:
+            r = 0
+        else:
+            tol = max(atol, rtol * sv[0])
+            r = int((sv > tol).sum())
+        
+        if r < l or l == lmax:
+            break
+        l = lmax
+    
+    return _complement(Q.dot(Wh[:r].conj().T), V0=V0)
+    
+def get_nullspace(A, method='qr', V0=None, atol=1e-13, rtol=0, rank=None):
+    """Compute an approximate basis for the nullspace of A using one of the
+    above methods.
+
+    Parameters
+    ----------
+    A : ndarray
+        A should be at most 2-D.
+    method : str
+        One of 'svd' (nullspace()), 'qr' (nullspace_qr()), 'qrp' 
+        (nullspace_qrp()) or 'rand' (nullspace_rand()).
+    V0 : ndarray
+        A previous nullspace basis, used as a starting guess by the 'qrp'
+        and 'rand' methods. It is ignored by the others.
+    atol, rtol : float
+        Tolerances for the rank determination. These are ignored by 'qr',
+        which assumes full rank.
+    rank : int
+        An upper bound for the rank of A, required by the 'rand' method.
+
+    Return value
+    ------------
+    ns : ndarray
+        The columns of `ns` are an orthonormal basis for the nullspace.
+    """
+    if method == 'qr':
+        return nullspace_qr(A)
+    elif method == 'svd':
+        return nullspace(A, atol=atol, rtol=rtol)
+    elif method == 'qrp':
+        return nullspace_qrp(A, atol=atol, rtol=rtol, V0=V0)
+    elif method == 'rand':
+        return nullspace_rand(A, atol=atol, rtol=rtol, V0=V0, rank=rank)
+    else:
+        raise ValueError("Unknown nullspace method: " + str(method))
+
+def nullspace_stacked(A):
+    """Compute bases for the nullspaces of a stack of matrices A[i].
+
+    The algorithm used by this function is based on the complete QR 
+    decomposition of each A[i].conj().T, which is considerably cheaper than
+    the full SVD needed for the same (k, k) basis. As with nullspace_qr(), 
+    the matrices are assumed to have full row rank.
+
+    Parameters
+    ----------
+    A : ndarray
+        A 3-D array with shape (K, m, k), with m <= k.
+
+    Return value
+    ------------
+    ns : ndarray
+        An array with shape (K, k, k - m). The columns of ns[i] are an 
+        orthonormal basis for the nullspace of A[i].
+    """
+    K, m, k = A.shape
+    
+    ns = np.empty((K, k, k - m), dtype=A.dtype)
+    for i in xrange(K):
+        ns[i] = qr(A[i].conj().T)[0][:, m:]
+    
+    return ns
+    
+def nullspace_projectors(A):
+    """Creates implicit nullspace projectors for a stack of matrices.
+
+    This is equivalent to [nullspace_projector(Ai) for Ai in A], but the
+    orthonormal factors are computed for all matrices at once, using
+    the Cholesky decomposition G G^dagger = A^dagger A, so that 
+    Q = A G^-dagger. This squares the condition number of A, so that A 
+    should be well-conditioned.
+
+    Parameters
+    ----------
+    A : ndarray
+        A 3-D array with shape (K, m, k), with m >= k.
+
+    Return value
+    ------------
+    P : list of nullspace_projector
+        The projectors onto the nullspaces of A[i].conj().T.
+    """
+    Ah = A.conj().transpose((0, 2, 1))
+    G = np.linalg.cholesky(np.matmul(Ah, A))
+    Qh = np.linalg.solve(G, Ah)
+    
+    return [nullspace_projector(Qhi.conj().T, orthonormal=True) for Qhi in Qh]
+
+class nullspace_projector(object):
+    """The orthogonal projector onto the nullspace of A.conj().T, kept 
+    implicitly.
+
+    For A with shape (m, k), this represents the (m, m) matrix
+
+        P = 1 - A (A^dagger A)^-1 A^dagger = 1 - Q Q^dagger
+
+    with Q the orthonormal factor of the economic QR decomposition of A. 
+    P is equal to ns.dot(ns.conj().T), with ns = nullspace_qr(A.conj().T), 
+    but the (m, m - k) basis ns is never formed: Only Q, of shape (m, k), 
+    is stored, and applying P to a matrix with n columns costs O(n m k).
+
+    Parameters
+    ----------
+    A : ndarray
+        A should be at most 2-D, with shape (m, k) and m >= k.
+    orthonormal : bool
+        Whether the columns of A are already orthonormal, in which case
+        they are used as Q directly.
+    """
+    def __init__(self, A, orthonormal=False):
+        A = np.atleast_2d(A)
+
+        if orthonormal:
+            self.Q = A
+        else:
+            self.Q = qr(A, mode='economic')[0]
+        self.shape = (A.shape[0], A.shape[0])
+        self.dtype = self.Q.dtype
+        
+        #The dimension of the nullspace
+        self.rank = A.shape[0] - A.shape[1]
+
+    def dot(self, x):
+        """Computes P.dot(x)."""
+        Q = self.Q
+        return x - Q.dot(Q.conj().T.dot(x))
+
+    def dot_left(self, x):
+        """Computes x.dot(P)."""
+        Q = self.Q
+        return x - x.dot(Q).dot(Q.conj().T)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Embedded Runge-Kutta pairs for integration with step-size control.
+
+These are used by the take_step_adaptive() methods of the TDVP classes.
+"""
+
+def rk_embedded_tableau(method):
+    """Returns the Butcher tableau of an embedded Runge-Kutta pair.
+    
+    Parameters
+    ----------
+    method : str
+        'bs32' for the Bogacki-Shampine 3(2) pair or 'dp54' for the 
+        Dormand-Prince 5(4) pair.
+        
+    Returns
+    -------
+    a : list of lists
+        The stage coefficients, with a[i] the coefficients for stage i.
+    b : list
+        The weights of the higher-order solution.
+    e : list
+        The differences between the weights of the higher- and lower-order 
+        solutions, which give the error estimate.
+    order : int
+        The order of the lower-order solution.
+    fsal : bool
+        Whether the pair has the first-same-as-last property, i.e. the last
+        stage is evaluated at the higher-order solution, so that it can be 
+        reused as the first stage of the next step.
+    """
+    if method == 'bs32':
+        a = [[],
+             [1./2],
+             [0, 3./4],
+             [2./9, 1./3, 4./9]]
+        b = [2./9, 1./3, 4./9, 0]
+        b_low = [7./24, 1./4, 1./3, 1./8]
+        order = 2
+    elif method == 'dp54':
+        a = [[],
+             [1./5],
+             [3./40, 9./40],
+             [44./45, -56./15, 32./9],
+             [19372./6561, -25360./2187, 64448./6561, -212./729],
+             [9017./3168, -355./33, 46732./5247, 49./176, -5103./18656],
+             [35./384, 0, 500./1113, 125./192, -2187./6784, 11./84]]
+        b = [35./384, 0, 500./1113, 125./192, -2187./6784, 11./84, 0]
+        b_low = [5179./57600, 0, 7571./16695, 393./640, -92097./339200, 
+                 187./2100, 1./40]
+        order = 4
+    else:
+        raise ValueError("Invalid embedded Runge-Kutta method: " + str(method))
+    
+    e = [bi - bli for bi, bli in zip(b, b_low)]
+    
+    fsal = b[-1] == 0 and a[-1] == b[:-1]
+    
+    return a, b, e, order, fsal
+    
+def rk_step_factor(err, order, safety=0.9, fac_min=0.2, fac_max=5.):
+    """Returns the factor by which to scale the step size of an embedded 
+    Runge-Kutta method, given the error estimate err relative to the 
+    tolerance.
+    
+    The step is acceptable if err <= 1.
+    """
+    if err == 0:
+        return fac_max
+    
+    fac = safety * err**(-1. / (order + 1))
+    
+    return min(fac_max, max(fac_min, fac))
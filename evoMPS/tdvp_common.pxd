@@ -8,7 +8,20 @@ cimport numpy as np
 
 ctypedef np.complex128_t DTYPE_t
 
+#The data types of the state supported by the kernels that do not take an
+#h_nn_func, which is always complex.
+ctypedef fused STYPE_t:
+    np.float32_t
+    np.float64_t
+    np.complex64_t
+    np.complex128_t
+
 ctypedef DTYPE_t (*h_nn_func)(int s, int t, int u, int v) nogil
 
 cpdef calc_C(np.ndarray[DTYPE_t, ndim=4, mode="c"] AA, h_nn_cptr, 
-             np.ndarray[DTYPE_t, ndim=4, mode="c"] out)
\ No newline at end of file
+             np.ndarray[DTYPE_t, ndim=4, mode="c"] out)
+
+cpdef calc_C_sparse(np.ndarray[STYPE_t, ndim=4, mode="c"] AA,
+                    np.ndarray[np.intp_t, ndim=2, mode="c"] h_idx,
+                    np.ndarray[STYPE_t, ndim=1, mode="c"] h_val,
+                    np.ndarray[STYPE_t, ndim=4, mode="c"] out)
\ No newline at end of file
@@ -51,4 +51,62 @@ cpdef calc_C(np.ndarray[DTYPE_t, ndim=4, mode="c"] AA,
                                 for j in range(D2):
                                     out_view[s, t, i, j] = out_view[s, t, i, j] + h * AA_view[u, v, i, j]
         
+    return out
+
+@cy.boundscheck(False)
+@cy.wraparound(False)
+cpdef calc_C_sparse(np.ndarray[STYPE_t, ndim=4, mode="c"] AA,
+                    np.ndarray[np.intp_t, ndim=2, mode="c"] h_idx,
+                    np.ndarray[STYPE_t, ndim=1, mode="c"] h_val,
+                    np.ndarray[STYPE_t, ndim=4, mode="c"] out):
+    """Like calc_C(), but takes h_nn as a list of its nonzero entries.
+    
+    h_idx[k] = (s, t, u, v) and h_val[k] = h_nn(s, t, u, v). Only the listed
+    entries are visited, so zero entries cost nothing.
+    
+    AA, h_val and out must all have the same data type, which may be 
+    float32, float64, complex64 or complex128.
+    """
+    cdef int q1 = AA.shape[0]
+    cdef int q2 = AA.shape[1]
+    
+    cdef int D1 = AA.shape[2]
+    cdef int D2 = AA.shape[3]
+    
+    cdef int nnz = h_idx.shape[0]
+    
+    assert h_idx.shape[1] == 4 and h_val.shape[0] == nnz
+    
+    if out is None:
+        out = np.empty([q1, q2, D1, D2], dtype=AA.dtype)
+    else:
+        assert out.shape[0] == q1 and out.shape[1] == q2
+        assert out.shape[2] == D1 and out.shape[3] == D2
+        
+    out.fill(0)
+    
+    cdef int k, i, j, s, t, u, v
+    
+    cdef STYPE_t h
+    
+    cdef np.intp_t [:,:] idx_view = h_idx
+    cdef STYPE_t [:] val_view = h_val
+    cdef STYPE_t [:,:,:,:] AA_view = AA
+    cdef STYPE_t [:,:,:,:] out_view = out
+    
+    for k in range(nnz): #there is no bounds checking in the loop below
+        assert 0 <= idx_view[k, 0] < q1 and 0 <= idx_view[k, 1] < q2
+        assert 0 <= idx_view[k, 2] < q1 and 0 <= idx_view[k, 3] < q2
+    
+    with nogil:
+        for k in range(nnz):
+            s = idx_view[k, 0]
+            t = idx_view[k, 1]
+            u = idx_view[k, 2]
+            v = idx_view[k, 3]
+            h = val_view[k]
+            for i in range(D1): 
+                for j in range(D2):
+                    out_view[s, t, i, j] = out_view[s, t, i, j] + h * AA_view[u, v, i, j]
+        
     return out
\ No newline at end of file
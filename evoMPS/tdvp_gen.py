@@ -16,10 +16,13 @@ TODO:
     - Find a way to randomize the starting state.
 
 """
+import numpy as np
 import scipy as sp
 import scipy.linalg as la
 import nullspace as ns
 import matmul as m
+import twosite as ts
+import rk
 
 class EvoMPS_TDVP_Generic:
     odr = 'C'
@@ -32,12 +35,19 @@ class EvoMPS_TDVP_Generic:
     q = None
     
     h_nn = None
+    h_nn_mat = None
     h_ext = None
     
     eps = 0
     
     sanity_checks = True
     
+    promote_eta = None
+    
+    implicit_V = False
+    
+    ns_method = None
+    
     def setup_A(self):
         """Initializes the state to full rank with norm 1.
         """
@@ -76,11 +86,12 @@ class EvoMPS_TDVP_Generic:
         """
         for n in xrange(1, self.N + 1):
             self.A[n].real = (sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n]) #/ sp.sqrt(self.N) #/ sp.sqrt(self.D[n])
-            self.A[n].imag = (sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n]) #/ sp.sqrt(self.N) #/ sp.sqrt(self.D[n])
+            if sp.iscomplexobj(self.A[n]):
+                self.A[n].imag = (sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n]) #/ sp.sqrt(self.N) #/ sp.sqrt(self.D[n])
                 
         self.restore_RCF()
             
-    def __init__(self, numsites, D, q):
+    def __init__(self, numsites, D, q, typ=None):
         """Creates a new TDVP_MPS object.
         
         The TDVP_MPS class implements the time-dependent variational principle 
@@ -100,12 +111,20 @@ class EvoMPS_TDVP_Generic:
         q : ndarray
             A 1-d array, also length numsites, of integers indicating the 
             dimension of the hilbert space for each site.
+        typ : dtype
+            The data type of the state (defaults to complex128). For a real
+            Hamiltonian, imaginary-time evolution can be done with float64,
+            which is cheaper. The single-precision types complex64 and float32
+            are also supported. See also set_typ() and promote_eta.
     
         Returns
         -------
         sqrt_A : ndarray
             An array of the same shape and type as A containing the matrix square root of A.        
         """
+        if not typ is None:
+            self.typ = typ
+        
         self.eps = sp.finfo(self.typ).eps
         
         self.N = numsites
@@ -116,6 +135,7 @@ class EvoMPS_TDVP_Generic:
         self.K = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 1..N
         self.C = sp.empty((self.N), dtype=sp.ndarray) #Elements 1..N-1
         self.A = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 1..N
+        self.Vsh = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 1..N, as last computed
         
         self.r = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 0..N
         self.l = sp.empty((self.N + 1), dtype=sp.ndarray)        
@@ -159,6 +179,67 @@ class EvoMPS_TDVP_Generic:
         self.setup_A()
         
         self.eta = sp.zeros((self.N + 1), dtype=self.typ)
+        self._B_fsal = None
+    
+    def gen_h_matrix(self):
+        """Generates a matrix form for h_nn, which can speed up parts of the
+        algorithm by avoiding excess loops and python calls.
+        
+        The result is stored in h_nn_mat, with h_nn_mat[n][s, t, u, v] equal
+        to h_nn(n, s, t, u, v) for the bonds n = 1..N-1.
+        
+        Instead of calling this, h_nn_mat may also be set directly, either to
+        a sequence of per-bond arrays indexed like this one, or to a single 
+        array of shape (q, q, q, q) shared by all bonds of a homogeneous chain.
+        
+        Since the tabulated form is what calc_C() uses, this must be called
+        again if the Hamiltonian changes.
+        """
+        h_nn_mat = sp.empty((self.N), dtype=sp.ndarray)
+        for n in xrange(1, self.N):
+            h_nn_n = lambda s, t, u, v: self.h_nn(n, s, t, u, v)
+            h_nn_mat_n = ts.tabulate(h_nn_n, self.q[n], self.q[n + 1], 
+                                     dtype=self.typ)
+            if h_nn_mat_n.dtype != self.typ:
+                raise ValueError("h_nn is not real: A complex typ is required.")
+            h_nn_mat[n] = h_nn_mat_n
+        self.h_nn_mat = h_nn_mat
+    
+    def set_typ(self, typ):
+        """Changes the data type of the state.
+        
+        This can be used, for example, to promote a ground state found using
+        imaginary-time evolution with typ = float64 to complex128 before 
+        doing real-time evolution. Converting a complex state to a real typ
+        discards any imaginary parts.
+        
+        The state must be updated using update() before further use.
+        """
+        self.typ = typ
+        self.eps = sp.finfo(self.typ).eps
+        
+        cmplx = sp.iscomplexobj(sp.empty(0, dtype=typ))
+        def conv(x):
+            x = sp.asarray(x)
+            if not cmplx:
+                x = x.real
+            return sp.array(x, dtype=typ, order=self.odr)
+        
+        for n in xrange(self.N + 1):
+            self.l[n] = conv(self.l[n])
+            self.r[n] = conv(self.r[n])
+            if n > 0:
+                self.A[n] = conv(self.A[n])
+                self.K[n] = sp.zeros_like(self.K[n], dtype=typ)
+            if 0 < n < self.N:
+                self.C[n] = sp.empty_like(self.C[n], dtype=typ)
+        
+        self.eta = sp.zeros((self.N + 1), dtype=self.typ)
+        self.Vsh = sp.empty((self.N + 1), dtype=sp.ndarray)
+        self._B_fsal = None
+        
+        if not self.h_nn_mat is None and not self.h_nn is None:
+            self.gen_h_matrix()
     
     def calc_C(self, n_low=-1, n_high=-1):
         """Generates the C matrices used to calculate the K's and ultimately the B's
@@ -171,8 +252,11 @@ class EvoMPS_TDVP_Generic:
         
         C[n] depends on A[n] and A[n + 1].
         
+        This calculation can be significantly faster if a matrix form for h_nn
+        is available. See gen_h_matrix().
+        
         """
-        if self.h_nn is None:
+        if self.h_nn is None and self.h_nn_mat is None:
             return 0
         
         if n_low < 1:
@@ -180,16 +264,32 @@ class EvoMPS_TDVP_Generic:
         if n_high < 1:
             n_high = self.N
         
-        for n in xrange(n_low, n_high):
-            self.C[n].fill(0)
-            for u in xrange(self.q[n]):
-                for v in xrange(self.q[n + 1]):
-                    AA = m.mmul(self.A[n][u], self.A[n + 1][v]) #only do this once for each 
-                    for s in xrange(self.q[n]):
-                        for t in xrange(self.q[n + 1]):                
-                            h_nn_stuv = self.h_nn(n, s, t, u, v)
-                            if h_nn_stuv != 0:
-                                self.C[n][s, t] += h_nn_stuv * AA
+        if self.h_nn_mat is None:
+            for n in xrange(n_low, n_high):
+                self.C[n].fill(0)
+                for u in xrange(self.q[n]):
+                    for v in xrange(self.q[n + 1]):
+                        AA = m.mmul(self.A[n][u], self.A[n + 1][v]) #only do this once for each 
+                        for s in xrange(self.q[n]):
+                            for t in xrange(self.q[n + 1]):                
+                                h_nn_stuv = self.h_nn(n, s, t, u, v)
+                                if h_nn_stuv != 0:
+                                    self.C[n][s, t] += h_nn_stuv * AA
+        else:
+            h_nn_mat = sp.asarray(self.h_nn_mat)
+            h_uniform = h_nn_mat.dtype != sp.object_ and h_nn_mat.ndim == 4
+            
+            tensordot = sp.tensordot
+            for n in xrange(n_low, n_high):
+                if h_uniform:
+                    h_nn_mat_n = h_nn_mat
+                else:
+                    h_nn_mat_n = h_nn_mat[n]
+                
+                #AA[u, :, v, :] = A[n][u] A[n + 1][v] for all u, v in one go
+                AA = tensordot(self.A[n], self.A[n + 1], axes=((2,), (1,)))
+                
+                self.C[n][:] = tensordot(h_nn_mat_n, AA, ((2, 3), (0, 2)))
     
     def calc_K(self, n_low=-1, n_high=-1):
         """Generates the K matrices used to calculate the B's
@@ -219,28 +319,29 @@ class EvoMPS_TDVP_Generic:
             if n < self.N:
                 for s in xrange(self.q[n]): 
                     for t in xrange(self.q[n+1]):
-                        self.K[n] += m.mmul(self.C[n][s, t],
-                                              self.r[n + 1], m.H(self.A[n+1][t]), 
-                                              m.H(self.A[n][s]))
-                    self.K[n] += m.mmul(self.A[n][s], self.K[n + 1], 
-                                          m.H(self.A[n][s]))
+                        self.K[n] += m.dot_nh(m.dot_nnh(self.C[n][s, t],
+                                                        self.r[n + 1], self.A[n+1][t]), 
+                                              self.A[n][s])
+                    self.K[n] += m.dot_nnh(self.A[n][s], self.K[n + 1], 
+                                           self.A[n][s])
             
             if not self.h_ext is None:
                 for s in xrange(self.q[n]):
                     for t in xrange(self.q[n]):
                         h_ext_st = self.h_ext(n, s, t)
                         if h_ext_st != 0:
-                            self.K[n] += h_ext_st * m.mmul(self.A[n][t], 
-                                                    self.r[n], m.H(self.A[n][s]))
+                            self.K[n] += h_ext_st * m.dot_nnh(self.A[n][t], 
+                                                    self.r[n], self.A[n][s])
     
-    def update(self):
+    def update(self, restore_rcf=True):
         self.calc_l()
         self.calc_r()
-        self.restore_RCF()
+        if restore_rcf:
+            self.restore_RCF()
         self.calc_C()
         self.calc_K()    
     
-    def calc_Vsh(self, n, sqrt_r):
+    def calc_Vsh(self, n, sqrt_r, implicit=False):
         """Generates m.H(V[n][s]) for a given n, used for generating B[n][s]
         
         This is described on p. 14 of arXiv:1103.0936v2 [cond-mat.str-el] for left 
@@ -251,25 +352,51 @@ class EvoMPS_TDVP_Generic:
         Each V[n] directly depends only on A[n] and r[n].
         
         We return the conjugate m.H(V) because we use it in more places than V.
+        
+        The basis is computed using nullspace.get_nullspace() with the method 
+        ns_method, or using nullspace.nullspace_qr() if ns_method is None. The
+        rank-revealing methods 'qrp' and 'rand' use the previous basis 
+        Vsh[n] as a starting guess.
+        
+        If implicit is True, a nullspace.nullspace_projector is returned instead,
+        which applies V V^dagger to parameter matrices x of shape 
+        (D[n - 1], q[n] * D[n]), with block s given by x[:, s * D[n]:(s + 1) * D[n]].
         """
+        if implicit:
+            R = sp.empty((self.q[n], self.D[n], self.D[n - 1]), dtype=self.typ)
+            for s in xrange(self.q[n]):
+                R[s] = m.dot_nh(sqrt_r, self.A[n][s])
+                
+            return ns.nullspace_projector(R.reshape((self.q[n] * self.D[n], self.D[n - 1])))
+        
         R = sp.zeros((self.D[n], self.q[n], self.D[n-1]), dtype=self.typ, order='C')
         
         for s in xrange(self.q[n]):
-            R[:,s,:] = m.mmul(sqrt_r, m.H(self.A[n][s]))
+            R[:,s,:] = m.dot_nh(sqrt_r, self.A[n][s])
 
         R = R.reshape((self.q[n] * self.D[n], self.D[n-1]))
-        V = m.H(ns.nullspace_qr(m.H(R)))
+        if self.ns_method is None:
+            V = m.H(ns.nullspace_qr(m.H(R)))
+        else:
+            V0 = None
+            if not self.Vsh[n] is None:
+                V0 = self.Vsh[n].transpose((1, 0, 2)).reshape((self.q[n] * self.D[n], -1))
+            V = m.H(ns.get_nullspace(m.H(R), method=self.ns_method, V0=V0,
+                                     rtol=self.eps * self.q[n] * self.D[n],
+                                     rank=self.D[n - 1]))
         #print (q[n]*D[n] - D[n-1], q[n]*D[n])
         #print V.shape
         #print sp.allclose(mat(V) * mat(V).H, sp.eye(q[n]*D[n] - D[n-1]))
         #print sp.allclose(mat(V) * mat(Rh).H, 0)
-        V = V.reshape((self.q[n] * self.D[n] - self.D[n - 1], self.D[n], self.q[n])) #this works with the above form for R
+        V = V.reshape((-1, self.D[n], self.q[n])) #this works with the above form for R
         
         #prepare for using V[s] and already take the adjoint, since we use it more often
-        Vsh = sp.empty((self.q[n], self.D[n], self.q[n] * self.D[n] - self.D[n - 1]), dtype=self.typ, order=self.odr)
+        Vsh = sp.empty((self.q[n], self.D[n], V.shape[0]), dtype=self.typ, order=self.odr)
         for s in xrange(self.q[n]):
             Vsh[s] = m.H(V[:,:,s])
         
+        self.Vsh[n] = Vsh
+        
         return Vsh
         
     def calc_x(self, n, Vsh, sqrt_l, sqrt_r, sqrt_l_inv, sqrt_r_inv):
@@ -292,7 +419,13 @@ class EvoMPS_TDVP_Generic:
             - K[n + 1]
             - V[n]
         """
-        x = sp.zeros((self.D[n - 1], self.q[n] * self.D[n] - self.D[n - 1]), dtype=self.typ, order=self.odr)
+        implicit = isinstance(Vsh, ns.nullspace_projector)
+        Dn = self.D[n]
+        
+        if implicit:
+            x = sp.zeros((self.D[n - 1], self.q[n] * Dn), dtype=self.typ, order=self.odr)
+        else:
+            x = sp.zeros((self.D[n - 1], Vsh.shape[2]), dtype=self.typ, order=self.odr)
         x_part = sp.empty_like(x)
         x_subpart = sp.empty_like(self.A[n][0])
         x_subsubpart = sp.empty_like(self.A[n][0])
@@ -304,7 +437,7 @@ class EvoMPS_TDVP_Generic:
             if n < self.N:
                 x_subsubpart.fill(0)
                 for t in xrange(self.q[n + 1]):
-                    x_subsubpart += m.mmul(self.C[n][s,t], self.r[n + 1], m.H(self.A[n + 1][t])) #~1st line
+                    x_subsubpart += m.dot_nnh(self.C[n][s,t], self.r[n + 1], self.A[n + 1][t]) #~1st line
                     
                 x_subsubpart += m.mmul(self.A[n][s], self.K[n + 1]) #~3rd line               
                 
@@ -316,7 +449,10 @@ class EvoMPS_TDVP_Generic:
                     x_subsubpart += self.h_ext(n, s, t) * self.A[n][t] #it may be more effecient to squeeze this into the nn term...
                 x_subpart += m.mmul(x_subsubpart, sqrt_r)
             
-            x_part += m.mmul(x_subpart, Vsh[s])
+            if implicit:
+                x_part[:, s * Dn:(s + 1) * Dn] = x_subpart
+            else:
+                x_part += m.mmul(x_subpart, Vsh[s])
                 
         x += m.mmul(sqrt_l, x_part)
             
@@ -325,9 +461,15 @@ class EvoMPS_TDVP_Generic:
             for s in xrange(self.q[n]):     #~2nd line
                 x_subsubpart.fill(0)
                 for t in xrange(self.q[n + 1]):
-                    x_subsubpart += m.mmul(m.H(self.A[n - 1][t]), self.l[n - 2], self.C[n - 1][t, s])
-                x_part += m.mmul(x_subsubpart, sqrt_r, Vsh[s])
+                    x_subsubpart += m.dot_hnn(self.A[n - 1][t], self.l[n - 2], self.C[n - 1][t, s])
+                if implicit:
+                    x_part[:, s * Dn:(s + 1) * Dn] = m.mmul(x_subsubpart, sqrt_r)
+                else:
+                    x_part += m.mmul(x_subsubpart, sqrt_r, Vsh[s])
             x += m.mmul(sqrt_l_inv, x_part)
+        
+        if implicit:
+            x = Vsh.dot_left(x)
                 
         return x
         
@@ -342,19 +484,101 @@ class EvoMPS_TDVP_Generic:
         if self.q[n] * self.D[n] - self.D[n - 1] > 0:
             l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv = self.calc_l_r_roots(n)
             
-            Vsh = self.calc_Vsh(n, r_sqrt)
+            Vsh = self.calc_Vsh(n, r_sqrt, implicit=self.implicit_V)
             
-            x = self.calc_x(n, Vsh, l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv)
+            return self._calc_B_from_Vsh(n, Vsh, l_sqrt, r_sqrt, l_sqrt_inv, 
+                                         r_sqrt_inv, set_eta)
+        else:
+            return None
             
-            if set_eta:
-                self.eta[n] = sp.sqrt(m.adot(x, x))
-    
-            B = sp.empty_like(self.A[n])
+    def _calc_B_from_Vsh(self, n, Vsh, l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv,
+                         set_eta):
+        x = self.calc_x(n, Vsh, l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv)
+        
+        if set_eta:
+            self.eta[n] = sp.sqrt(m.adot(x, x))
+
+        B = sp.empty_like(self.A[n])
+        if isinstance(Vsh, ns.nullspace_projector):
+            Dn = self.D[n]
             for s in xrange(self.q[n]):
-                B[s] = m.mmul(l_sqrt_inv, x, m.H(Vsh[s]), r_sqrt_inv)
-            return B
+                B[s] = m.mmul(l_sqrt_inv, x[:, s * Dn:(s + 1) * Dn], r_sqrt_inv)
         else:
-            return None
+            for s in xrange(self.q[n]):
+                B[s] = m.mmul(l_sqrt_inv, m.dot_nh(x, Vsh[s]), r_sqrt_inv)
+        return B
+        
+    def calc_B_all(self, set_eta=True):
+        """Generates the B[n] tangent vectors for all sites.
+        
+        The result is the same as that of calling calc_B(n) for n = 1..N, 
+        but the eigenvalue decompositions needed for the roots of l and r 
+        and the nullspace bases V[n] are computed in batches, with one 
+        LAPACK call per group of sites with the same shape. In the bulk of
+        a chain, most sites share the same shape.
+        
+        Returns
+        -------
+        B : list
+            A list of length N + 1 with B[n] the tangent vector for site n,
+            or None where B[n] is not defined (and for n = 0).
+        """
+        l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv = self.calc_l_r_roots_all()
+        
+        Vsh = self.calc_Vsh_all(r_sqrt, implicit=self.implicit_V)
+        
+        B = [None] * (self.N + 1)
+        for n in xrange(1, self.N + 1):
+            if not Vsh[n] is None:
+                B[n] = self._calc_B_from_Vsh(n, Vsh[n], l_sqrt[n], r_sqrt[n], 
+                                             l_sqrt_inv[n], r_sqrt_inv[n],
+                                             set_eta)
+        
+        return B
+        
+    def calc_Vsh_all(self, r_sqrt, implicit=False):
+        """Generates Vsh[n] (see calc_Vsh()) for all sites, given the
+        roots r_sqrt[n].
+        
+        Sites with the same (q[n], D[n - 1], D[n]) are handled together,
+        using nullspace.nullspace_stacked() (one QR decomposition each) or,
+        if implicit is True, a single stacked Cholesky decomposition (see 
+        nullspace.nullspace_projectors()). The resulting bases differ from
+        those of calc_Vsh() by a unitary transformation, which does not 
+        affect B.
+        
+        If ns_method is set, calc_Vsh() is called for each site instead.
+        
+        Returns a list of length N + 1 with None where V[n] is empty.
+        """
+        Vsh = [None] * (self.N + 1)
+        
+        groups = {}
+        for n in xrange(1, self.N + 1):
+            if self.q[n] * self.D[n] - self.D[n - 1] > 0:
+                if self.ns_method is None or implicit:
+                    groups.setdefault((self.q[n], self.D[n - 1], self.D[n]), []).append(n)
+                else:
+                    Vsh[n] = self.calc_Vsh(n, r_sqrt[n])
+                
+        for (q, Dm1, Dn), sites in groups.iteritems():
+            R = sp.empty((len(sites), q, Dn, Dm1), dtype=self.typ)
+            for i, n in enumerate(sites):
+                for s in xrange(q):
+                    R[i, s] = m.dot_nh(r_sqrt[n], self.A[n][s])
+            R = R.reshape((len(sites), q * Dn, Dm1))
+            
+            if implicit:
+                P = ns.nullspace_projectors(R)
+                for i, n in enumerate(sites):
+                    Vsh[n] = P[i]
+            else:
+                V = ns.nullspace_stacked(R.conj().transpose((0, 2, 1)))
+                V = V.reshape((len(sites), q, Dn, q * Dn - Dm1))
+                for i, n in enumerate(sites):
+                    Vsh[n] = sp.asarray(V[i], order=self.odr)
+        
+        return Vsh
         
     def calc_l_r_roots(self, n):
         """Returns the matrix square roots (and inverses) needed to calculate B.
@@ -362,46 +586,110 @@ class EvoMPS_TDVP_Generic:
         Hermiticity of l[n] and r[n] is used to speed this up.
         If an exception occurs here, it is probably because these matrices
         are not longer Hermitian (enough).
+        
+        If l[n] or r[n] are diagonal or the identity, as they are after
+        restore_RCF(), the roots and inverses are computed elementwise.
         """
-        l_sqrt, evd = m.sqrtmh(self.l[n - 1], ret_evd=True)
-        l_sqrt_inv = m.invmh(l_sqrt, evd=evd)
+        if isinstance(self.l[n - 1], (m.eyemat, m.simple_diag_matrix)):
+            l_sqrt = self.l[n - 1].sqrt()
+            l_sqrt_inv = l_sqrt.inv()
+        else:
+            l_sqrt, evd = m.sqrtmh(self.l[n - 1], ret_evd=True)
+            l_sqrt_inv = m.invmh(l_sqrt, evd=evd)
 
-        r_sqrt, evd =  m.sqrtmh(self.r[n], ret_evd=True)
-        r_sqrt_inv = m.invmh(r_sqrt, evd=evd)
+        if isinstance(self.r[n], (m.eyemat, m.simple_diag_matrix)):
+            r_sqrt = self.r[n].sqrt()
+            r_sqrt_inv = r_sqrt.inv()
+        else:
+            r_sqrt, evd =  m.sqrtmh(self.r[n], ret_evd=True)
+            r_sqrt_inv = m.invmh(r_sqrt, evd=evd)
+        
+        return l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv
+        
+    def calc_l_r_roots_all(self):
+        """Returns the matrix square roots (and inverses) needed to calculate 
+        B[n], for all n.
+        
+        The result is the same as that of calling calc_l_r_roots(n) for
+        n = 1..N, except that the dense l[n - 1] and r[n] are diagonalized 
+        in batches, with one call to numpy.linalg.eigh() per matrix shape.
+        
+        Returns
+        -------
+        (l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv) : lists
+            Lists of length N + 1, indexed by n (entry 0 is None).
+        """
+        l_sqrt = [None] * (self.N + 1)
+        r_sqrt = [None] * (self.N + 1)
+        l_sqrt_inv = [None] * (self.N + 1)
+        r_sqrt_inv = [None] * (self.N + 1)
+        
+        dense = {}
+        for n in xrange(1, self.N + 1):
+            for x, x_sqrt, x_sqrt_inv in ((self.l[n - 1], l_sqrt, l_sqrt_inv),
+                                          (self.r[n], r_sqrt, r_sqrt_inv)):
+                if isinstance(x, (m.eyemat, m.simple_diag_matrix)):
+                    x_sqrt[n] = x.sqrt()
+                    x_sqrt_inv[n] = x_sqrt[n].inv()
+                else:
+                    dense.setdefault(x.shape, []).append((n, x, x_sqrt, x_sqrt_inv))
+        
+        for grp in dense.itervalues():
+            ev, EV = np.linalg.eigh(sp.array([g[1] for g in grp]))
+            ev = sp.sqrt(ev) #may be complex, as in m.sqrtmh()
+            EVh = EV.conj().transpose((0, 2, 1))
+            
+            sqrts = np.matmul(EV * ev[:, None, :], EVh)
+            sqrts_inv = np.matmul(EV / ev[:, None, :], EVh)
+            
+            for i, (n, x, x_sqrt, x_sqrt_inv) in enumerate(grp):
+                x_sqrt[n] = sqrts[i]
+                x_sqrt_inv[n] = sqrts_inv[i]
         
         return l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv
     
+    def _check_dtau(self, dtau):
+        if sp.imag(dtau) != 0 and not sp.iscomplexobj(self.A[1]):
+            raise ValueError("A complex dtau requires a complex typ. See set_typ().")
+            
+    def _check_promote(self, eta):
+        """Promotes a single-precision state to double precision if eta has
+        dropped below promote_eta.
+        """
+        if (not self.promote_eta is None and self.eps > sp.finfo(sp.float64).eps
+            and abs(eta) < self.promote_eta):
+            self.set_typ(sp.promote_types(self.typ, sp.float64).type)
+    
     def take_step(self, dtau): #simple, forward Euler integration     
         """Performs a complete forward-Euler step of imaginary time dtau.
         
         If dtau is itself imaginary, real-time evolution results.
         
-        Here, the A's are updated as the sites are visited. Since we want all
-        tangent vectors to be generated using the old state, we must delay
-        updating each A[n] until we are *two* steps away (due to the direct
-        dependency on A[n - 1] in calc_x).
+        All tangent vectors are generated from the old state, in one batched
+        pass (see calc_B_all()), before any A[n] is updated.
         
-        The dependencies on l, r, C and K are not a problem because we store
-        all these matrices separately and do not update them at all during take_step().
+        If the state is single-precision and the total eta is below 
+        promote_eta, the state is promoted to double precision after the 
+        step (see set_typ()).
         
         Parameters
         ----------
         dtau : complex
             The (imaginary or real) amount of imaginary time (tau) to step.
         """
+        self._check_dtau(dtau)
+        
         eta_tot = 0
         
-        B_prev = None
-        for n in xrange(1, self.N + 2):
-            #V is not always defined (e.g. at the right boundary vector, and possibly before)
-            if n <= self.N:
-                B = self.calc_B(n)
-                eta_tot += self.eta[n]
+        B = self.calc_B_all()
+        for n in xrange(1, self.N + 1):
+            eta_tot += self.eta[n]
             
-            if n > 1 and not B_prev is None:
-                self.A[n - 1] += -dtau * B_prev
-                
-            B_prev = B
+            #V is not always defined (e.g. at the right boundary vector, and possibly before)
+            if not B[n] is None:
+                self.A[n] += -dtau * B[n]
+        
+        self._check_promote(eta_tot)
             
         return eta_tot
 
@@ -440,11 +728,13 @@ class EvoMPS_TDVP_Generic:
         dbg_bstep = False
         safe_mode = True
         
-        tol = sp.finfo(sp.complex128).eps * 3
+        tol = self.eps * 3
         max_iter = 10
         itr_switch_mode = 10
         #---------------------------
         
+        self._check_dtau(dtau)
+        
         if midpoint:
             dtau = dtau / 2
         
@@ -523,7 +813,7 @@ class EvoMPS_TDVP_Generic:
                             self.A[n][s] += dA[s]
     
                     for s in xrange(self.q[n]):
-                        r_dA += m.mmul(dA[s], self.r[n], m.H(dA[s]))
+                        r_dA += m.dot_nnh(dA[s], self.r[n], dA[s])
                         sqsum += sum(dA[s]**2)
                     
                     fnorm = sp.sqrt(sqsum)
@@ -594,7 +884,7 @@ class EvoMPS_TDVP_Generic:
                 r_dA = sp.zeros_like(self.r[n - 1])
                 sqsum = 0
                 for s in xrange(self.q[n]):
-                    r_dA += m.mmul(dA[s], self.r[n], m.H(dA[s]))
+                    r_dA += m.dot_nnh(dA[s], self.r[n], dA[s])
                     sqsum += sum(dA[s]**2)
                 delta_n = sp.sqrt(sp.trace(m.mmul(self.l[n - 1], r_dA)))                
                 delta2 += delta_n
@@ -629,6 +919,8 @@ class EvoMPS_TDVP_Generic:
         Euler method, since there is no need to iteratively solve an implicit
         equation.
         """
+        self._check_dtau(dtau)
+        
         def upd():
             self.calc_l()
             self.calc_r()
@@ -642,58 +934,194 @@ class EvoMPS_TDVP_Generic:
         for n in xrange(1, self.N + 1):
             A0[n] = self.A[n].copy()
 
-        B_fin = sp.empty_like(self.A)
-
-        B_prev = None
-        for n in xrange(1, self.N + 2):
-            if n <= self.N:
-                B = self.calc_B(n) #k1
-                eta_tot += self.eta[n]
-                B_fin[n] = B
-
-            if not B_prev is None:
-                self.A[n - 1] = A0[n - 1] - dtau/2 * B_prev
-
-            B_prev = B
+        B_fin = self.calc_B_all() #k1
+        for n in xrange(1, self.N + 1):
+            eta_tot += self.eta[n]
+            if not B_fin[n] is None:
+                self.A[n] = A0[n] - dtau/2 * B_fin[n]
 
         upd()
 
-        B_prev = None
-        for n in xrange(1, self.N + 2):
-            if n <= self.N:
-                B = self.calc_B(n, set_eta=False) #k2
-
-            if not B_prev is None:
-                self.A[n - 1] = A0[n - 1] - dtau/2 * B_prev
-                B_fin[n - 1] += 2 * B_prev
-
-            B_prev = B
+        B = self.calc_B_all(set_eta=False) #k2
+        for n in xrange(1, self.N + 1):
+            if not B[n] is None:
+                self.A[n] = A0[n] - dtau/2 * B[n]
+                B_fin[n] += 2 * B[n]
 
         upd()
 
-        B_prev = None
-        for n in xrange(1, self.N + 2):
-            if n <= self.N:
-                B = self.calc_B(n, set_eta=False) #k3
-
-            if not B_prev is None:
-                self.A[n - 1] = A0[n - 1] - dtau * B_prev
-                B_fin[n - 1] += 2 * B_prev
-
-            B_prev = B
+        B = self.calc_B_all(set_eta=False) #k3
+        for n in xrange(1, self.N + 1):
+            if not B[n] is None:
+                self.A[n] = A0[n] - dtau * B[n]
+                B_fin[n] += 2 * B[n]
 
         upd()
 
+        B = self.calc_B_all(set_eta=False) #k4
         for n in xrange(1, self.N + 1):
-            B = self.calc_B(n, set_eta=False) #k4
-            if not B is None:
-                B_fin[n] += B
+            if not B[n] is None:
+                B_fin[n] += B[n]
 
         for n in xrange(1, self.N + 1):
             if not B_fin[n] is None:
                 self.A[n] = A0[n] - dtau /6 * B_fin[n]
+                
+        self._check_promote(eta_tot)
 
         return eta_tot
+        
+    def take_step_adaptive(self, dtau, tol=1E-6, method='bs32', dtau_max=None,
+                           max_rejects=10):
+        """Takes a step using an embedded Runge-Kutta pair with error control.
+        
+        The error of the step is estimated from the difference between the
+        two solutions of the pair, dA[n], measured in the tangent-space 
+        metric as sqrt(sum_n sum_s tr(l[n - 1] dA[n][s] r[n] dA[n][s]^dagger)),
+        using l and r of the initial state. If it exceeds tol, the step is 
+        rejected and retried with a smaller step. Only the magnitude of dtau
+        is adapted, so that its phase (e.g. imaginary for real-time 
+        evolution) is kept.
+        
+        Both pairs have the first-same-as-last property: The last stage is
+        B at the new state. It is kept and used as the first stage of the 
+        next call, unless A, C or K have changed in the meantime. This is 
+        the case if the state is updated using update(restore_rcf=False), 
+        but not if the canonical form is restored.
+        
+        Parameters
+        ----------
+        dtau : complex
+            The proposed step, usually the dtau_next of the previous step.
+        tol : float
+            The tolerance for the error estimate of a single step.
+        method : str
+            The embedded pair (see rk.rk_embedded_tableau()).
+        dtau_max : float
+            The maximum magnitude of the proposed next step.
+        max_rejects : int
+            The maximum number of rejections, after which the step is 
+            accepted anyway.
+            
+        Returns
+        -------
+        eta_tot : float
+            The total eta of the initial state.
+        dtau : complex
+            The step taken.
+        dtau_next : complex
+            The proposed next step.
+        """
+        self._check_dtau(dtau)
+        
+        def upd():
+            self.calc_l()
+            self.calc_r()
+            self.calc_C()
+            self.calc_K()
+            
+        def comb(coeffs, Bs):
+            res = [None] * (self.N + 1)
+            for c, B in zip(coeffs, Bs):
+                if c == 0:
+                    continue
+                for n in xrange(1, self.N + 1):
+                    if not B[n] is None:
+                        if res[n] is None:
+                            res[n] = c * B[n]
+                        else:
+                            res[n] += c * B[n]
+            return res
+
+        a, b, e, order, fsal = rk.rk_embedded_tableau(method)
+
+        #Take a copy of the current state
+        A0 = sp.empty_like(self.A)
+        l0 = sp.empty_like(self.l)
+        r0 = sp.empty_like(self.r)
+        for n in xrange(1, self.N + 1):
+            A0[n] = self.A[n].copy()
+        for n in xrange(self.N + 1):
+            l0[n] = sp.array(self.l[n])
+            r0[n] = sp.array(self.r[n])
+        
+        B_i = self._get_B_fsal()
+        if B_i is None:
+            B_i = self.calc_B_all() #k1
+        eta0 = self.eta.copy()
+        eta_tot = 0
+        for n in xrange(1, self.N + 1):
+            eta_tot += self.eta[n]
+        
+        rejects = 0
+        while True:
+            k = [B_i]
+            for i in xrange(1, len(a)):
+                dA = comb(a[i], k)
+                for n in xrange(1, self.N + 1):
+                    if not dA[n] is None:
+                        self.A[n] = A0[n] - dtau * dA[n]
+                upd()
+                k.append(self.calc_B_all(set_eta=fsal and i == len(a) - 1))
+            
+            dA = comb(e, k)
+            err = 0
+            for n in xrange(1, self.N + 1):
+                if not dA[n] is None:
+                    for s in xrange(self.q[n]):
+                        err += m.adot(dA[n][s], 
+                                      m.mmul(l0[n - 1], dA[n][s], r0[n])).real
+            err = abs(dtau) * sp.sqrt(max(err, 0)) / tol
+            
+            fac = rk.rk_step_factor(err, order)
+            if err <= 1:
+                break
+                
+            if rejects == max_rejects:
+                print "Warning: Accepting step with error above tolerance!"
+                break
+            
+            rejects += 1
+            dtau = dtau * min(fac, 1.)
+        
+        if fsal: #the last stage was evaluated at the new state
+            self._B_fsal = (self._copy_arrays(self.A), self._copy_arrays(self.C),
+                            self._copy_arrays(self.K), k[-1], self.eta)
+            self.eta = eta0
+        else:
+            dA = comb(b, k)
+            for n in xrange(1, self.N + 1):
+                if not dA[n] is None:
+                    self.A[n] = A0[n] - dtau * dA[n]
+                
+        dtau_next = dtau * fac
+        if not dtau_max is None and abs(dtau_next) > dtau_max:
+            dtau_next = dtau_next * (dtau_max / abs(dtau_next))
+        
+        self._check_promote(eta_tot)
+
+        return eta_tot, dtau, dtau_next
+            
+    def _copy_arrays(self, x):
+        return [None if xn is None else xn.copy() for xn in x]
+        
+    def _get_B_fsal(self):
+        """Returns the last stage of the previous take_step_adaptive() call,
+        if it is B at the current state, and restores the corresponding eta.
+        Otherwise, None is returned.
+        """
+        if self._B_fsal is None:
+            return None
+        
+        A, C, K, B, eta = self._B_fsal
+        self._B_fsal = None
+        for old, new in ((A, self.A), (C, self.C), (K, self.K)):
+            for xo, xn in zip(old, new):
+                if not sp.array_equal(xo, xn): #also handles None
+                    return None
+        
+        self.eta = eta
+        return B
             
     def add_noise(self, fac):
         """Adds some random noise of a given order to the state matrices A
@@ -703,7 +1131,8 @@ class EvoMPS_TDVP_Generic:
         for n in xrange(1, self.N + 1):
             for s in xrange(self.q[n]):
                 self.A[n][s].real += (sp.rand(self.D[n - 1], self.D[n]) - 0.5) * 2 * fac
-                self.A[n][s].imag += (sp.rand(self.D[n - 1], self.D[n]) - 0.5) * 2 * fac
+                if sp.iscomplexobj(self.A[n]):
+                    self.A[n][s].imag += (sp.rand(self.D[n - 1], self.D[n]) - 0.5) * 2 * fac
                 
     
     def calc_l(self, start=-1, finish=-1):
@@ -716,10 +1145,7 @@ class EvoMPS_TDVP_Generic:
         if finish < 0:
             finish = self.N
         for n in xrange(start, finish + 1):
-            self.l[n].fill(0)
-
-            for s in xrange(self.q[n]):
-                self.l[n] += m.mmul(m.H(self.A[n][s]), self.l[n - 1], self.A[n][s])
+            self.l[n] = self.eps_l(n, self.l[n - 1])
     
     def calc_r(self, n_low=-1, n_high=-1):
         """Updates the r matrices using the current state.
@@ -731,7 +1157,7 @@ class EvoMPS_TDVP_Generic:
         if n_high < 0:
             n_high = self.N - 1
         for n in reversed(xrange(n_low, n_high + 1)):
-            self.eps_r(n + 1, self.r[n + 1], out=self.r[n])
+            self.r[n] = self.eps_r(n + 1, self.r[n + 1])
     
     def simple_renorm(self, update_r=True):
         """Renormalize the state by altering A[N] by a factor.
@@ -787,22 +1213,28 @@ class EvoMPS_TDVP_Generic:
         res : ndarray
             The resulting matrix.
         """
-        if out is None:
-            out = sp.zeros((self.D[n - 1], self.D[n - 1]), dtype=self.typ)
-        else:
-            out.fill(0)
-
         if o is None:
+            if out is None:
+                out = sp.zeros((self.D[n - 1], self.D[n - 1]), 
+                               dtype=sp.result_type(self.typ, x.dtype))
+            else:
+                out.fill(0)
+                
             for s in xrange(self.q[n]):
-                out += m.mmul(self.A[n][s], x, m.H(self.A[n][s]))            
+                out += m.dot_nnh(self.A[n][s], x, self.A[n][s])
         else:
+            #o may be complex even if the state is real
+            res = 0
             for s in xrange(self.q[n]):
                 for t in xrange(self.q[n]):
                     o_st = o(n, s, t)
                     if o_st != 0.:
-                        tmp = m.mmul(self.A[n][t], x, m.H(self.A[n][s]))
-                        tmp *= o_st
-                        out += tmp
+                        res = res + o_st * m.dot_nnh(self.A[n][t], x, self.A[n][s])
+            
+            if out is None:
+                out = sp.zeros((self.D[n - 1], self.D[n - 1]), 
+                               dtype=sp.result_type(self.typ, x.dtype, res))
+            out[:] = res
         return out
         
     def eps_l(self, n, x, out=None):
@@ -825,12 +1257,13 @@ class EvoMPS_TDVP_Generic:
             The resulting matrix.
         """
         if out is None:
-            out = sp.zeros_like(self.l[n])
+            out = sp.zeros((self.D[n], self.D[n]), 
+                           dtype=sp.result_type(self.typ, x.dtype))
         else:
             out.fill(0.)
 
         for s in xrange(self.q[n]):
-            out += m.mmul(m.H(self.A[n][s]), x, self.A[n][s])
+            out += m.dot_hnn(self.A[n][s], x, self.A[n][s])
         return out
     
     def restore_ONR_n(self, n, G_n_i):
@@ -862,7 +1295,7 @@ class EvoMPS_TDVP_Generic:
         G_n_m1_i : ndarray
             The inverse gauge transformation matrix for the site n - 1.
         """
-        GGh_n_i = m.mmul(G_n_i, m.H(G_n_i)) #r[n] does not belong here. The condition is for sum(AA). r[n] = 1 is a consequence. 
+        GGh_n_i = m.dot_nh(G_n_i, G_n_i) #r[n] does not belong here. The condition is for sum(AA). r[n] = 1 is a consequence. 
         
         M = self.eps_r(n, GGh_n_i)
                     
@@ -930,17 +1363,17 @@ class EvoMPS_TDVP_Generic:
         """   
         if start < 1:
             start = self.N
+            
+        #Tolerance for the sanity checks, scaled with the precision of typ
+        check_tol = 1E-12 * self.eps / sp.finfo(sp.float64).eps
         
         G_n_i = sp.eye(self.D[start], dtype=self.typ) #This is actually just the number 1
         for n in reversed(xrange(2, start + 1)):
             G_n_i = self.restore_ONR_n(n, G_n_i)
-            self.eps_r(n, self.r[n], out=self.r[n - 1]) #Update r[n - 1], which should, ideally, now equal 1
-            #self.r[n - 1][:] = sp.eye(self.D[n - 1])
-            #self.r[n - 1] = m.eyemat(self.D[n - 1], dtype=self.typ)
-            #print self.r[n - 1]
+            self.r[n - 1] = m.eyemat(self.D[n - 1], dtype=self.typ) #r[n - 1] = 1 by construction
             if self.sanity_checks and not diag_l:
-                r_nm1 = self.eps_r(n, m.eyemat(self.D[n], self.typ))
-                if not sp.allclose(r_nm1, self.r[n - 1], atol=1E-12, rtol=1E-12):
+                r_nm1 = self.eps_r(n, self.r[n])
+                if not sp.allclose(r_nm1, sp.eye(self.D[n - 1]), atol=check_tol, rtol=check_tol):
                     print "Sanity Fail in restore_RCF!: r_%u is bad" % n
         
         #Now do A[1]...
@@ -958,26 +1391,25 @@ class EvoMPS_TDVP_Generic:
             
             if self.sanity_checks:
                 r0 = self.eps_r(1, self.r[1])
-                if not sp.allclose(r0, 1, atol=1E-12, rtol=1E-12):
+                if not sp.allclose(r0, 1, atol=check_tol, rtol=check_tol):
                     print "Sanity Fail in restore_RCF!: r_0 is bad / norm failure"
                 
         if diag_l:
             G_nm1 = sp.eye(self.D[0], dtype=self.typ)
             for n in xrange(1, self.N):
-                x = m.mmul(m.H(G_nm1), self.l[n - 1], G_nm1)
+                x = m.dot_hnn(G_nm1, self.l[n - 1], G_nm1)
                 M = self.eps_l(n, x)
                 ev, EV = la.eigh(M)
                 
                 G_n_i = EV
-                self.l[n][:] = sp.diag(ev)
-                #self.l[n] = m.simple_diag_matrix(sp.array(ev, dtype=self.typ))
+                self.l[n] = m.simple_diag_matrix(ev, dtype=self.typ)
                 
                 for s in xrange(self.q[n]):                
                     self.A[n][s] = m.mmul(G_nm1, self.A[n][s], G_n_i)
                 
                 if self.sanity_checks:
                     l = self.eps_l(n, self.l[n - 1])
-                    if not sp.allclose(l, self.l[n]):
+                    if not sp.allclose(l, self.l[n], atol=check_tol, rtol=check_tol):
                         print "Sanity Fail in restore_RCF!: l_%u is bad" % n
                 
                 G_nm1 = m.H(EV)
@@ -991,13 +1423,13 @@ class EvoMPS_TDVP_Generic:
             self.eps_l(n, self.l[n - 1], out=self.l[n])
             
             if self.sanity_checks:
-                if not sp.allclose(self.l[self.N].real, 1, atol=1E-12, rtol=1E-12):
+                if not sp.allclose(self.l[self.N].real, 1, atol=check_tol, rtol=check_tol):
                     print "Sanity Fail in restore_RCF!: l_N is bad / norm failure"
                     print "l_N = " + str(self.l[self.N].squeeze().real)
                 
                 for n in xrange(1, self.N + 1):
                     r_nm1 = self.eps_r(n, m.eyemat(self.D[n], self.typ))
-                    if not sp.allclose(r_nm1, self.r[n - 1], atol=1E-12, rtol=1E-12):
+                    if not sp.allclose(r_nm1, self.r[n - 1], atol=check_tol, rtol=check_tol):
                         print "Sanity Fail in restore_RCF!: r_%u is bad" % n
                     
             return True #FIXME: This OK?
@@ -1044,9 +1476,15 @@ class EvoMPS_TDVP_Generic:
         n : int
             The site number.
         """
-        res = self.eps_r(n, self.r[n], o)
-        res = m.mmul(self.l[n - 1], res)
-        return res.trace()
+        rho = self.density_1s(n)
+        
+        res = 0
+        for s in xrange(self.q[n]):
+            for t in xrange(self.q[n]):
+                o_st = o(n, s, t)
+                if o_st != 0.:
+                    res += o_st * rho[s, t]
+        return res
         
     def expect_1s_cor(self, o1, o2, n1, n2):
         """Computes the correlation of two single site operators acting on two different sites.
@@ -1086,15 +1524,17 @@ class EvoMPS_TDVP_Generic:
         n1 : int
             The site number.
         """
-        rho = sp.empty((self.q[n], self.q[n]), dtype=sp.complex128)
-                    
-        r_n = self.r[n]
-        r_nm1 = sp.empty_like(self.r[n - 1])
-        for s in xrange(self.q[n]):
-            for t in xrange(self.q[n]):
-                r_nm1 = m.mmul(self.A[n][t], r_n, m.H(self.A[n][s]))                
-                rho[s, t] = m.mmul(self.l[n - 1], r_nm1).trace()
-        return rho
+        q = self.q[n]
+        
+        #rho[s, t] = tr(l[n - 1] A[n][t] r[n] A[n][s]^dagger), which is a
+        #single product of the stacked l[n - 1] A[n][t] r[n] with the A[n][s].
+        lAr = sp.empty_like(self.A[n])
+        for t in xrange(q):
+            lAr[t] = m.mmul(self.l[n - 1], self.A[n][t], self.r[n])
+            
+        rho = m.dot_nh(self.A[n].reshape((q, -1)), lAr.reshape((q, -1))).conj()
+        
+        return sp.asarray(rho, dtype=sp.complex128)
         
     def density_2s(self, n1, n2):
         """Returns a reduced density matrix for a pair of sites.
@@ -1112,7 +1552,7 @@ class EvoMPS_TDVP_Generic:
         
         for s2 in xrange(self.q[n2]):
             for t2 in xrange(self.q[n2]):
-                r_n2 = m.mmul(self.A[n2][t2], self.r[n2], m.H(self.A[n2][s2]))
+                r_n2 = m.dot_nnh(self.A[n2][t2], self.r[n2], self.A[n2][s2])
                 
                 r_n = r_n2
                 for n in reversed(xrange(n1 + 1, n2)):
@@ -1120,7 +1560,7 @@ class EvoMPS_TDVP_Generic:
                     
                 for s1 in xrange(self.q[n1]):
                     for t1 in xrange(self.q[n1]):
-                        r_n1 = m.mmul(self.A[n1][t1], r_n, m.H(self.A[n1][s1]))
+                        r_n1 = m.dot_nnh(self.A[n1][t1], r_n, self.A[n1][s1])
                         tmp = m.mmul(self.l[n1 - 1], r_n1)
                         rho[s1 * self.q[n1] + s2, t1 * self.q[n1] + t2] = tmp.trace()
         return rho
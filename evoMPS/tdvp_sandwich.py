@@ -9,6 +9,7 @@ import scipy as sp
 import scipy.linalg as la
 import nullspace as ns
 import matmul as mm
+import twosite as ts
 import tdvp_uniform as uni
 
 def go(sim, tau, steps, force_calc_lr=False, RK4=False,
@@ -209,11 +210,16 @@ class EvoMPS_TDVP_Sandwich:
     q = None
 
     h_nn = None
+    h_nn_opsum = None
 
     eps = 0
 
     sanity_checks = False
 
+    implicit_V = False
+
+    ns_method = None
+
     u_gnd_l = None
     u_gnd_r = None
 
@@ -239,6 +245,7 @@ class EvoMPS_TDVP_Sandwich:
         self.K = sp.empty((self.N + 3), dtype=sp.ndarray) #Elements 1..N
         self.C = sp.empty((self.N + 2), dtype=sp.ndarray) #Elements 1..N-1
         self.A = sp.empty((self.N + 3), dtype=sp.ndarray) #Elements 1..N
+        self.Vsh = sp.empty((self.N + 3), dtype=sp.ndarray) #Elements 2..N, as last computed
 
         self.r = sp.empty((self.N + 3), dtype=sp.ndarray) #Elements 0..N
         self.l = sp.empty((self.N + 3), dtype=sp.ndarray)
@@ -267,10 +274,16 @@ class EvoMPS_TDVP_Sandwich:
                 self.C[n] = sp.empty((self.q[n], self.q[n+1], self.D[n-1], self.D[n+1]), dtype=self.typ, order=self.odr)
 
     def __init__(self, numsites, uni_ground):
-        self.u_gnd_l = uni.EvoMPS_TDVP_Uniform(uni_ground.D, uni_ground.q)
+        self.typ = uni_ground.typ
+        
+        self.u_gnd_l = uni.EvoMPS_TDVP_Uniform(uni_ground.D, uni_ground.q, 
+                                               typ=self.typ)
         self.u_gnd_l.sanity_checks = self.sanity_checks
         self.u_gnd_l.h_nn = uni_ground.h_nn
         self.u_gnd_l.h_nn_cptr = uni_ground.h_nn_cptr
+        self.u_gnd_l.h_nn_mat = uni_ground.h_nn_mat
+        self.u_gnd_l.h_nn_coo = uni_ground.h_nn_coo
+        self.u_gnd_l.h_nn_opsum = uni_ground.h_nn_opsum
         self.u_gnd_l.A = uni_ground.A.copy()
         self.u_gnd_l.l = uni_ground.l.copy()
         self.u_gnd_l.r = uni_ground.r.copy()
@@ -283,11 +296,15 @@ class EvoMPS_TDVP_Sandwich:
         self.u_gnd_l_kmr = la.norm(self.u_gnd_l.r / la.norm(self.u_gnd_l.r) - 
                                    self.u_gnd_l.K / la.norm(self.u_gnd_l.K))
 
-        self.u_gnd_r = uni.EvoMPS_TDVP_Uniform(uni_ground.D, uni_ground.q)
+        self.u_gnd_r = uni.EvoMPS_TDVP_Uniform(uni_ground.D, uni_ground.q, 
+                                               typ=self.typ)
         self.u_gnd_r.sanity_checks = self.sanity_checks
         self.u_gnd_r.symm_gauge = False
         self.u_gnd_r.h_nn = uni_ground.h_nn
         self.u_gnd_r.h_nn_cptr = uni_ground.h_nn_cptr
+        self.u_gnd_r.h_nn_mat = uni_ground.h_nn_mat
+        self.u_gnd_r.h_nn_coo = uni_ground.h_nn_coo
+        self.u_gnd_r.h_nn_opsum = uni_ground.h_nn_opsum
         self.u_gnd_r.A = self.u_gnd_l.A.copy()
         self.u_gnd_r.l = self.u_gnd_l.l.copy()
         self.u_gnd_r.r = self.u_gnd_l.r.copy()
@@ -299,6 +316,7 @@ class EvoMPS_TDVP_Sandwich:
 
         self.h_nn = self.wrap_h
         self.h_nn_mat = None
+        self.h_nn_opsum = None
 
         self.eps = sp.finfo(self.typ).eps
 
@@ -321,7 +339,8 @@ class EvoMPS_TDVP_Sandwich:
         """
         for n in xrange(1, self.N + 1):
             self.A[n].real = (sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n]) #/ sp.sqrt(self.N) #/ sp.sqrt(self.D[n])
-            self.A[n].imag = 0#(sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n])
+            if sp.iscomplexobj(self.A[n]):
+                self.A[n].imag = 0#(sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n])
 
     def wrap_h(self, n, s, t, u, v):
         return self.u_gnd_l.h_nn(s, t, u, v)
@@ -329,15 +348,79 @@ class EvoMPS_TDVP_Sandwich:
     def gen_h_matrix(self):
         """Generates a matrix form for h_nn, which can speed up parts of the
         algorithm by avoiding excess loops and python calls.
+        
+        An operator-sum form (see twosite.op_sum()) is also generated for 
+        each site and stored in h_nn_opsum, together with the h_nn it was 
+        generated from. It is only used while h_nn is unchanged.
         """
-        self.h_nn_mat = sp.zeros((self.N + 1, self.q.max(), self.q.max(), 
-                                  self.q.max(), self.q.max()), dtype=sp.complex128)
+        h_nn_mat = sp.zeros((self.N + 1, self.q.max(), self.q.max(), 
+                             self.q.max(), self.q.max()), dtype=self.typ)
+        opsum = []
         for n in xrange(self.N + 1):
-            for u in xrange(self.q[n]):
-                for v in xrange(self.q[n + 1]):
-                    for s in xrange(self.q[n]):
-                        for t in xrange(self.q[n + 1]):
-                            self.h_nn_mat[n, s, t, u, v] = self.h_nn(n, s, t, u, v)
+            q1 = self.q[n]
+            q2 = self.q[n + 1]
+            h_nn_n = lambda s, t, u, v: self.h_nn(n, s, t, u, v)
+            h_nn_mat_n = ts.tabulate(h_nn_n, q1, q2, dtype=self.typ)
+            if h_nn_mat_n.dtype != h_nn_mat.dtype:
+                raise ValueError("h_nn is not real: A complex typ is required.")
+            h_nn_mat[n, :q1, :q2, :q1, :q2] = h_nn_mat_n
+            opsum.append(ts.op_sum(h_nn_mat_n))
+        self.h_nn_mat = h_nn_mat
+        self.h_nn_opsum = (self.h_nn, opsum)
+        
+    def _get_h_nn_opsum(self, n):
+        """Returns the operator-sum form of h_nn for site n, or None if it 
+        is not available for the current h_nn.
+        """
+        if (self.h_nn_opsum is None or not self.h_nn_opsum[0] is self.h_nn
+            or not 0 <= n < len(self.h_nn_opsum[1])):
+            return None
+            
+        return self.h_nn_opsum[1][n]
+        
+    def set_typ(self, typ):
+        """Changes the data type of the state, including that of the uniform
+        states on either side.
+        
+        This can be used, for example, to promote a state found using
+        imaginary-time evolution with typ = float64 to complex128 before 
+        doing real-time evolution. Converting a complex state to a real typ
+        discards any imaginary parts.
+        
+        The state must be updated using update() before further use.
+        """
+        self.typ = typ
+        self.eps = sp.finfo(self.typ).eps
+        
+        self.u_gnd_l.set_typ(typ)
+        self.u_gnd_r.set_typ(typ)
+        
+        cmplx = sp.iscomplexobj(sp.empty(0, dtype=typ))
+        def conv(x):
+            x = sp.asarray(x)
+            if not cmplx:
+                x = x.real
+            return sp.array(x, dtype=typ, order=self.odr)
+        
+        for n in xrange(self.N + 2):
+            self.A[n] = conv(self.A[n])
+            self.l[n] = conv(self.l[n])
+            self.r[n] = conv(self.r[n])
+            self.K[n] = sp.zeros_like(self.K[n], dtype=typ)
+            if n < self.N + 1:
+                self.C[n] = sp.empty_like(self.C[n], dtype=typ)
+        self.r[self.N + 1] = self.r[self.N]
+        
+        self.u_gnd_l.A = self.A[0]
+        self.u_gnd_l.l = self.l[0]
+        self.u_gnd_r.A = self.A[self.N + 1]
+        self.u_gnd_r.r = self.r[self.N]
+        
+        self.eta = sp.zeros((self.N + 1), dtype=self.typ)
+        self.Vsh = sp.empty((self.N + 3), dtype=sp.ndarray)
+        
+        if not self.h_nn_mat is None:
+            self.gen_h_matrix()
 
     def calc_C(self, n_low=-1, n_high=-1):
         """Generates the C matrices used to calculate the K's and ultimately the B's
@@ -351,7 +434,8 @@ class EvoMPS_TDVP_Sandwich:
         C[n] depends on A[n] and A[n + 1].
         
         This calculation can be significantly faster if a matrix form for h_nn
-        is available. See gen_h_matrix().
+        is available. See gen_h_matrix(), which also generates an 
+        operator-sum form (see twosite.op_sum()) that is used if available.
 
         """
         if self.h_nn is None:
@@ -361,8 +445,19 @@ class EvoMPS_TDVP_Sandwich:
             n_low = 0
         if n_high < 1:
             n_high = self.N + 1
+            
+        for n in xrange(n_low, min(n_high, 2)): #FIXME: Temp. hack
+            if n == 0:
+                self.AA0 = self._calc_AA(n)
+            else:
+                self.AA1 = self._calc_AA(n)
         
-        if self.h_nn_mat is None:
+        if not self._get_h_nn_opsum(n_low) is None:
+            for n in xrange(n_low, n_high):
+                O, P = self._get_h_nn_opsum(n)
+                self.C[n][:] = ts.calc_C(ts.apply_1s(O, self.A[n]), 
+                                         ts.apply_1s(P, self.A[n + 1]))
+        elif self.h_nn_mat is None:
             for n in xrange(n_low, n_high):
                 self.C[n].fill(0)
                 for u in xrange(self.q[n]):
@@ -374,20 +469,13 @@ class EvoMPS_TDVP_Sandwich:
                                 if h_nn_stuv != 0:
                                     self.C[n][s, t] += h_nn_stuv * AA
         else:
-            dot = sp.dot
             for n in xrange(n_low, n_high):
-                An = self.A[n]
-                Anp1 = self.A[n + 1]
-                
-                AA = sp.empty_like(self.C[n])
-                for u in xrange(self.q[n]):
-                    for v in xrange(self.q[n + 1]):
-                        AA[u, v] = dot(An[u], Anp1[v])
-                        
-                if n == 0: #FIXME: Temp. hack
-                    self.AA0 = AA
+                if n == 0:
+                    AA = self.AA0
                 elif n == 1:
-                    self.AA1 = AA
+                    AA = self.AA1
+                else:
+                    AA = self._calc_AA(n)
                 
                 res = sp.tensordot(AA, self.h_nn_mat[n], ((0, 1), (2, 3)))
                 res = sp.rollaxis(res, 3)
@@ -395,6 +483,18 @@ class EvoMPS_TDVP_Sandwich:
                 
                 self.C[n][:] = res
 
+    def _calc_AA(self, n):
+        """Returns AA[u, v] = A[n][u].dot(A[n + 1][v])."""
+        An = self.A[n]
+        Anp1 = self.A[n + 1]
+        
+        AA = sp.empty_like(self.C[n])
+        for u in xrange(self.q[n]):
+            for v in xrange(self.q[n + 1]):
+                AA[u, v] = sp.dot(An[u], Anp1[v])
+                
+        return AA
+
     def calc_K(self):
         """Generates the right K matrices used to calculate the B's
 
@@ -412,8 +512,6 @@ class EvoMPS_TDVP_Sandwich:
         n_low = 0
         n_high = self.N + 1
             
-        H = mm.H
-        
         self.h_expect = sp.zeros((self.N + 1), dtype=self.typ)
         
         self.u_gnd_r.calc_AA()
@@ -434,11 +532,10 @@ class EvoMPS_TDVP_Sandwich:
             Hr = sp.zeros_like(K)
 
             for s in xrange(self.q[n]):
-                Ash = H(A[s])
                 for t in xrange(self.q[n+1]):
-                    Hr += C[s, t].dot(rp1.dot(H(Ap1[t]).dot(Ash)))
+                    Hr += C[s, t].dot(mm.dot_nh(rp1, A[s].dot(Ap1[t])))
 
-                K += A[s].dot(Kp1.dot(Ash))
+                K += mm.dot_nnh(A[s], Kp1, A[s])
                 
             self.h_expect[n] = mm.adot(self.get_l(n), Hr)
                 
@@ -453,7 +550,7 @@ class EvoMPS_TDVP_Sandwich:
              
         return h
 
-    def calc_Vsh(self, n, sqrt_r):
+    def calc_Vsh(self, n, sqrt_r, implicit=False):
         """Generates mm.H(V[n][s]) for a given n, used for generating B[n][s]
 
         This is described on p. 14 of arXiv:1103.0936v2 [cond-mat.str-el] for left
@@ -464,14 +561,38 @@ class EvoMPS_TDVP_Sandwich:
         Each V[n] directly depends only on A[n] and r[n].
 
         We return the conjugate mm.H(V) because we use it in more places than V.
+
+        The basis is computed using nullspace.get_nullspace() with the method
+        ns_method, or using nullspace.nullspace_qr() if ns_method is None. The
+        rank-revealing methods 'qrp' and 'rand' use the previous basis
+        Vsh[n] as a starting guess.
+
+        If implicit is True, a nullspace.nullspace_projector is returned instead,
+        which applies V V^dagger to parameter matrices x of shape
+        (D[n - 1], q[n] * D[n]), with block s given by x[:, s * D[n]:(s + 1) * D[n]].
         """
+        if implicit:
+            R = sp.empty((self.q[n], self.D[n], self.D[n - 1]), dtype=self.typ)
+            for s in xrange(self.q[n]):
+                R[s] = mm.mmul(sqrt_r, mm.H(self.A[n][s]))
+
+            return ns.nullspace_projector(R.reshape((self.q[n] * self.D[n], self.D[n - 1])))
+
         R = sp.zeros((self.D[n], self.q[n], self.D[n-1]), dtype=self.typ, order='C')
 
         for s in xrange(self.q[n]):
             R[:,s,:] = mm.mmul(sqrt_r, mm.H(self.A[n][s]))
 
         R = R.reshape((self.q[n] * self.D[n], self.D[n-1]))
-        Vconj = ns.nullspace_qr(mm.H(R)).T
+        if self.ns_method is None:
+            Vconj = ns.nullspace_qr(mm.H(R)).T
+        else:
+            V0 = None
+            if not self.Vsh[n] is None:
+                V0 = self.Vsh[n].transpose((1, 0, 2)).reshape((self.q[n] * self.D[n], -1))
+            Vconj = ns.get_nullspace(mm.H(R), method=self.ns_method, V0=V0,
+                                     rtol=self.eps * self.q[n] * self.D[n],
+                                     rank=self.D[n - 1]).T
 
         if self.sanity_checks:
             if not sp.allclose(mm.mmul(Vconj.conj(), R), 0):
@@ -479,13 +600,15 @@ class EvoMPS_TDVP_Sandwich:
             if not sp.allclose(mm.mmul(Vconj, mm.H(Vconj)), sp.eye(Vconj.shape[0])):
                 print "Sanity Fail in calc_Vsh!: V H(V)_%u != eye" % (n)
             
-        Vconj = Vconj.reshape((self.q[n] * self.D[n] - self.D[n - 1], self.D[n], self.q[n]))
+        Vconj = Vconj.reshape((-1, self.D[n], self.q[n]))
 
         Vsh = Vconj.T
         Vsh = sp.asarray(Vsh, order='C')
+        
+        self.Vsh[n] = Vsh
 
         if self.sanity_checks:
-            M = sp.zeros((self.q[n] * self.D[n] - self.D[n - 1], self.D[n]), dtype=self.typ)
+            M = sp.zeros((Vsh.shape[2], self.D[n]), dtype=self.typ)
             for s in xrange(self.q[n]):
                 M += mm.mmul(mm.H(Vsh[s]), sqrt_r, mm.H(self.A[n][s]))
             if not sp.allclose(M, 0):
@@ -509,7 +632,13 @@ class EvoMPS_TDVP_Sandwich:
             - K[n + 1]
             - V[n]
         """
-        x = sp.zeros((self.D[n - 1], self.q[n] * self.D[n] - self.D[n - 1]), dtype=self.typ, order=self.odr)
+        implicit = isinstance(Vsh, ns.nullspace_projector)
+        Dn = self.D[n]
+
+        if implicit:
+            x = sp.zeros((self.D[n - 1], self.q[n] * Dn), dtype=self.typ, order=self.odr)
+        else:
+            x = sp.zeros((self.D[n - 1], Vsh.shape[2]), dtype=self.typ, order=self.odr)
         x_part = sp.empty_like(x)
         x_subpart = sp.empty_like(self.A[n][0])
         x_subsubpart = sp.empty_like(self.A[n][0])
@@ -521,8 +650,6 @@ class EvoMPS_TDVP_Sandwich:
         Ap1 = self.A[n + 1]
         Am1 = self.A[n - 1]
         Kp1 = self.K[n + 1]
-        
-        H = mm.H
 
         x_part.fill(0)
         for s in xrange(self.q[n]):
@@ -531,16 +658,16 @@ class EvoMPS_TDVP_Sandwich:
             if n < self.N + 1:
                 x_subsubpart.fill(0)
                 for t in xrange(self.q[n + 1]):
-                    x_subsubpart += C[s,t].dot(rp1.dot(H(Ap1[t]))) #~1st line
+                    x_subsubpart += C[s,t].dot(mm.dot_nh(rp1, Ap1[t])) #~1st line
 
                 x_subsubpart += A[s].dot(Kp1) #~3rd line
 
-                try:
-                    x_subpart += sqrt_r_inv.dot_left(x_subsubpart)
-                except AttributeError:
-                    x_subpart += x_subsubpart.dot(sqrt_r_inv)
+                x_subpart += mm.mmul(x_subsubpart, sqrt_r_inv)
 
-            x_part += x_subpart.dot(Vsh[s])
+            if implicit:
+                x_part[:, s * Dn:(s + 1) * Dn] = x_subpart
+            else:
+                x_part += x_subpart.dot(Vsh[s])
 
         x += sqrt_l.dot(x_part)
 
@@ -550,10 +677,16 @@ class EvoMPS_TDVP_Sandwich:
             for s in xrange(self.q[n]):     #~2nd line
                 x_subsubpart.fill(0)
                 for t in xrange(self.q[n + 1]):
-                    x_subsubpart += H(Am1[t]).dot(l_nm2.dot(Cm1[t, s]))
-                x_part += x_subsubpart.dot(sqrt_r.dot(Vsh[s]))
+                    x_subsubpart += mm.dot_hn(Am1[t], l_nm2.dot(Cm1[t, s]))
+                if implicit:
+                    x_part[:, s * Dn:(s + 1) * Dn] = x_subsubpart.dot(sqrt_r)
+                else:
+                    x_part += x_subsubpart.dot(sqrt_r.dot(Vsh[s]))
             x += sqrt_l_inv.dot(x_part)
 
+        if implicit:
+            x = Vsh.dot_left(x)
+
         return x
         
     def calc_B1(self):
@@ -567,14 +700,14 @@ class EvoMPS_TDVP_Sandwich:
         """
         B1 = sp.empty_like(self.A[1])
         
-        try:
+        if isinstance(self.r[1], (mm.eyemat, mm.simple_diag_matrix)):
             r1_i = self.r[1].inv()
-        except AttributeError:
+        else:
             r1_i = mm.invmh(self.r[1])
             
-        try:
+        if isinstance(self.l[0], (mm.eyemat, mm.simple_diag_matrix)):
             l0_i = self.l[0].inv()
-        except AttributeError:
+        else:
             l0_i = mm.invmh(self.l[0])
         
         A0 = self.A[0]
@@ -591,27 +724,21 @@ class EvoMPS_TDVP_Sandwich:
         C0 = self.C[0] - self.h_expect[0] * self.AA0
         
         for s in xrange(self.q[1]):
-            try:
-                B1[s] = A1[s].dot(r1_i.dot_left(K2))
-            except AttributeError:
-                B1[s] = A1[s].dot(K2.dot(r1_i))
+            B1[s] = A1[s].dot(mm.mmul(K2, r1_i))
             
             for t in xrange(self.q[2]):
-                try:
-                    B1[s] += C1[s, t].dot(r2.dot(r1_i.dot_left(mm.H(A2[t]))))
-                except AttributeError:
-                    B1[s] += C1[s, t].dot(r2.dot(mm.H(A2[t]).dot(r1_i)))                    
+                B1[s] += C1[s, t].dot(mm.mmul(r2, mm.dot_hn(A2[t], r1_i)))
                 
             B1sbit = KLh.dot(A1[s])
                             
             for t in xrange(self.q[0]):
-                B1sbit += mm.H(A0[t]).dot(l0.dot(C0[t,s]))
+                B1sbit += mm.dot_hn(A0[t], l0.dot(C0[t,s]))
                 
             B1[s] += l0_i.dot(B1sbit)
            
         rb = sp.zeros_like(self.r[0])
         for s in xrange(self.q[1]):
-            rb += B1[s].dot(r1.dot(mm.H(B1[s])))
+            rb += mm.dot_nnh(B1[s], r1, B1[s])
         eta = sp.sqrt(mm.adot(l0, rb))
                 
         return B1, eta
@@ -634,7 +761,7 @@ class EvoMPS_TDVP_Sandwich:
             else:
                 l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv = self.calc_l_r_roots(n)
     
-                Vsh = self.calc_Vsh(n, r_sqrt)
+                Vsh = self.calc_Vsh(n, r_sqrt, implicit=self.implicit_V)
     
                 x = self.calc_opt_x(n, Vsh, l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv)
                 
@@ -642,8 +769,13 @@ class EvoMPS_TDVP_Sandwich:
                     self.eta[n] = sp.sqrt(mm.adot(x, x))
     
                 B = sp.empty_like(self.A[n])
-                for s in xrange(self.q[n]):
-                    B[s] = mm.mmul(l_sqrt_inv, x, mm.H(Vsh[s]), r_sqrt_inv)
+                if self.implicit_V:
+                    Dn = self.D[n]
+                    for s in xrange(self.q[n]):
+                        B[s] = mm.mmul(l_sqrt_inv, x[:, s * Dn:(s + 1) * Dn], r_sqrt_inv)
+                else:
+                    for s in xrange(self.q[n]):
+                        B[s] = mm.mmul(l_sqrt_inv, mm.dot_nh(x, Vsh[s]), r_sqrt_inv)
 
             if self.sanity_checks:
                 M = sp.zeros_like(self.r[n - 1])
@@ -667,24 +799,18 @@ class EvoMPS_TDVP_Sandwich:
         If l[n] or r[n] are diagonal or the identity, further optimizations are
         used.
         """
-        try:
+        if isinstance(self.l[n - 1], (mm.eyemat, mm.simple_diag_matrix)):
             l_sqrt = self.l[n - 1].sqrt()
-        except AttributeError:
-            l_sqrt, evd = mm.sqrtmh(self.l[n - 1], ret_evd=True)
-
-        try:
             l_sqrt_inv = l_sqrt.inv()
-        except AttributeError:
+        else:
+            l_sqrt, evd = mm.sqrtmh(self.l[n - 1], ret_evd=True)
             l_sqrt_inv = mm.invmh(l_sqrt, evd=evd)
 
-        try:
+        if isinstance(self.r[n], (mm.eyemat, mm.simple_diag_matrix)):
             r_sqrt = self.r[n].sqrt()
-        except AttributeError:
-            r_sqrt, evd =  mm.sqrtmh(self.r[n], ret_evd=True)
-
-        try:
             r_sqrt_inv = r_sqrt.inv()
-        except AttributeError:
+        else:
+            r_sqrt, evd =  mm.sqrtmh(self.r[n], ret_evd=True)
             r_sqrt_inv = mm.invmh(r_sqrt, evd=evd)
 
         if self.sanity_checks:
@@ -716,6 +842,10 @@ class EvoMPS_TDVP_Sandwich:
 
         return h
 
+    def _check_dtau(self, dtau):
+        if sp.imag(dtau) != 0 and not sp.iscomplexobj(self.A[1]):
+            raise ValueError("A complex dtau requires a complex typ. See set_typ().")
+
     def take_step(self, dtau): #simple, forward Euler integration
         """Performs a complete forward-Euler step of imaginary time dtau.
 
@@ -734,6 +864,7 @@ class EvoMPS_TDVP_Sandwich:
         dtau : complex
             The (imaginary or real) amount of imaginary time (tau) to step.
         """
+        self._check_dtau(dtau)
 
         eta_tot = 0
 
@@ -759,6 +890,7 @@ class EvoMPS_TDVP_Sandwich:
         more than a backward Euler step. It is, however, far more accurate
         and stable than forward Euler.
         """
+        self._check_dtau(dtau)
         
         def upd():
             self.calc_l()
@@ -857,7 +989,7 @@ class EvoMPS_TDVP_Sandwich:
             self.l[n].fill(0)
 
             for s in xrange(self.q[n]):
-                self.l[n] += mm.mmul(mm.H(self.A[n][s]), self.l[n - 1], self.A[n][s])
+                self.l[n] += mm.dot_hnn(self.A[n][s], self.l[n - 1], self.A[n][s])
 
     def calc_r(self, n_low=-1, n_high=-1):
         """Updates the r matrices using the current state.
@@ -896,19 +1028,20 @@ class EvoMPS_TDVP_Sandwich:
         elif n < 0:
             n = 0
 
-        res = sp.zeros((self.D[n - 1], self.D[n - 1]), dtype=self.typ)
+        res = sp.zeros((self.D[n - 1], self.D[n - 1]), 
+                       dtype=sp.result_type(self.typ, x.dtype))
 
         if o is None:
             for s in xrange(self.q[n]):
-                res += mm.mmul(self.A[n][s], x, mm.H(self.A[n][s]))
+                res += mm.dot_nnh(self.A[n][s], x, self.A[n][s])
         else:
+            #o may be complex even if the state is real
             A = self.A[n]
             for s in xrange(self.q[n]):
-                Ash = mm.H(A[s])
                 for t in xrange(self.q[n]):
                     o_st = o(n, s, t)
                     if o_st != 0:
-                        res += o_st * A[t].dot(x.dot(Ash))
+                        res = res + o_st * mm.dot_nnh(A[t], x, A[s])
         return res
 
     def eps_r_2s(self, n, x, op, A1=None, A2=None, A3=None, A4=None):
@@ -930,25 +1063,13 @@ class EvoMPS_TDVP_Sandwich:
         if A4 is None:
             A4 = self.A[m]
 
-        res = sp.zeros((A1.shape[1], A1.shape[1]), dtype=self.typ)
-        subres = sp.zeros_like(A1[0])
-        
-        H = mm.H
-
-        for u in xrange(self.q[n]):
-            A3u = A3[u]
-            for v in xrange(self.q[m]):
-                AAuvH = H(A3u.dot(A4[v]))
-                subres.fill(0)
-                for s in xrange(self.q[n]):
-                    A1s = A1[s]
-                    for t in xrange(self.q[m]):
-                        opval = op(n, u, v, s, t)
-                        if opval != 0:
-                            subres += opval * A1s.dot(A2[t])
-                res += subres.dot(x.dot(AAuvH))
+        if op is self.h_nn and not self._get_h_nn_opsum(n) is None:
+            O, P = self._get_h_nn_opsum(n)
+        else:
+            O, P = ts.op_sum(ts.tabulate(lambda u, v, s, t: op(n, u, v, s, t), 
+                                         self.q[n], self.q[m], dtype=self.typ))
 
-        return res
+        return ts.eps_r_2s(x, ts.apply_1s(O, A1), ts.apply_1s(P, A2), A3, A4)
 
     def eps_l(self, n, x):
         """Implements the left epsilon map
@@ -975,7 +1096,7 @@ class EvoMPS_TDVP_Sandwich:
         res = sp.zeros_like(self.l[n])
 
         for s in xrange(self.q[n]):
-            res += mm.mmul(mm.H(self.A[n][s]), x, self.A[n][s])
+            res += mm.dot_hnn(self.A[n][s], x, self.A[n][s])
         return res
 
     def restore_ONR_n(self, n, G_n_i):
@@ -1010,7 +1131,7 @@ class EvoMPS_TDVP_Sandwich:
         if G_n_i is None:
             GGh_n_i = self.r[n]
         else:
-            GGh_n_i = mm.mmul(G_n_i, self.r[n], mm.H(G_n_i))
+            GGh_n_i = mm.dot_nnh(G_n_i, self.r[n], G_n_i)
 
         M = self.eps_r(n, GGh_n_i)
 
@@ -1090,8 +1211,8 @@ class EvoMPS_TDVP_Sandwich:
         for s in xrange(self.q[0]): #Note: This does not change the scale of A[0]
             self.A[0][s] = mm.mmul(G_n, self.A[0][s], G_n_i)
 
-        self.u_gnd_l.r = mm.mmul(G_n, self.u_gnd_l.r, mm.H(G_n))
-        self.l[0] = mm.mmul(mm.H(G_n_i), self.l[0], G_n_i)
+        self.u_gnd_l.r = mm.dot_nnh(G_n, self.u_gnd_l.r, G_n)
+        self.l[0] = mm.dot_hnn(G_n_i, self.l[0], G_n_i)
 
     def restore_RCF_l(self):
         G_nm1 = None
@@ -1100,7 +1221,7 @@ class EvoMPS_TDVP_Sandwich:
             if n == 0:
                 x = l_nm1
             else:
-                x = mm.mmul(mm.H(G_nm1), l_nm1, G_nm1)
+                x = mm.dot_hnn(G_nm1, l_nm1, G_nm1)
             M = self.eps_l(n, x)
             ev, EV = la.eigh(M)
 
@@ -1137,7 +1258,7 @@ class EvoMPS_TDVP_Sandwich:
         ##This should not be necessary if G_N is really unitary
         #self.r[self.N] = mm.mmul(G_nm1, self.r[self.N], mm.H(G_nm1))
         #self.r[self.N + 1] = self.r[self.N]
-        self.u_gnd_r.l[:] = mm.mmul(mm.H(G_nm1_i), self.u_gnd_r.l, G_nm1_i)
+        self.u_gnd_r.l[:] = mm.dot_hnn(G_nm1_i, self.u_gnd_r.l, G_nm1_i)
         
         self.S_hc = sp.zeros((self.N), dtype=sp.complex128)
         for n in xrange(1, self.N + 1):
@@ -1423,7 +1544,7 @@ class EvoMPS_TDVP_Sandwich:
 
         for s2 in xrange(self.q[n2]):
             for t2 in xrange(self.q[n2]):
-                r_n2 = mm.mmul(self.A[n2][t2], self.r[n2], mm.H(self.A[n2][s2]))
+                r_n2 = mm.dot_nnh(self.A[n2][t2], self.r[n2], self.A[n2][s2])
 
                 r_n = r_n2
                 for n in reversed(xrange(n1 + 1, n2)):
@@ -1431,7 +1552,7 @@ class EvoMPS_TDVP_Sandwich:
 
                 for s1 in xrange(self.q[n1]):
                     for t1 in xrange(self.q[n1]):
-                        r_n1 = mm.mmul(self.A[n1][t1], r_n, mm.H(self.A[n1][s1]))
+                        r_n1 = mm.dot_nnh(self.A[n1][t1], r_n, self.A[n1][s1])
                         tmp = mm.mmul(self.l[n1 - 1], r_n1)
                         rho[s1 * self.q[n1] + s2, t1 * self.q[n1] + t2] = tmp.trace()
         return rho
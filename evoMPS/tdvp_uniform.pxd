@@ -26,6 +26,8 @@ cdef class EvoMPS_TDVP_Uniform:
     cdef public object h_nn
     cdef public object h_nn_mat
     cdef public object h_nn_cptr
+    cdef public object h_nn_coo
+    cdef public object h_nn_opsum
     
     cdef public bint symm_gauge
     
@@ -54,8 +56,10 @@ cdef class EvoMPS_TDVP_Uniform:
     cpdef _calc_lr(self, x, tmp, bint calc_l=*, A1=*, A2=*, bint rescale=*,
                    int max_itr=*, float rtol=*, float atol=*)
                    
-    @cython.locals(s = cython.int)
+    @cython.locals(q = cython.int, D1 = cython.int, Dm1 = cython.int, 
+                   D2 = cython.int, Dm2 = cython.int)
     cpdef _eps_r_noop_dense(self, x, A1, A2, out)
     
-    @cython.locals(s = cython.int)
+    @cython.locals(q = cython.int, D1 = cython.int, Dm1 = cython.int, 
+                   D2 = cython.int, Dm2 = cython.int)
     cpdef _eps_l_noop_dense(self, x, A1, A2, out)
\ No newline at end of file
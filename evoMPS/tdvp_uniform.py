@@ -12,7 +12,12 @@ import scipy.sparse.linalg as las
 import scipy.optimize as opti
 import nullspace as ns
 import matmul as m
+import twosite as ts
+import rk
 import math as ma
+import multiprocessing as mp
+import Queue
+import traceback
 
 import time
 
@@ -43,8 +48,12 @@ class EOp:
             self.eps = tdvp._eps_l_noop_dense
         else:
             self.eps = tdvp._eps_r_noop_dense
+            
+        self.calls = 0
     
     def matvec(self, v):
+        self.calls += 1
+        
         x = v.reshape((self.D, self.D))
 
         Ex = self.eps(x, self.A1, self.A2, self.out)
@@ -67,32 +76,111 @@ class PPInvOp:
         
         self.shape = (self.D**2, self.D**2)
         
-        self.dtype = np.dtype(tdvp.typ)
+        if p == 0: #keep things real for a real state
+            self.dtype = np.dtype(tdvp.typ)
+            self.eip = 1
+        else:
+            self.dtype = np.result_type(tdvp.typ, np.complex64)
+            self.eip = sp.exp(1.j * p)
         
         self.out = np.empty_like(self.l)
+        
+        self.diag = None
     
-    def matvec(self, v):
-        x = v.reshape((self.D, self.D))
+    def apply(self, x):
+        """Applies the operator to x in matrix form.
+        """
+        if x.dtype != self.out.dtype: #e.g. a complex x for a real state
+            self.out = np.empty(x.shape, dtype=np.result_type(x, self.out))
         
         if self.left: #Multiplying from the left, but x is a col. vector, so use mat_dagger
             Ehx = self.tdvp._eps_l_noop_dense(x, self.A1, self.A2, self.out)
             if self.pseudo:
                 QEQhx = Ehx - self.l * m.adot(self.r, x)
-                res = x - sp.exp(-1.j * self.p) * QEQhx
+                res = x - np.conj(self.eip) * QEQhx
             else:
-                res = x - sp.exp(-1.j * self.p) * Ehx
+                res = x - np.conj(self.eip) * Ehx
         else:
             Ex = self.tdvp._eps_r_noop_dense(x, self.A1, self.A2, self.out)
             if self.pseudo:
                 QEQx = Ex - self.r * m.adot(self.l, x)
-                res = x - sp.exp(1.j * self.p) * QEQx
+                res = x - self.eip * QEQx
             else:
-                res = x - sp.exp(1.j * self.p) * Ex
+                res = x - self.eip * Ex
         
-        return res.ravel()
+        return res
+    
+    def apply_stack(self, X):
+        """Applies the operator to each matrix X[i] of a stack.
+        
+        The transfer operator is applied to the whole stack at once, using
+        matrix-matrix multiplications.
+        """
+        if self.left:
+            Y = np.tensordot(self.A1.conj(), X, ((1,), (1,)))
+            EX = np.tensordot(Y, self.A2, ((0, 3), (0, 1))).transpose((1, 0, 2))
+            if self.pseudo:
+                c = np.tensordot(X, np.conj(self.r), ((1, 2), (0, 1)))
+                EX -= c[:, None, None] * np.asarray(self.l)
+            return X - np.conj(self.eip) * EX
+        else:
+            Y = np.tensordot(self.A1, X, ((2,), (1,)))
+            EX = np.tensordot(Y, self.A2.conj(), ((0, 3), (0, 2))).transpose((1, 0, 2))
+            if self.pseudo:
+                c = np.tensordot(X, np.conj(self.l), ((1, 2), (0, 1)))
+                EX -= c[:, None, None] * np.asarray(self.r)
+            return X - self.eip * EX
+    
+    def matvec(self, v):
+        x = v.reshape((self.D, self.D))
+        
+        return self.apply(x).ravel()
+        
+    def calc_diag(self):
+        """Computes the diagonal of the operator in the product basis.
+        
+        The diagonal of E is sum_s A1[s]_ii A2[s]_jj* (or its conjugate for
+        the left action). If pseudo is set, the diagonal of the projector 
+        part is obtained from the elements of l and r, which are diagonal 
+        in the canonical forms.
+        """
+        dA1 = np.diagonal(self.A1, axis1=1, axis2=2)
+        dA2 = np.diagonal(self.A2, axis1=1, axis2=2)
+        l = np.asarray(self.l)
+        r = np.asarray(self.r)
+        
+        if self.left:
+            dE = dA1.conj().T.dot(dA2)
+            if self.pseudo:
+                dE = dE - l * r.conj()
+            diag = 1 - np.conj(self.eip) * dE
+        else:
+            dE = dA1.T.dot(dA2.conj())
+            if self.pseudo:
+                dE = dE - r * l.conj()
+            diag = 1 - self.eip * dE
+            
+        diag[abs(diag) < 1E-2] = 1
         
-class Excite_H_Op:
-    def __init__(self, tdvp, donor, p):
+        self.diag = diag
+        
+        return diag
+        
+    def precond(self, x):
+        """The diagonal (Jacobi) preconditioner, in matrix form.
+        """
+        if self.diag is None:
+            self.calc_diag()
+        
+        return x / self.diag
+        
+class Excite_H_Op(las.LinearOperator):
+    """The effective Hamiltonian for excitations with momentum p.
+    
+    Single vectors are handled by calc_BHB(), blocks of vectors by
+    calc_BHB_block().
+    """
+    def __init__(self, tdvp, donor, p, prereq=None, block_prereq=None):
         self.donor = donor
         self.tdvp = tdvp
         self.p = p
@@ -101,46 +189,298 @@ class Excite_H_Op:
         self.q = tdvp.q
         
         d = (self.q - 1) * self.D**2
-        self.shape = (d, d)
         
-        self.dtype = np.dtype(tdvp.typ)
+        #The effective Hamiltonian is complex, even for a real state
+        las.LinearOperator.__init__(self, np.result_type(tdvp.typ, np.complex64),
+                                    (d, d))
+        
+        if prereq is None:
+            prereq = tdvp.calc_BHB_prereq(donor)
+        self.prereq = prereq
         
-        self.prereq = (tdvp.calc_BHB_prereq(donor))
+        if block_prereq is None:
+            block_prereq = tdvp.calc_BHB_block_prereq(donor, prereq)
+        self.block_prereq = block_prereq
+        
+        self.prec_L = None
+        self.prec_R = None
+        self.prec_eps = 1E-2
         
         self.calls = 0
     
-    def matvec(self, v):
+    def _matvec(self, v):
         x = v.reshape((self.D, (self.q - 1)*self.D))
         
         self.calls += 1
-        print "Calls: %u" % self.calls
         
-        res = self.tdvp.calc_BHB(x, self.p, self.donor, *self.prereq)
+        res = self.tdvp.calc_BHB(x, self.p, self.donor, *self.prereq,
+                                 block_prereq=self.block_prereq)
         
         return res.ravel()
+        
+    def _matmat(self, V):
+        k = V.shape[1]
+        X = V.T.reshape((k, self.D, (self.q - 1)*self.D))
+        
+        self.calls += k
+        
+        res = self.tdvp.calc_BHB_block(X, self.p, self.donor, self.prereq,
+                                       self.block_prereq)
+        
+        return res.reshape((k, self.shape[0])).T
+        
+    def _adjoint(self):
+        return self
+        
+    def calc_precond(self):
+        """Computes the model used by precond().
+        
+        The model keeps the local terms #5, #6 and #1 of calc_BHB(), which
+        act on x as x -> L x + x R with L = l^-1/2 K_l^H l^-1/2 and R formed 
+        from K_r, the nullspace and the Hamiltonian term (see 
+        calc_BHB_block_prereq()), assuming r = 1 for the donor. L and R are
+        diagonalized, so that the model is diagonal in the product basis.
+        """
+        Vri_ = self.prereq[6]
+        F15 = self.block_prereq[3]
+        LK6 = self.block_prereq[8]
+        
+        L = m.H(_lmul_stack(self.tdvp.l_sqrt_i, m.H(LK6)))
+        R = np.tensordot(Vri_, F15, ((0, 2), (0, 1)))
+        
+        self.prec_L = la.eigh(0.5 * (L + m.H(L)))
+        self.prec_R = la.eigh(0.5 * (R + m.H(R)))
+        
+    def precond(self, V, theta):
+        """Applies the inverse of the model (see calc_precond()), shifted by
+        -theta[j], to each column j of V.
+        """
+        if self.prec_L is None:
+            self.calc_precond()
+        
+        a, U = self.prec_L
+        b, W = self.prec_R
+        
+        k = V.shape[1]
+        X = V.T.reshape((k, self.D, (self.q - 1)*self.D))
+        
+        Y = _lmul_stack(m.H(U), X).dot(W)
+        den = a[None, :, None] + b[None, None, :] - np.asarray(theta)[:, None, None]
+        small = abs(den) < self.prec_eps
+        den[small] = np.where(den[small] < 0, -self.prec_eps, self.prec_eps)
+        Y /= den
+        Y = _lmul_stack(U, Y).dot(m.H(W))
+        
+        return Y.reshape((k, self.shape[0])).T
+        
+    def precond_guess(self, k):
+        """Returns the k eigenvectors of the model with the lowest 
+        eigenvalues (see calc_precond()), as columns.
+        """
+        if self.prec_L is None:
+            self.calc_precond()
+            
+        a, U = self.prec_L
+        b, W = self.prec_R
+        
+        ab = (a[:, None] + b[None, :]).ravel()
+        V = np.empty((self.shape[0], k), dtype=self.dtype)
+        for j, ind in enumerate(np.argsort(ab)[:k]):
+            i1, i2 = divmod(ind, len(b))
+            V[:, j] = np.outer(U[:, i1], W[:, i2].conj()).ravel()
+            
+        return V
+        
+    def calc_dense(self, j0=0, j1=None, block=32):
+        """Computes the columns j0 to j1 of the dense matrix.
+        
+        The columns are obtained by applying the operator to blocks of up to
+        block unit vectors via matmat().
+        """
+        d = self.shape[0]
+        if j1 is None:
+            j1 = d
+        
+        H = np.empty((d, j1 - j0), dtype=self.dtype)
+        for i in xrange(j0, j1, block):
+            k = min(block, j1 - i)
+            E = np.zeros((d, k), dtype=self.dtype)
+            E[i + np.arange(k), np.arange(k)] = 1
+            H[:, i - j0:i - j0 + k] = self.matmat(E)
+            
+        return H
+        
+class Excite_Context:
+    """The momentum-independent data needed for excitation spectra.
+    
+    This computes K_left and the roots of l and r for tdvp, the nullspace 
+    Vsh of donor and the prerequisites of calc_BHB() once, so that 
+    Excite_H_Op can then be constructed for any number of momenta.
+    
+    The context is only valid as long as the states and the Hamiltonian
+    are not modified (see is_valid()).
+    """
+    def __init__(self, tdvp, donor):
+        self.tdvp = tdvp
+        self.donor = donor
+        
+        tdvp.calc_K_l()
+        tdvp.calc_l_r_roots()
+        if not donor is tdvp:
+            donor.calc_l_r_roots()
+        donor.Vsh = donor.calc_Vsh(donor.r_sqrt)
+        
+        self.prereq = tdvp.calc_BHB_prereq(donor)
+        self.block_prereq = tdvp.calc_BHB_block_prereq(donor, self.prereq)
+        
+        self.Vsh = donor.Vsh
+        self.A = tdvp.A.copy()
+        self.A_ = donor.A.copy()
+        self.h_nn_mat = np.array(tdvp.h_nn_mat)
+        
+    def is_valid(self):
+        """Checks whether the states and Hamiltonian are unchanged.
+        
+        The nullspace donor.Vsh must also not have been replaced (e.g. by 
+        calc_B()), since calc_BHB() uses it directly.
+        """
+        return (self.donor.Vsh is self.Vsh
+                and np.array_equal(self.A, self.tdvp.A)
+                and np.array_equal(self.A_, self.donor.A)
+                and np.array_equal(self.h_nn_mat, self.tdvp.h_nn_mat))
+        
+    def get_op(self, p):
+        """Returns the effective Hamiltonian for momentum p.
+        """
+        return Excite_H_Op(self.tdvp, self.donor, p, prereq=self.prereq,
+                           block_prereq=self.block_prereq)
+
+def _lmul_stack(G, Y):
+    """Multiplies each matrix Y[..., :, :] from the left by G.
+    
+    G may be an eyemat or simple_diag_matrix. Otherwise, all products are
+    done using a single matrix multiplication.
+    """
+    if isinstance(G, m.eyemat):
+        return Y
+    elif isinstance(G, m.simple_diag_matrix):
+        return Y * G.diag[:, None]
+    
+    return np.moveaxis(np.tensordot(G, Y, ((1,), (Y.ndim - 2,))), 0, -2)
+    
+def _mid_stack(L, Z):
+    """Computes res[i] = sum_s L[s] Z[i, :, s, :] for a stack Z.
+    """
+    return np.tensordot(L, Z, ((0, 2), (2, 1))).transpose((1, 0, 2))
+
+def _excite_dense_worker(op, j0, j1, block, queue):
+    """Computes columns j0 to j1 of op in a worker process.
+    
+    The result, or an error, is reported via queue.
+    """
+    try:
+        queue.put(('res', j0, op.calc_dense(j0, j1, block=block)))
+    except Exception:
+        queue.put(('err', traceback.format_exc()))
+
+def _excite_dispersion_worker(tdvp, i, donor, ps, kwargs, queue):
+    """Runs tdvp._excite_dispersion_serial() in worker process i.
+    
+    Results, errors and completion are reported via queue.
+    """
+    try:
+        for p, res in tdvp._excite_dispersion_serial(donor, ps, **kwargs):
+            queue.put(('res', p, res))
+    except Exception:
+        queue.put(('err', traceback.format_exc()))
+    queue.put(('done', i))
+
+def _get_worker_msg(queue, workers, finished, poll=1.0):
+    """Gets the next message sent by the worker processes via queue.
+    
+    The queue is polled every poll seconds. If a worker whose index is not 
+    in finished has meanwhile exited with a nonzero exit code (for example, 
+    because it was killed), its result will never arrive and a RuntimeError
+    is raised instead of waiting forever.
+    """
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Queue.Empty:
+            for i, w in enumerate(workers):
+                if not i in finished and w.exitcode:
+                    raise RuntimeError("Worker process %d exited with code %d "
+                                       "before sending its result" 
+                                       % (i, w.exitcode))
 
 class EvoMPS_TDVP_Uniform:
     odr = 'C'    
         
     def __init__(self, D, q, typ=None):
-        
+        """Creates a new uniform MPS with bond dimension D and physical
+        dimension q.
+        
+        The data type typ of the state defaults to complex128. For a real
+        Hamiltonian (with real matrix elements h_nn), imaginary-time evolution
+        can be done with typ = float64, which is cheaper. See also set_typ().
+        
+        The single-precision types complex64 and float32 are also supported.
+        These are faster still, but the accuracy of the ground state is then
+        limited. If promote_eta is set, the state is automatically promoted
+        to double precision by take_step() once eta drops below promote_eta.
+        Unless PPinv_solver is set, calc_PPinv() uses 'gmres' for single-
+        precision states and 'bicgstab' otherwise. In single precision, 
+        imaginary-time evolution is more stable with symm_gauge = False.
+        
+        If implicit_V is set, calc_B() does not form an explicit basis for
+        the tangent-space parametrization (see calc_Vsh()). Otherwise, 
+        ns_method selects the nullspace routine used to compute it.
+        """
         if typ is None:
-            self.typ = np.complex128
-           
+            typ = np.complex128
+        self.typ = typ
+        
         try:
             self.gemm = la.get_blas_funcs('gemm', dtype=self.typ)
         except:
             self.gemm = None
         
-        self.itr_rtol = 1E-13
-        self.itr_atol = 1E-14
+        self.eps = np.finfo(self.typ).eps
+        
+        self._init_tols()
+        
+        self.promote_eta = None
+        
+        self.implicit_V = False
+        self.ns_method = None
         
         self.pow_itr_max = 2000
-        self.ev_use_arpack = False
+        self.ev_use_arpack = 'auto'
+        self.ev_auto_itr = 100
+        self.ev_degen_tol = 1E-3
+        self.ev_itr_fac = 3
+        self.ev_ratio = None
+        self.EOp_ev = None
+        self._EOp_ev_key = None
+        self._B_fsal = None
+        
+        self.PPinv_solver = None
+        self.PPinv_precond = True
+        self.PPinv_itr_max = 2000
+        self.PPinv_cache_max = 16
+        self.PPinv_dense_D = 24
+        self.PPinv_LU_cache_max = 4
+        self.itr_PPinv = 0
+        self.conv_PPinv = True
         
         self.h_nn = None    
         self.h_nn_cptr = None
         self.h_nn_mat = None
+        self.h_nn_coo = None
+        self.h_nn_opsum = None
+        self._h_forms_key = None
+        self._op_sum_cache = {}
+        self.op_sum_cache_max = 16
         
         self.symm_gauge = False
         
@@ -149,7 +489,8 @@ class EvoMPS_TDVP_Uniform:
         
         self.userdata = None        
         
-        self.eps = np.finfo(self.typ).eps
+        self._excite_ctx = None
+        self._excite_ctx_nontriv = None
         
         self.eta = 0
         
@@ -163,6 +504,58 @@ class EvoMPS_TDVP_Uniform:
 
     def randomize(self, fac=0.5):
         m.randomize_cmplx(self.A, a=-fac, b=fac)
+        
+    def _init_tols(self):
+        #Tolerances for iterative methods, limited by the precision of typ
+        self.itr_rtol = max(1E-13, self.eps * 10)
+        self.itr_atol = max(1E-14, self.eps)
+        
+    def set_typ(self, typ):
+        """Changes the data type of the state.
+        
+        This can be used, for example, to promote a ground state found using
+        imaginary-time evolution with typ = float64 to complex128 before 
+        doing real-time evolution. Converting a complex state to a real typ
+        discards any imaginary parts.
+        
+        The tolerances itr_rtol and itr_atol are reset to the defaults for
+        the new typ.
+        
+        The state must be updated using update() before further use.
+        """
+        A = self.A
+        l = np.asarray(self.l)
+        r = np.asarray(self.r)
+        
+        self.typ = typ
+        self.eps = np.finfo(self.typ).eps
+        self._init_tols()
+        self.ev_ratio = None
+        self.EOp_ev = None
+        self._EOp_ev_key = None
+        self._B_fsal = None
+        self._h_forms_key = None
+        self._op_sum_cache = {}
+        try:
+            self.gemm = la.get_blas_funcs('gemm', dtype=self.typ)
+        except:
+            self.gemm = None
+            
+        self._init_arrays(self.D, self.q)
+        
+        if np.iscomplexobj(self.A):
+            self.A[:] = A
+            self.l = l.astype(self.typ)
+            self.r = r.astype(self.typ)
+        else:
+            self.A[:] = A.real
+            self.l = np.ascontiguousarray(l.real, dtype=self.typ)
+            self.r = np.ascontiguousarray(r.real, dtype=self.typ)
+        self.l_before_CF = self.l
+        self.r_before_CF = self.r
+        
+        if not self.h_nn_mat is None and not self.h_nn is None:
+            self.gen_h_matrix()
     
     def _init_arrays(self, D, q):
         self.D = D
@@ -176,6 +569,12 @@ class EvoMPS_TDVP_Uniform:
         self.K = np.ones_like(self.A[0])
         self.K_left = None
         
+        self.Vsh = None
+        
+        self._PPinv_cache = {}
+        self._PPinv_LU = {}
+        self._eps_bufs = {}
+        
         self.l = np.ones_like(self.A[0])
         self.r = np.ones_like(self.A[0])
         self.l_before_CF = self.l
@@ -185,13 +584,43 @@ class EvoMPS_TDVP_Uniform:
         
         self.tmp = np.zeros_like(self.A[0])
            
+    def _eps_buf(self, slot, shape, dtype):
+        """Returns a preallocated work array for the epsilon maps.
+        
+        The arrays are kept between calls, so that the transposed copies
+        needed by _eps_r_noop_dense() and _eps_l_noop_dense() do not cause
+        allocations in the iterative solvers.
+        """
+        key = (slot, shape, np.dtype(dtype))
+        buf = self._eps_bufs.get(key)
+        if buf is None:
+            buf = np.empty(shape, dtype=dtype)
+            self._eps_bufs[key] = buf
+        return buf
+    
     def _eps_r_noop_dense(self, x, A1, A2, out):
         """The right epsilon map, optimized for efficiency.
+        
+        The products A1[s] x are computed using a single matrix 
+        multiplication on the stacked matrices A1[s]. These, and the A2[s],
+        are then transposed into the (D, q * D) layout, so that the sum over
+        s of A1[s] x A2[s]^H is a single gemm call that conjugates A2 on
+        the fly.
         """
-        out.fill(0)
-        dot = np.dot
-        for s in xrange(self.q):
-            out += dot(A1[s], dot(x, A2[s].conj().T))
+        q, D1, Dm1 = A1.shape
+        D2, Dm2 = A2.shape[1:]
+        typ = np.result_type(A1.dtype, x.dtype)
+        
+        A1x = self._eps_buf(0, (q, D1, Dm2), typ)
+        m.gemm(A1.reshape((q * D1, Dm1)), x, out=A1x.reshape((q * D1, Dm2)))
+        
+        A1xt = self._eps_buf(1, (D1, q, Dm2), typ)
+        A1xt[:] = A1x.transpose((1, 0, 2))
+        A2t = self._eps_buf(2, (D2, q, Dm2), A2.dtype)
+        A2t[:] = A2.transpose((1, 0, 2))
+        
+        m.gemm(A1xt.reshape((D1, q * Dm2)), A2t.reshape((D2, q * Dm2)),
+               trans_b=2, out=out)
         
         return out
         
@@ -220,53 +649,70 @@ class EvoMPS_TDVP_Uniform:
         if A2 is None:
             A2 = self.A
 
-        if out is None:
-            out = np.zeros((A1.shape[1], A2.shape[1]), dtype=self.typ)
-        else:
-            out.fill(0.)
-            
         if op is None:
+            if out is None:
+                out = np.zeros((A1.shape[1], A2.shape[1]), 
+                               dtype=np.result_type(A1.dtype, x.dtype, A2.dtype))
+            else:
+                out.fill(0.)
+                
             for s in xrange(self.q):
-                out += m.mmul(A1[s], x, m.H(A2[s]))
+                out += m.dot_nnh(A1[s], x, A2[s])
         else:
+            #op may be complex even if the state is real
+            res = 0
             for s in xrange(self.q):
                 for t in xrange(self.q):
                     o_st = op(s, t)
                     if o_st != 0.:
-                        tmp = m.mmul(A1[t], x, m.H(A2[s]))
-                        tmp *= o_st
-                        out += tmp
+                        res = res + o_st * m.dot_nnh(A1[t], x, A2[s])
+            
+            if out is None:
+                out = np.zeros((A1.shape[1], A2.shape[1]), 
+                               dtype=np.result_type(A1.dtype, x.dtype, res))
+            out[:] = res
         return out
         
     def _eps_l_noop_dense(self, x, A1, A2, out):
         """The left epsilon map, optimized for efficiency.
+        
+        The A2[s] are transposed into the (D, q * D) layout, so that the 
+        products x A2[s] are a single matrix multiplication. After 
+        transposing these back to the stacked layout, the sum over s of 
+        A1[s]^H x A2[s] is a single gemm call with the stacked matrices 
+        A1[s], conjugated on the fly. See also _eps_r_noop_dense().
         """
-        out.fill(0)        
-        #gemm = self.gemm
+        q, Dm1, D1 = A1.shape
+        Dm2, D2 = A2.shape[1:]
+        typ = np.result_type(x.dtype, A2.dtype)
         
-        #if gemm is None:
-        dot = np.dot
-        for s in xrange(self.q):
-            out += dot(A1[s].conj().T, dot(x, A2[s]))
-        #else:
-        #    for s in xrange(self.q):
-        #        out += gemm(1, A1[s], gemm(1, x, A2[s]), 0, None, 2, 0, False)
+        A2t = self._eps_buf(3, (Dm2, q, D2), A2.dtype)
+        A2t[:] = A2.transpose((1, 0, 2))
+        
+        xA2t = self._eps_buf(4, (Dm1, q, D2), typ)
+        m.gemm(x, A2t.reshape((Dm2, q * D2)), out=xA2t.reshape((Dm1, q * D2)))
+        xA2 = self._eps_buf(5, (q, Dm1, D2), typ)
+        xA2[:] = xA2t.transpose((1, 0, 2))
+        
+        m.gemm(A1.reshape((q * Dm1, D1)), xA2.reshape((q * Dm1, D2)),
+               trans_a=2, out=out)
             
         return out
         
     def eps_l(self, x, A1=None, A2=None, out=None):
-        if out is None:
-            out = np.zeros_like(self.A[0])
-        else:
-            out.fill(0.)
-            
         if A1 is None:
             A1 = self.A
         if A2 is None:
             A2 = self.A
             
+        if out is None:
+            out = np.zeros((A1.shape[2], A2.shape[2]), 
+                           dtype=np.result_type(A1.dtype, x.dtype, A2.dtype))
+        else:
+            out.fill(0.)
+            
         for s in xrange(self.q):
-            out += m.mmul(m.H(A1[s]), x, A2[s])
+            out += m.dot_hnn(A1[s], x, A2[s])
             
         return out
         
@@ -284,6 +730,31 @@ class EvoMPS_TDVP_Uniform:
         #AA = np.array([dot(A[s], A[t]) for s in xrange(self.q) for t in xrange(self.q)])
         #self.AA = AA.reshape(self.q, self.q, self.D, self.D)
         
+    def _get_op_sum(self, op):
+        """Returns the operator-sum decomposition (see twosite.op_sum()) of
+        the two-site operator op.
+        
+        The decomposition is cached, with op identified by object identity,
+        so that op should not be modified after it has been used.
+        """
+        entry = self._op_sum_cache.get(id(op))
+        if entry is None or not entry[0] is op:
+            if len(self._op_sum_cache) >= self.op_sum_cache_max:
+                self._op_sum_cache.clear()
+            h = ts.tabulate(op, self.q, self.q, dtype=self.typ)
+            entry = (op, ts.op_sum(h))
+            self._op_sum_cache[id(op)] = entry
+            
+        return entry[1]
+        
+    def _eps_r_2s_op(self, x, op, A1, A2, A3, A4):
+        """The two-site right epsilon map for a general operator, using an 
+        operator-sum decomposition of op (see _get_op_sum()).
+        """
+        O, P = self._get_op_sum(op)
+            
+        return ts.eps_r_2s(x, ts.apply_1s(O, A1), ts.apply_1s(P, A2), A3, A4)
+        
     def eps_r_2s(self, x, op, A1=None, A2=None, A3=None, A4=None, C34=None, C=None):
         if A1 is None:
             A1 = self.A
@@ -298,76 +769,38 @@ class EvoMPS_TDVP_Uniform:
             C = self.C
             op = None
             
-        res = np.zeros((A1.shape[1], A3.shape[1]), dtype=self.typ)
-        zeros_like = np.zeros_like
-        zeros = np.zeros
-        
-        if (A1 is self.A) and (A2 is self.A) and (A3 is self.A) and (A4 is self.A):
-            if op is None and not C is None:
-                for s in xrange(self.q):
-                    for t in xrange(self.q):
-                        res += C[s, t].dot(x.dot(m.H(self.AA[s, t])))
-            else:
-                for u in xrange(self.q):
-                    for v in xrange(self.q):
-                        subres = zeros_like(A1[0])
-                        for s in xrange(self.q):
-                            for t in xrange(self.q):
-                                opval = op(u, v, s, t)
-                                if opval != 0:
-                                    subres += opval * self.AA[s, t]
-                        res += subres.dot(x.dot(m.H(self.AA[u, v])))
-        elif (A1 is self.A) and (A2 is self.A):
-            if op is None and not C is None:
-                for s in xrange(self.q):
-                    for t in xrange(self.q):
-                        AAstH = m.H(A3[s].dot(A4[t]))
-                        res += C[s, t].dot(x.dot(AAstH))
-            elif op is None and not C34 is None:
-                for s in xrange(self.q):
-                    for t in xrange(self.q):
-                        res += self.AA[s, t].dot(x.dot(m.H(C34[s, t])))
-            else:
-                for u in xrange(self.q):
-                    for v in xrange(self.q):
-                        subres = zeros_like(self.A[0])
-                        for s in xrange(self.q):
-                            for t in xrange(self.q):
-                                opval = op(u, v, s, t)
-                                if opval != 0:
-                                    subres += opval * self.AA[s, t]
-                        AAuvH = m.H(A3[u].dot(A4[v]))
-                        res += subres.dot(x.dot(AAuvH))
-        elif (op is None and not C34 is None) or (A3 is self.A) and (A4 is self.A):
-            if op is None and not C34 is None:
-                for s in xrange(self.q):
-                    for t in xrange(self.q):
-                        res += A1[s].dot(A2[t]).dot(x.dot(m.H(C34[s, t])))
-            elif op is None and not C is None:
-                for s in xrange(self.q):
-                    for t in xrange(self.q):
-                        res += A1[s].dot(A2[t]).dot(x.dot(m.H(C[s, t])))
-            else:
-                for u in xrange(self.q):
-                    for v in xrange(self.q):
-                        subres = zeros((A1.shape[1], A2.shape[2]), dtype=self.typ)
-                        for s in xrange(self.q):
-                            for t in xrange(self.q):
-                                opval = op(u, v, s, t)
-                                if opval != 0:
-                                    subres += opval * A1[s].dot(A2[t])
-                        res += subres.dot(x.dot(m.H(self.AA[u, v])))
+        if not op is None:
+            return self._eps_r_2s_op(x, op, A1, A2, A3, A4)
+            
+        typ = np.result_type(A1.dtype, A2.dtype, A3.dtype, A4.dtype, x.dtype)
+        if not C is None:
+            typ = np.result_type(typ, C.dtype)
+        if not C34 is None:
+            typ = np.result_type(typ, C34.dtype)
+        res = np.zeros((A1.shape[1], A3.shape[1]), dtype=typ)
+        
+        if (A1 is self.A) and (A2 is self.A) and (A3 is self.A) and (A4 is self.A) and not C is None:
+            for s in xrange(self.q):
+                for t in xrange(self.q):
+                    res += C[s, t].dot(m.dot_nh(x, self.AA[s, t]))
+        elif (A1 is self.A) and (A2 is self.A) and not C is None:
+            for s in xrange(self.q):
+                for t in xrange(self.q):
+                    res += C[s, t].dot(m.dot_nh(x, A3[s].dot(A4[t])))
+        elif (A1 is self.A) and (A2 is self.A) and not C34 is None:
+            for s in xrange(self.q):
+                for t in xrange(self.q):
+                    res += self.AA[s, t].dot(m.dot_nh(x, C34[s, t]))
+        elif not C34 is None:
+            for s in xrange(self.q):
+                for t in xrange(self.q):
+                    res += A1[s].dot(A2[t]).dot(m.dot_nh(x, C34[s, t]))
+        elif (A3 is self.A) and (A4 is self.A) and not C is None:
+            for s in xrange(self.q):
+                for t in xrange(self.q):
+                    res += A1[s].dot(A2[t]).dot(m.dot_nh(x, C[s, t]))
         else:
-            for u in xrange(self.q):
-                for v in xrange(self.q):
-                    subres = zeros((A1.shape[1], A2.shape[2]), dtype=self.typ)
-                    for s in xrange(self.q):
-                        for t in xrange(self.q):
-                            opval = op(u, v, s, t)
-                            if opval != 0:
-                                subres += opval * A1[s].dot(A2[t])
-                    AAuvH = m.H(A3[u].dot(A4[v]))
-                    res += subres.dot(x.dot(AAuvH))
+            raise ValueError("eps_r_2s: Either op, C or C34 must be supplied.")
                     
         return res
 
@@ -396,41 +829,94 @@ class EvoMPS_TDVP_Uniform:
     
     def _calc_lr_ARPACK(self, x, tmp, calc_l=False, A1=None, A2=None, rescale=True,
                         tol=1E-14):
+        """Arnoldi iteration (ARPACK) to obtain the eigenvector corresponding 
+           to the largest eigenvalue of the (non-Hermitian) transfer operator.
+           
+           The contents of x are used as the starting vector and are 
+           replaced by the result. If ev_use_arpack is 'auto', the two 
+           largest eigenvalues are computed, so that the ratio of their
+           magnitudes, which determines the convergence rate of power 
+           iteration, is also available.
+           
+           If ARPACK does not converge, power iteration is continued from 
+           the best available vector.
+           
+           Returns x, whether the solver converged, the number of 
+           applications of the transfer operator and the ratio (or None).
+        """
         if A1 is None:
             A1 = self.A
         if A2 is None:
             A2 = self.A
+            
+        n = x.size #we will scale x so that stuff doesn't get too small
+        
+        if n < 4:
+            return self._calc_lr(x, tmp, calc_l=calc_l, A1=A1, A2=A2, 
+                                 rescale=rescale, max_itr=self.pow_itr_max,
+                                 rtol=tol, atol=self.itr_atol)
                         
         try:
             norm = la.get_blas_funcs("nrm2", [x])
         except ValueError:
             norm = np.linalg.norm
     
-        n = x.size #we will scale x so that stuff doesn't get too small
-        
-        #start = time.clock()
+        if self.ev_use_arpack == 'auto':
+            k = 2
+        else:
+            k = 1
+            
         opE = EOp(self, A1, A2, calc_l)
         x *= n / norm(x.ravel())
+        x0 = x.ravel().copy()
         try:
-            ev, eV = las.eigsh(opE, which='LM', k=1, v0=x.ravel(), tol=tol)
+            ev, eV = las.eigs(opE, which='LM', k=k, v0=x0, tol=tol)
             conv = True
         except las.ArpackNoConvergence as e:
-            print "Reset! (l? %s)" % str(calc_l)
-            ev, eV = las.eigsh(opE, which='LM', k=1, tol=tol)
-            conv = True
+            ev, eV = e.eigenvalues, e.eigenvectors
+            conv = False
+        except las.ArpackError:
+            ev = []
+            conv = False
             
-        #print ev2
-        #print ev2 * ev2.conj()
-        ev = np.real_if_close(ev[0])
-        ev = np.asscalar(ev)
-        eV = eV[:, 0]
+        if len(ev) == 0:
+            print "ARPACK failed, falling back to power iteration (l? %s)" % str(calc_l)
+            x, conv, itr, ratio = self._calc_lr(x, tmp, calc_l=calc_l, A1=A1, 
+                                                A2=A2, rescale=rescale, 
+                                                max_itr=self.pow_itr_max,
+                                                rtol=tol, atol=self.itr_atol)
+            return x, conv, itr + opE.calls, ratio
+            
+        i_srt = np.argsort(-abs(ev))
+        ev = ev[i_srt]
+        eV = eV[:, i_srt]
+        if len(ev) > 1:
+            ratio = abs(ev[1] / ev[0])
+        else:
+            ratio = None
+        
+        if ratio is None or abs(ev[1] - ev[0]) >= self.ev_degen_tol * abs(ev[0]):
+            eV = eV[:, 0]
+        else:
+            #Degenerate: Keep the component of the starting vector in the 
+            #dominant eigenspace, like power iteration would.
+            eV = eV.dot(la.lstsq(eV, x0)[0])
+        ev = ev[0]
+        
+        if not np.iscomplexobj(x):
+            ev = ev.real
+        else:
+            ev = np.asscalar(np.real_if_close(ev))
         
         #remove any additional phase factor
         eVmean = eV.mean()
         eV *= np.sqrt(np.conj(eVmean) / eVmean)
         
-        if eV.mean() < 0:
+        if eV.mean().real < 0:
             eV *= -1
+            
+        if not np.iscomplexobj(x):
+            eV = eV.real
 
         eV = eV.reshape(self.D, self.D)
         
@@ -438,11 +924,20 @@ class EvoMPS_TDVP_Uniform:
         
         x[:] = eV
         
-        #print "splinalg: %g" % (time.clock() - start)   
-        
-        #print "Herm? %g" % norm((eV - m.H(eV)).ravel())
-        #print "Norm of diff: %g" % norm((eV - x).ravel())
-        #print "Norms: (%g, %g)" % (norm(eV.ravel()), norm(x.ravel()))
+        itr = opE.calls
+        
+        if not conv:
+            x, conv, itr_pow, ratio_pow = self._calc_lr(x, tmp, calc_l=calc_l, 
+                                                        A1=A1, A2=A2, 
+                                                        rescale=False, 
+                                                        max_itr=self.pow_itr_max,
+                                                        rtol=tol, 
+                                                        atol=self.itr_atol)
+            itr += itr_pow
+            opE.eps(x, A1, A2, tmp)
+            ev = tmp.mean() / x.mean()
+            if not np.iscomplexobj(x):
+                ev = ev.real
                     
         if rescale and not abs(ev - 1) < tol:
             A1 *= 1 / sp.sqrt(ev)
@@ -457,7 +952,7 @@ class EvoMPS_TDVP_Uniform:
                 if not abs(ev - 1) < tol:
                     print "Sanity check failed: Largest ev after re-scale = " + str(ev)
         
-        return x, conv
+        return x, conv, itr, ratio
                 
     def _calc_lr(self, x, tmp, calc_l=False, A1=None, A2=None, rescale=True,
                  max_itr=1000, rtol=1E-14, atol=1E-14):
@@ -465,6 +960,11 @@ class EvoMPS_TDVP_Uniform:
            eigenvalue.
            
            The contents of the starting vector x is modifed.
+           
+           Returns x, whether the iteration converged, the number of 
+           iterations and an estimate of the ratio of the magnitudes of the 
+           two largest eigenvalues (or None), obtained from the rate of 
+           convergence.
         """        
         if A1 is None:
             A1 = self.A
@@ -486,6 +986,8 @@ class EvoMPS_TDVP_Uniform:
 
         x *= n / norm(x.ravel())
         tmp[:] = x
+        ratio = None
+        diffs = []
         for i in xrange(max_itr):
             x[:] = tmp
             if calc_l:
@@ -495,11 +997,18 @@ class EvoMPS_TDVP_Uniform:
             ev_mag = norm(tmp.ravel()) / n
             ev = (tmp.mean() / x.mean()).real
             tmp *= (1 / ev_mag)
-            if norm((tmp - x).ravel()) < atol + rtol * n:
+            diff = norm((tmp - x).ravel())
+            if diff < atol + rtol * n:
 #            if allclose(tmp, x, rtol, atol):                
                 #print (i, ev, ev_mag, norm((tmp - x).ravel())/n, atol, rtol)
                 x[:] = tmp
-                break            
+                break
+            diffs.append(diff)
+            if i > 1:
+                #use the second half of the iterations, where the rate is
+                #closest to its asymptotic value
+                h = i // 2
+                ratio = (diff / diffs[h])**(1. / (i - h))
 #        else:
 #            print (i, ev, ev_mag, norm((tmp - x).ravel())/norm(x.ravel()), atol, rtol)
                     
@@ -516,8 +1025,179 @@ class EvoMPS_TDVP_Uniform:
                 if not abs(ev - 1) < atol:
                     print "Sanity check failed: Largest ev after re-scale = " + str(ev)
         
-        return x, i < max_itr - 1, i
+        return x, i < max_itr - 1, i, ratio
     
+    def _use_arpack(self):
+        """Decides whether to use Arnoldi iteration in calc_lr().
+        
+        If ev_use_arpack is 'auto', Arnoldi iteration is used when the
+        estimated ratio of the two largest eigenvalues of the transfer
+        operator (from the previous call) predicts that power iteration 
+        would need more than ev_auto_itr iterations to converge from scratch.
+        
+        If the ratio is within ev_degen_tol of 1, the largest eigenvalues are
+        practically degenerate and the dominant eigenvector can jump between
+        them as the state changes. 
+        Power iteration, which follows the previous fixed point continuously, 
+        is then used instead. Close to (but not at) degeneracy, as for 
+        near-critical states, Arnoldi iteration is used. Power iteration is
+        also used for single-precision states, for which its convergence is
+        limited by rounding errors, rather than by the spectral gap.
+        """
+        if self.ev_use_arpack != 'auto':
+            return self.ev_use_arpack
+        
+        ratio = self.ev_ratio
+        if (self.D**2 < 4 or self._is_single_prec()
+            or ratio is None or ratio <= 0 
+            or ratio > 1 - self.ev_degen_tol):
+            return False
+        
+        return np.log(self.itr_rtol) / np.log(ratio) > self.ev_auto_itr
+
+    def _pow_itr_limit(self):
+        """The maximum number of power iterations for calc_lr().
+
+        If ev_use_arpack is 'auto' and the ratio of the two largest
+        eigenvalues is known, this is ev_itr_fac times the number of
+        iterations needed to converge from scratch (but at least ev_auto_itr
+        and at most pow_itr_max).
+        """
+        ratio = self.ev_ratio
+        if (self.ev_use_arpack != 'auto' or ratio is None
+            or not 0 < ratio < 1):
+            return self.pow_itr_max
+
+        n_itr = np.log(self.itr_rtol) / np.log(ratio)
+
+        return int(min(self.pow_itr_max,
+                       max(self.ev_auto_itr, self.ev_itr_fac * n_itr)))
+
+    def _calc_lr_auto(self, x, tmp, calc_l=False):
+        """Computes l or r using the method chosen by _use_arpack().
+
+        If power iteration does not converge within _pow_itr_limit()
+        iterations and ev_use_arpack is 'auto', Arnoldi iteration is
+        continued from the result (except for single-precision states).
+
+        Updates the estimate ev_ratio of the ratio of the two largest
+        eigenvalues of the transfer operator.
+        """
+        if self._use_arpack():
+            x, conv, itr, ratio = self._calc_lr_ARPACK(x, tmp, calc_l=calc_l,
+                                                       tol=self.itr_rtol)
+        else:
+            x, conv, itr, ratio = self._calc_lr(x, tmp, calc_l=calc_l,
+                                                max_itr=self._pow_itr_limit(),
+                                                rtol=self.itr_rtol,
+                                                atol=self.itr_atol)
+            if (not conv and self.ev_use_arpack == 'auto'
+                and not self._is_single_prec()):
+                x, conv, itr_A, ratio_A = self._calc_lr_ARPACK(x, tmp,
+                                                               calc_l=calc_l,
+                                                               tol=self.itr_rtol)
+                itr += itr_A
+                if not ratio_A is None:
+                    ratio = ratio_A
+
+        if not ratio is None:
+            self.ev_ratio = ratio
+
+        return x, conv, itr
+
+    def calc_EOp_ev(self, k=4, tol=1E-8):
+        """Computes the largest eigenvalues of the transfer operator.
+
+        The transfer operator is E = sum_s A[s] (x) A[s]*. For a normalized
+        state (after update()) the largest eigenvalue is 1. The magnitude
+        of the second-largest determines the correlation length and the
+        convergence rate of the power iteration in calc_lr().
+
+        The full spectrum is computed densely if k is close to D**2.
+        Otherwise, ARPACK is used, starting from r.
+
+        The results are stored in EOp_ev, together with a copy of the A for
+        which they were computed. If A is unchanged (compared by value), 
+        at least k eigenvalues are available, and they were computed with a
+        tolerance of at most tol, they are returned without recomputation. 
+        The estimate ev_ratio is also updated.
+
+        Parameters
+        ----------
+        k : int
+            The number of eigenvalues to compute.
+        tol : float
+            The relative tolerance for ARPACK.
+
+        Returns
+        -------
+        ev : ndarray
+            The k largest eigenvalues, sorted by decreasing magnitude.
+        """
+        n = self.D**2
+        
+        key = self._EOp_ev_key
+        if (not key is None and len(self.EOp_ev) >= min(k, n) 
+            and key[1] <= tol and np.array_equal(key[0], self.A)):
+            return self.EOp_ev[:k]
+
+        if k >= n - 1:
+            E = np.zeros((n, n), dtype=self.typ)
+            for s in xrange(self.q):
+                E += np.kron(self.A[s], self.A[s].conj())
+
+            ev = la.eigvals(E)
+        else:
+            opE = EOp(self, self.A, self.A, False)
+            ev = las.eigs(opE, which='LM', k=k, tol=tol,
+                          v0=np.asarray(self.r, dtype=self.typ).ravel(),
+                          return_eigenvectors=False)
+
+        ev = ev[np.argsort(-abs(ev))][:k]
+
+        self.EOp_ev = ev
+        if k >= n - 1:
+            tol = 0
+        self._EOp_ev_key = (self.A.copy(), tol)
+        if len(ev) > 1:
+            self.ev_ratio = abs(ev[1] / ev[0])
+
+        return ev
+
+    def correlation_length(self, exact=True):
+        """Computes the correlation length from the transfer operator.
+
+        This is xi = -1 / ln|lam_2 / lam_1|, in units of the lattice spacing,
+        where lam_1 and lam_2 are the two largest eigenvalues of the
+        transfer operator. It is an upper bound on the correlation length
+        of any pair of local observables.
+
+        Parameters
+        ----------
+        exact : bool
+            Whether to obtain the eigenvalues using calc_EOp_ev(), which 
+            reuses them while A is unchanged. Otherwise, the estimate
+            ev_ratio from the last calc_lr() is used, which is cheap, but
+            may be imprecise.
+
+        Returns
+        -------
+        xi : float
+            The correlation length.
+        """
+        if not exact and not self.ev_ratio is None:
+            ratio = self.ev_ratio
+        else:
+            ev = self.calc_EOp_ev(k=2)
+            ratio = abs(ev[1] / ev[0])
+
+        if ratio == 0:
+            return 0
+        elif ratio >= 1:
+            return np.inf
+
+        return -1. / np.log(ratio)
+
     def calc_lr(self, reset=False, auto_reset=False):
         tmp = np.empty_like(self.tmp)
         
@@ -525,31 +1205,14 @@ class EvoMPS_TDVP_Uniform:
         self.l_before_CF = np.asarray(self.l_before_CF)
         self.r_before_CF = np.asarray(self.r_before_CF)
         
-        if self.ev_use_arpack:
-            self.l, self.conv_l = self._calc_lr_ARPACK(self.l_before_CF, tmp,
-                                                   calc_l=True,
-                                                   tol=self.itr_rtol)
-        else:
-            self.l, self.conv_l, self.itr_l = self._calc_lr(self.l_before_CF, 
-                                                    tmp, 
-                                                    calc_l=True,
-                                                    max_itr=self.pow_itr_max,
-                                                    rtol=self.itr_rtol, 
-                                                    atol=self.itr_atol)
+        self.l, self.conv_l, self.itr_l = self._calc_lr_auto(self.l_before_CF,
+                                                             tmp, calc_l=True)
                                         
         self.l_before_CF = self.l.copy()
 
-        if self.ev_use_arpack:
-            self.r, self.conv_r = self._calc_lr_ARPACK(self.r_before_CF, tmp, 
-                                                   calc_l=False,
-                                                   tol=self.itr_rtol)
-        else:
-            self.r, self.conv_r, self.itr_r = self._calc_lr(self.r_before_CF, 
-                                                    tmp, 
-                                                    calc_l=False,
-                                                    max_itr=self.pow_itr_max,
-                                                    rtol=self.itr_rtol, 
-                                                    atol=self.itr_atol)
+        self.r, self.conv_r, self.itr_r = self._calc_lr_auto(self.r_before_CF,
+                                                             tmp, calc_l=False)
+            
         self.r_before_CF = self.r.copy()
             
         #normalize eigenvectors:
@@ -557,7 +1220,7 @@ class EvoMPS_TDVP_Uniform:
         if self.symm_gauge:
             norm = m.adot(self.l, self.r).real
             itr = 0 
-            while not np.allclose(norm, 1, atol=1E-13, rtol=0) and itr < 10:
+            while not np.allclose(norm, 1, atol=self.itr_atol * 10, rtol=0) and itr < 10:
                 self.l *= 1. / ma.sqrt(norm)
                 self.r *= 1. / ma.sqrt(norm)
                 
@@ -574,7 +1237,7 @@ class EvoMPS_TDVP_Uniform:
 
             norm = m.adot(self.l, self.r).real
             itr = 0 
-            while not np.allclose(norm, 1, atol=1E-13, rtol=0) and itr < 10:
+            while not np.allclose(norm, 1, atol=self.itr_atol * 10, rtol=0) and itr < 10:
                 self.l *= 1. / norm
                 norm = m.adot(self.l, self.r).real
                 itr += 1
@@ -612,15 +1275,43 @@ class EvoMPS_TDVP_Uniform:
                 print "Sanity check failed: r is not pos. def.!"
             
             norm = m.adot(self.l, self.r)
-            if not np.allclose(norm, 1.0, atol=1E-13, rtol=0):
+            if not np.allclose(norm, 1.0, atol=self.itr_atol * 10, rtol=0):
                 print "Sanity check failed: Bad norm = " + str(norm)
     
-    def restore_SCF(self):
-        X = la.cholesky(self.r, lower=True)
-        Y = la.cholesky(self.l, lower=False)
-        
+    def _factor_pd(self, x):
+        """Returns G, G_i, floored such that x = G G^H and G_i = G^-1.
+        
+        G is the lower Cholesky factor of x. If x is numerically singular 
+        (typically in single precision, where the smallest Schmidt 
+        coefficients are not resolved), G is instead formed from the 
+        eigendecomposition, with the smallest eigenvalues raised to a small 
+        positive floor. In that case, floored is True.
+        """
+        try:
+            G = la.cholesky(x, lower=True)
+            G_i = m.invtr(G, lower=True)
+            floored = False
+        except la.LinAlgError:
+            ev, EV = la.eigh(x)
+            ev = np.maximum(ev, ev[-1] * self.eps)
+            G = EV * np.sqrt(ev)
+            G_i = (EV / np.sqrt(ev)).conj().T
+            floored = True
+            
+        return G, G_i, floored
+    
+    def restore_SCF(self):
+        X, X_i, floored_r = self._factor_pd(self.r)
+        Y, Y_i, floored_l = self._factor_pd(self.l)
+        Y = Y.conj().T
+        Y_i = Y_i.conj().T
+        
         U, sv, Vh = la.svd(Y.dot(X))
         
+        if floored_r or floored_l or self._is_single_prec() or sv[-1] == 0:
+            #Unresolvable Schmidt coefficients can come out zero
+            sv = np.maximum(sv, sv[0] * self.eps)
+        
         #s contains the Schmidt coefficients,
         lam = sv**2
         self.S_hc = - np.sum(lam * sp.log2(lam))
@@ -628,9 +1319,9 @@ class EvoMPS_TDVP_Uniform:
         S = m.simple_diag_matrix(sv, dtype=self.typ)
         Srt = S.sqrt()
         
-        g = m.mmul(Srt, Vh, m.invtr(X, lower=True))
+        g = m.mmul(Srt, Vh, X_i)
         
-        g_i = m.mmul(m.invtr(Y, lower=False), U, Srt)
+        g_i = m.mmul(Y_i, U, Srt)
         
         for s in xrange(self.q):
             self.A[s] = m.mmul(g, self.A[s], g_i)
@@ -641,8 +1332,8 @@ class EvoMPS_TDVP_Uniform:
             if not np.allclose(g.dot(g_i), np.eye(self.D)):
                 print "Sanity check failed! Restore_SCF, bad GT!"
             
-            l = m.mmul(m.H(g_i), self.l, g_i)
-            r = m.mmul(g, self.r, m.H(g))
+            l = m.dot_hnn(g_i, self.l, g_i)
+            r = m.dot_nnh(g, self.r, g)
             
             if not np.allclose(Sfull, l):
                 print "Sanity check failed: Restorce_SCF, left failed!"
@@ -669,16 +1360,18 @@ class EvoMPS_TDVP_Uniform:
             self.restore_SCF()
         else:
             #First get G such that r = eye
-            G = la.cholesky(self.r, lower=True)
-            G_i = m.invtr(G, lower=True)
+            G, G_i, floored = self._factor_pd(self.r)
 
-            self.l = m.mmul(m.H(G), self.l, G)
+            self.l = m.dot_hnn(G, self.l, G)
             
             #Now bring l into diagonal form, trace = 1 (guaranteed by r = eye..?)
             ev, EV = la.eigh(self.l)
+            if floored or self._is_single_prec() or ev[0] <= 0:
+                #Unresolvable Schmidt coefficients can come out negative
+                ev = np.maximum(ev, ev[-1] * self.eps)
             
             G = G.dot(EV)
-            G_i = m.H(EV).dot(G_i)
+            G_i = m.dot_hn(EV, G_i)
             
             for s in xrange(self.q):
                 self.A[s] = m.mmul(G_i, self.A[s], G)
@@ -691,9 +1384,9 @@ class EvoMPS_TDVP_Uniform:
             if self.sanity_checks:
                 M = np.zeros_like(self.r)
                 for s in xrange(self.q):
-                    M += m.mmul(self.A[s], m.H(self.A[s]))            
+                    M += m.dot_nh(self.A[s], self.A[s])            
                 
-                self.r = m.mmul(G_i, self.r, m.H(G_i))
+                self.r = m.dot_nnh(G_i, self.r, G_i)
                 
                 if not np.allclose(M, self.r, 
                                    rtol=self.itr_rtol*self.check_fac,
@@ -732,18 +1425,64 @@ class EvoMPS_TDVP_Uniform:
     def gen_h_matrix(self):
         """Generates a matrix form for h_nn, which can speed up parts of the
         algorithm by avoiding excess loops and python calls.
+        
+        A list of the nonzero entries is also generated (see gen_h_coo()), 
+        so that calc_C() can use the compiled kernel, if available, without 
+        a hand-written h_nn_cptr, as is an operator-sum decomposition 
+        (see twosite.op_sum()). calc_C() uses whichever is cheaper.
+        
+        This must be called again if the Hamiltonian changes. Alternatively,
+        h_nn_mat may be replaced by a new array, in which case the derived
+        forms are regenerated by calc_C() (see _update_h_forms()).
+        """
+        h_nn_mat = ts.tabulate(self.h_nn, self.q, self.q, dtype=self.typ)
+        if h_nn_mat.dtype != self.typ:
+            raise ValueError("h_nn is not real: A complex typ is required.")
+        self.h_nn_mat = h_nn_mat
+        
+        self._update_h_forms()
+        
+    def _update_h_forms(self):
+        """Regenerates h_nn_coo and h_nn_opsum if h_nn_mat has been replaced
+        since they were generated. Modifying h_nn_mat in place is not 
+        detected.
+        """
+        if self._h_forms_key is self.h_nn_mat:
+            return
+        
+        if self.h_nn_mat is None:
+            self.h_nn_coo = None
+            self.h_nn_opsum = None
+        else:
+            self.gen_h_coo()
+            self.h_nn_opsum = ts.op_sum(self.h_nn_mat)
+        self._h_forms_key = self.h_nn_mat
+                        
+    def gen_h_coo(self):
+        """Generates a coordinate list of the nonzero entries of h_nn_mat.
+        
+        The result is a tuple (h_idx, h_val), where each row of h_idx is
+        an index (s, t, u, v) and h_val holds the corresponding values.
         """
-        self.h_nn_mat = sp.zeros((self.q, self.q, self.q, self.q), dtype=self.typ)
-        q = self.q
-        for u in xrange(q):
-            for v in xrange(q):
-                for s in xrange(q):
-                    for t in xrange(q):
-                        self.h_nn_mat[s, t, u, v] = self.h_nn(s, t, u, v)   
+        nz = np.nonzero(self.h_nn_mat)
+        h_idx = np.ascontiguousarray(np.transpose(nz), dtype=np.intp)
+        h_val = np.ascontiguousarray(self.h_nn_mat[nz], dtype=self.typ)
+        
+        self.h_nn_coo = (h_idx.reshape((-1, 4)), h_val)
     
     def calc_C(self):
-        if not tc is None and not self.h_nn_cptr is None and np.iscomplexobj(self.C):
+        self._update_h_forms()
+        
+        if not tc is None and not self.h_nn_cptr is None and self.C.dtype == np.complex128:
             self.C = tc.calc_C(self.AA, self.h_nn_cptr, self.C)
+        elif not self.h_nn_opsum is None and self.h_nn_opsum[0].shape[0] * self.D < self.q**2:
+            #O(k q^2 D^3) instead of O(q^4 D^3): Cheaper for large q and small D
+            O, P = self.h_nn_opsum
+            self.C[:] = ts.calc_C(ts.apply_1s(O, self.A), ts.apply_1s(P, self.A))
+        elif (not tc is None and not self.h_nn_coo is None 
+              and self.C.dtype.char in 'fdFD' and self.h_nn_coo[1].dtype == self.C.dtype):
+            h_idx, h_val = self.h_nn_coo
+            self.C = tc.calc_C_sparse(self.AA, h_idx, h_val, self.C)
         elif not self.h_nn_mat is None:
             self.C[:] = sp.tensordot(self.h_nn_mat, self.AA, ((2, 3), (0, 1)))
         else:
@@ -757,10 +1496,37 @@ class EvoMPS_TDVP_Uniform:
                             if h != 0:
                                 self.C[s, t] += h * self.AA[u, v]
     
+    def _get_PPinv_solver(self):
+        if self.PPinv_solver is None:
+            if self._is_single_prec():
+                return 'gmres'
+            return 'bicgstab'
+        return self.PPinv_solver
+    
     def calc_PPinv(self, x, p=0, out=None, left=False, A1=None, A2=None, r=None, pseudo=True):
-        if out is None:
-            out = np.ones_like(self.A[0])
-            
+        """Solves (1 - e^(ip) QEQ) y = x for y, or the left version.
+        
+        Here, E is the transfer operator built from A1 and A2 and Q projects
+        out the fixed point r (and l). If pseudo is False, Q is omitted.
+        
+        The solver is chosen by PPinv_solver, which can be 'gmres' or 
+        'bicgstab' (solving in matrix form, see matmul.gmres_iso() and
+        matmul.bicgstab_iso()) or 'scipy' (scipy.sparse.linalg.bicgstab).
+        If PPinv_solver is None, 'gmres' is used for single-precision states,
+        for which Bi-CGSTAB tends to stagnate, and 'bicgstab' otherwise.
+        If PPinv_precond is set, the first two use a diagonal 
+        preconditioner (see PPInvOp.calc_diag()). If 'bicgstab' fails to
+        converge, the solve is repeated using 'gmres'.
+        
+        The solver is started from the previous solution with the same p, 
+        left, pseudo, A1, A2 and r (identified by object identity), if 
+        available, or else from out. The number of iterations is stored in 
+        itr_PPinv and convergence in conv_PPinv.
+        
+        For D <= PPinv_dense_D, systems that are solved repeatedly (such as 
+        those in calc_BHB()) are instead solved directly using a cached LU
+        factorization (see _get_PPinv_LU()).
+        """
         if A1 is None:
             A1 = self.A
             
@@ -772,15 +1538,77 @@ class EvoMPS_TDVP_Uniform:
         
         op = PPInvOp(self, p, left, pseudo, A1, A2, r)
         
-        res = out.ravel()
-        x = x.ravel()
+        if out is None:
+            out = np.ones_like(self.A[0], dtype=np.result_type(op.dtype, x.dtype))
+            
+        key = (p, left, pseudo, id(A1), id(A2), id(r))
+        x0 = self._PPinv_cache.get(key)
+        if (not x0 is None and x0.shape == out.shape 
+            and np.can_cast(x0.dtype, out.dtype)):
+            out[:] = x0
+        
+        x = np.asarray(x)
+        
+        if self.D <= self.PPinv_dense_D:
+            lu = self._get_PPinv_LU(p, pseudo, A1, A2, r)
+        else:
+            lu = None
+        
+        if not lu is None:
+            if left:
+                res = la.lu_solve(lu, x.ravel(), trans=2)
+            else:
+                res = la.lu_solve(lu, x.ravel())
+            conv = True
+            itr = 0
+        elif self._get_PPinv_solver() == 'scipy':
+            cnt = [0]
+            def cb(xk):
+                cnt[0] += 1
+            res, info = las.bicgstab(op, x.ravel(), x0=out.ravel(), 
+                                     maxiter=self.PPinv_itr_max, 
+                                     tol=self.itr_rtol, callback=cb) #tol: norm( b - A*x ) / norm( b )
+            conv = info == 0
+            itr = cnt[0]
+        else:
+            if self.PPinv_precond:
+                M = op.precond
+            else:
+                M = None
+            
+            res = out.copy()
+            solver = self._get_PPinv_solver()
+            if solver == 'gmres':
+                res, conv, itr = m.gmres_iso(op, res, x, PPInvOp.apply,
+                                             max_itr=self.PPinv_itr_max, 
+                                             atol=self.itr_atol, 
+                                             rtol=self.itr_rtol, M=M)
+            elif solver == 'bicgstab':
+                res, conv, itr = m.bicgstab_iso(op, res, x, PPInvOp.apply, 
+                                                m.adot,
+                                                max_itr=self.PPinv_itr_max, 
+                                                atol=self.itr_atol, 
+                                                rtol=self.itr_rtol, M=M)
+                if not conv:
+                    #Bi-CGSTAB can break down or diverge: Retry using GMRES.
+                    res, conv, itr_g = m.gmres_iso(op, out.copy(), x, 
+                                                   PPInvOp.apply,
+                                                   max_itr=self.PPinv_itr_max, 
+                                                   atol=self.itr_atol, 
+                                                   rtol=self.itr_rtol, M=M)
+                    itr += itr_g
+            else:
+                raise ValueError("Invalid PPinv_solver: " + str(solver))
+            res = res.ravel()
         
-        res, info = las.bicgstab(op, x, x0=res, maxiter=2000, 
-                                 tol=self.itr_rtol) #tol: norm( b - A*x ) / norm( b )
+        self.itr_PPinv = itr
+        self.conv_PPinv = conv
         
-        if info > 0:
+        if not conv:
             print "Warning: Did not converge on solution for ppinv!"
         
+        x = x.ravel()
+        
         #Test
         if self.sanity_checks:
             RHS_test = op.matvec(res)
@@ -805,6 +1633,11 @@ class EvoMPS_TDVP_Uniform:
         
         out[:] = res
         
+        if conv:
+            if len(self._PPinv_cache) >= self.PPinv_cache_max:
+                self._PPinv_cache.clear()
+            self._PPinv_cache[key] = out.copy()
+        
         return out
         
     def calc_K(self):
@@ -812,7 +1645,7 @@ class EvoMPS_TDVP_Uniform:
         
         for s in xrange(self.q):
             for t in xrange(self.q):
-                Hr += m.mmul(self.C[s, t], self.r, m.H(self.AA[s, t]))
+                Hr += m.dot_nnh(self.C[s, t], self.r, self.AA[s, t])
         
         self.h = m.adot(self.l, Hr)
         
@@ -833,7 +1666,7 @@ class EvoMPS_TDVP_Uniform:
         
         for s in xrange(self.q):
             for t in xrange(self.q):
-                lH += m.mmul(m.H(self.AA[s, t]), self.l, self.C[s, t])
+                lH += m.dot_hnn(self.AA[s, t], self.l, self.C[s, t])
         
         h = m.adot(self.r, lH)
         
@@ -851,23 +1684,58 @@ class EvoMPS_TDVP_Uniform:
         
         return self.K_left, h
             
-    def calc_Vsh(self, r_sqrt):
+    def calc_Vsh(self, r_sqrt, implicit=False):
+        """Generates the parametrization V of the tangent vectors B.
+        
+        By default, an array Vsh with Vsh[s] = H(V[s]) is returned. The 
+        basis is computed using nullspace.get_nullspace() with the method 
+        ns_method, or using nullspace.nullspace_qr() if ns_method is None. 
+        The rank-revealing methods 'qrp' and 'rand' use the previous basis 
+        self.Vsh as a starting guess.
+        
+        If implicit is True, the orthonormal basis V is not formed. Instead,
+        a nullspace.nullspace_projector is returned, which applies the 
+        projector P = V H(V) to parameter matrices x of shape (D, q * D), with 
+        block s given by x[:, s * D:(s + 1) * D]. This avoids the full QR 
+        decomposition of R, which is costly for large q and D.
+        """
+        if implicit:
+            R = np.empty((self.q, self.D, self.D), dtype=self.typ)
+            for s in xrange(self.q):
+                R[s] = m.dot_nh(r_sqrt, self.A[s])
+            
+            V = ns.nullspace_projector(R.reshape((self.q * self.D, self.D)))
+            
+            if self.sanity_checks:
+                if not np.allclose(V.dot(R.reshape((self.q * self.D, self.D))), 0):
+                    print "Sanity check failed: P . R not zero!"
+            
+            return V
+        
         R = np.zeros((self.D, self.q, self.D), dtype=self.typ, order='C')
         
         for s in xrange(self.q):
-            R[:,s,:] = m.mmul(r_sqrt, m.H(self.A[s]))
+            R[:,s,:] = m.dot_nh(r_sqrt, self.A[s])
         
         R = R.reshape((self.q * self.D, self.D))
         
-        Vconj = ns.nullspace_qr(m.H(R)).T
-        #R can be pretty huge for large q and D. The decomp. can take a long time...
+        if self.ns_method is None:
+            Vconj = ns.nullspace_qr(m.H(R)).T
+            #R can be pretty huge for large q and D. The decomp. can take a long time...
+        else:
+            V0 = None
+            if isinstance(self.Vsh, np.ndarray):
+                V0 = self.Vsh.transpose((1, 0, 2)).reshape((self.q * self.D, -1))
+            Vconj = ns.get_nullspace(m.H(R), method=self.ns_method, V0=V0, 
+                                     rtol=self.eps * self.q * self.D, 
+                                     rank=self.D).T
 
         if self.sanity_checks:
-            if not np.allclose(np.dot(Vconj, m.H(Vconj)), np.eye(self.q*self.D - self.D)):
+            if not np.allclose(np.dot(Vconj, m.H(Vconj)), np.eye(Vconj.shape[0])):
                 print "Sanity check failed: V . H(V) not eye!"
             if not np.allclose(np.dot(Vconj.conj(), R), 0):
                 print "Sanity check failed: V . R not zero!"
-        Vconj = Vconj.reshape(((self.q - 1) * self.D, self.D, self.q))
+        Vconj = Vconj.reshape((-1, self.D, self.q))
         
         #prepare for using V[s] and already take the adjoint, since we use it more often
         Vsh = Vconj.T
@@ -876,49 +1744,69 @@ class EvoMPS_TDVP_Uniform:
         return Vsh
         
     def calc_x(self, l_sqrt, l_sqrt_i, r_sqrt, r_sqrt_i, Vsh, out=None):
+        implicit = isinstance(Vsh, ns.nullspace_projector)
+        D = self.D
+        
         if out is None:
-            out = np.zeros((self.D, (self.q - 1) * self.D), dtype=self.typ, 
-                           order=self.odr)
+            if implicit:
+                out = np.zeros((D, self.q * D), dtype=self.typ, order=self.odr)
+            else:
+                out = np.zeros((D, Vsh.shape[2]), dtype=self.typ, 
+                               order=self.odr)
         
         tmp = np.zeros_like(out)
         for s in xrange(self.q):
             tmp2 = m.mmul(self.A[s], self.K)
             for t in xrange(self.q):
-                tmp2 += m.mmul(self.C[s, t], self.r, m.H(self.A[t]))
-            tmp += m.mmul(tmp2, r_sqrt_i, Vsh[s])
+                tmp2 += m.dot_nnh(self.C[s, t], self.r, self.A[t])
+            if implicit:
+                tmp[:, s * D:(s + 1) * D] = m.mmul(tmp2, r_sqrt_i)
+            else:
+                tmp += m.mmul(tmp2, r_sqrt_i, Vsh[s])
         out += l_sqrt.dot(tmp)
         
         tmp.fill(0)
         for s in xrange(self.q):
             tmp2.fill(0)
             for t in xrange(self.q):
-                tmp2 += m.mmul(m.H(self.A[t]), self.l, self.C[t, s])
-            tmp += m.mmul(tmp2, r_sqrt, Vsh[s])
+                tmp2 += m.dot_hnn(self.A[t], self.l, self.C[t, s])
+            if implicit:
+                tmp[:, s * D:(s + 1) * D] = m.mmul(tmp2, r_sqrt)
+            else:
+                tmp += m.mmul(tmp2, r_sqrt, Vsh[s])
         out += l_sqrt_i.dot(tmp)
         
+        if implicit:
+            out[:] = Vsh.dot_left(out)
+        
         return out
         
     def get_B_from_x(self, x, Vsh, l_sqrt_i, r_sqrt_i, out=None):
         if out is None:
-            out = np.zeros_like(self.A)
+            out = np.zeros_like(self.A, dtype=np.result_type(self.A, x))
             
-        for s in xrange(self.q):
-            out[s] = m.mmul(l_sqrt_i, x, m.H(Vsh[s]), r_sqrt_i)
+        if isinstance(Vsh, ns.nullspace_projector):
+            D = self.D
+            for s in xrange(self.q):
+                out[s] = m.mmul(l_sqrt_i, x[:, s * D:(s + 1) * D], r_sqrt_i)
+        else:
+            for s in xrange(self.q):
+                out[s] = m.mmul(l_sqrt_i, m.dot_nh(x, Vsh[s]), r_sqrt_i)
             
         return out
         
     def calc_l_r_roots(self):
-        try:
+        if isinstance(self.l, (m.eyemat, m.simple_diag_matrix)):
             self.l_sqrt = self.l.sqrt()
             self.l_sqrt_i = self.l_sqrt.inv()
-        except AttributeError:
+        else:
             self.l_sqrt, evd = m.sqrtmh(self.l, ret_evd=True)
             self.l_sqrt_i = m.invmh(self.l_sqrt, evd=evd)
             
-        try:
+        if isinstance(self.r, (m.eyemat, m.simple_diag_matrix)):
             self.r_sqrt = self.r.sqrt()
             self.r_sqrt_i = self.r_sqrt.inv()
-        except AttributeError:
+        else:
             self.r_sqrt, evd = m.sqrtmh(self.r, ret_evd=True)
             self.r_sqrt_i = m.invmh(self.r_sqrt, evd=evd)
         
@@ -935,7 +1823,7 @@ class EvoMPS_TDVP_Uniform:
     def calc_B(self, set_eta=True):
         self.calc_l_r_roots()
                 
-        self.Vsh = self.calc_Vsh(self.r_sqrt)
+        self.Vsh = self.calc_Vsh(self.r_sqrt, implicit=self.implicit_V)
         
         self.x = self.calc_x(self.l_sqrt, self.l_sqrt_i, self.r_sqrt, 
                         self.r_sqrt_i, self.Vsh)
@@ -949,7 +1837,7 @@ class EvoMPS_TDVP_Uniform:
             #Test gauge-fixing:
             tst = np.zeros_like(self.A[0])
             for s in xrange(self.q):
-                tst += m.mmul(B[s], self.r, m.H(self.A[s]))
+                tst += m.dot_nnh(B[s], self.r, self.A[s])
             if not np.allclose(tst, 0):
                 print "Sanity check failed: Gauge-fixing violation!"
 
@@ -963,13 +1851,39 @@ class EvoMPS_TDVP_Uniform:
         self.calc_C()
         self.calc_K()
         
+    def _check_dtau(self, dtau):
+        if np.imag(dtau) != 0 and not np.iscomplexobj(self.A):
+            raise ValueError("A complex dtau requires a complex typ. See set_typ().")
+            
+    def _is_single_prec(self):
+        return self.eps > np.finfo(np.float64).eps
+            
+    def _check_promote(self):
+        """Promotes a single-precision state to double precision if eta has
+        dropped below promote_eta.
+        """
+        if (not self.promote_eta is None and self._is_single_prec()
+            and abs(self.eta) < self.promote_eta):
+            self.set_typ(np.promote_types(self.typ, np.float64).type)
+        
     def take_step(self, dtau, B=None):
+        """Takes a forward-Euler step of imaginary time dtau.
+        
+        If the state is single-precision and eta is below promote_eta, the 
+        state is promoted to double precision after the step (see set_typ()).
+        """
+        self._check_dtau(dtau)
+        
         if B is None:
             B = self.calc_B()
         
         self.A += -dtau * B
+        
+        self._check_promote()
             
     def take_step_RK4(self, dtau, B_i=None):
+        self._check_dtau(dtau)
+        
         def update():
             self.calc_lr()
             #self.restore_CF() #this really messes things up...
@@ -1006,8 +1920,136 @@ class EvoMPS_TDVP_Uniform:
         B_fin += B
             
         self.A = A0 - dtau /6 * B_fin
+        
+        self._check_promote()
             
-    def pinvE_brute(self, p, A1, A2, r, pseudo=True):
+    def take_step_adaptive(self, dtau, tol=1E-6, method='bs32', B_i=None,
+                           dtau_max=None, max_rejects=10):
+        """Takes a step using an embedded Runge-Kutta pair with error control.
+        
+        The error of the step is estimated from the difference between the
+        two solutions of the pair, dA, measured in the tangent-space metric
+        as sqrt(sum_s tr(l dA[s] r dA[s]^dagger)), using l and r of the 
+        initial state. If it exceeds tol, the step is rejected and retried 
+        with a smaller step. Only the magnitude of dtau is adapted, so that
+        its phase (e.g. imaginary for real-time evolution) is kept.
+        
+        As with take_step_RK4(), the state is not updated after the step.
+        
+        Both pairs have the first-same-as-last property: The last stage is
+        B at the new state. It is kept and used as B_i by the next call, 
+        unless B_i is given or A or C have changed in the meantime (beyond
+        the rescaling done by calc_lr()). This is the case if the state is 
+        updated using update(restore_CF=False), but not if the gauge is 
+        restored.
+        
+        Parameters
+        ----------
+        dtau : complex
+            The proposed step, usually the dtau_next of the previous step.
+        tol : float
+            The tolerance for the error estimate of a single step.
+        method : str
+            The embedded pair (see rk.rk_embedded_tableau()).
+        B_i : ndarray
+            The tangent vector B at the current state, if already computed.
+        dtau_max : float
+            The maximum magnitude of the proposed next step.
+        max_rejects : int
+            The maximum number of rejections, after which the step is 
+            accepted anyway.
+            
+        Returns
+        -------
+        dtau : complex
+            The step taken.
+        dtau_next : complex
+            The proposed next step.
+        """
+        self._check_dtau(dtau)
+        
+        def update():
+            self.calc_lr()
+            self.calc_AA()
+            self.calc_C()
+            self.calc_K()
+            
+        a, b, e, order, fsal = rk.rk_embedded_tableau(method)
+        
+        A0 = self.A.copy()
+        l0 = np.array(self.l)
+        r0 = np.array(self.r)
+        
+        if B_i is None:
+            B_i = self._get_B_fsal()
+        if B_i is None:
+            B_i = self.calc_B()
+        eta0 = self.eta
+        
+        rejects = 0
+        while True:
+            k = [B_i]
+            for i in xrange(1, len(a)):
+                self.A = A0 - dtau * sum(aij * kj for aij, kj in zip(a[i], k) 
+                                         if aij != 0)
+                update()
+                k.append(self.calc_B(set_eta=fsal and i == len(a) - 1))
+            
+            dA = dtau * sum(ei * ki for ei, ki in zip(e, k) if ei != 0)
+            err = 0
+            for s in xrange(self.q):
+                err += m.adot(dA[s], l0.dot(dA[s]).dot(r0)).real
+            err = ma.sqrt(max(err, 0)) / tol
+            
+            fac = rk.rk_step_factor(err, order)
+            if err <= 1:
+                break
+            
+            if rejects == max_rejects:
+                print "Warning: Accepting step with error above tolerance!"
+                break
+                
+            rejects += 1
+            dtau = dtau * min(fac, 1.)
+        
+        if fsal: #the last stage was evaluated at the new state
+            self._B_fsal = (self.A.copy(), self.C.copy(), k[-1], self.eta)
+            self.eta = eta0
+        else:
+            self.A = A0 - dtau * sum(bi * ki for bi, ki in zip(b, k) if bi != 0)
+        
+        dtau_next = dtau * fac
+        if not dtau_max is None and abs(dtau_next) > dtau_max:
+            dtau_next = dtau_next * (dtau_max / abs(dtau_next))
+        
+        self._check_promote()
+        
+        return dtau, dtau_next
+            
+    def _get_B_fsal(self):
+        """Returns the last stage of the previous take_step_adaptive() call,
+        if it is B at the current state, and restores the corresponding eta.
+        Otherwise, None is returned.
+        """
+        if self._B_fsal is None:
+            return None
+        
+        A, C, B, eta = self._B_fsal
+        self._B_fsal = None
+        if A.shape != self.A.shape:
+            return None
+        
+        #calc_lr() rescales A if the norm is off by more than its tolerance
+        for x0, x in ((A, self.A), (C, self.C)):
+            if la.norm((x - x0).ravel()) > self.itr_rtol * la.norm(x0.ravel()):
+                return None
+            
+        self.eta = eta
+        return B
+            
+    def _calc_PPinv_dense(self, p, A1, A2, r, pseudo=True):
+        """Builds 1 - e^(ip) QEQ (or 1 - e^(ip) E) as a dense matrix.
+        """
         E = np.zeros((self.D**2, self.D**2), dtype=self.typ)
 
         for s in xrange(self.q):
@@ -1021,9 +2063,45 @@ class EvoMPS_TDVP_Uniform:
         else:
             QEQ = E
         
-        EyemE = np.eye(self.D**2, dtype=self.typ) - sp.exp(1.j * p) * QEQ
+        if p == 0:
+            eip = 1
+        else:
+            eip = sp.exp(1.j * p)
+        
+        return np.eye(self.D**2, dtype=self.typ) - eip * QEQ
         
-        return la.inv(EyemE)
+    def _get_PPinv_LU(self, p, pseudo, A1, A2, r):
+        """Returns the LU factorization of 1 - e^(ip) QEQ for calc_PPinv().
+        
+        The factorization is only computed when a system with the same p,
+        pseudo, A1, A2, r and l is solved for the second time, so that 
+        one-off solves (such as for K after each step) remain iterative. 
+        The arrays are compared by value, since they may be modified in 
+        place. None is returned if no factorization is available.
+        
+        The same factorization is used for the left action, which is the
+        Hermitian conjugate.
+        """
+        key = (p, pseudo, id(A1), id(A2), id(r))
+        arrs = (A1, A2, np.asarray(r), np.asarray(self.l))
+        
+        entry = self._PPinv_LU.get(key)
+        if entry is None or not all(np.array_equal(a, b) 
+                                    for a, b in zip(entry[0], arrs)):
+            if len(self._PPinv_LU) >= self.PPinv_LU_cache_max:
+                self._PPinv_LU.clear()
+            self._PPinv_LU[key] = ([a.copy() for a in arrs], None)
+            return None
+        
+        if entry[1] is None:
+            EyemE = self._calc_PPinv_dense(p, A1, A2, r, pseudo=pseudo)
+            entry = (entry[0], la.lu_factor(EyemE, overwrite_a=True))
+            self._PPinv_LU[key] = entry
+            
+        return entry[1]
+    
+    def pinvE_brute(self, p, A1, A2, r, pseudo=True):
+        return la.inv(self._calc_PPinv_dense(p, A1, A2, r, pseudo=pseudo))
         
     def calc_BHB_prereq(self, donor):
         l = self.l
@@ -1062,13 +2140,13 @@ class EvoMPS_TDVP_Uniform:
         C_AhlA = np.empty_like(self.C)
         for u in xrange(self.q):
             for s in xrange(self.q):
-                C_AhlA[u, s] = m.H(A[u]).dot(l.dot(A[s]))
+                C_AhlA[u, s] = m.dot_hn(A[u], l.dot(A[s]))
         C_AhlA = sp.tensordot(h_nn_mat, C_AhlA, ((2, 0), (0, 1)))
         
         C_A_Vrh_ = np.empty((self.q, self.q, A_.shape[1], Vr_.shape[1]), dtype=self.typ)
         for t in xrange(self.q):
             for v in xrange(self.q):
-                C_A_Vrh_[t, v] = A_[t].dot(m.H(Vr_[v]))
+                C_A_Vrh_[t, v] = m.dot_nh(A_[t], Vr_[v])
         C_A_Vrh_ = sp.tensordot(h_nn_mat, C_A_Vrh_, ((1, 3), (0, 1)))
                 
         C_Vri_A_ = np.empty((self.q, self.q, Vri_.shape[1], A_.shape[2]), dtype=self.typ)
@@ -1085,150 +2163,392 @@ class EvoMPS_TDVP_Uniform:
         
         return h_nn, h_nn_mat, C, C_, V_, Vr_, Vri_, C_Vri_A_, C_AhlA, C_A_Vrh_, rhs10
             
-    def calc_BHB(self, x, p, donor, h_nn, h_nn_mat, C, C_, V_, Vr_, Vri_, C_Vri_A_, C_AhlA, C_A_Vrh_, rhs10): 
+    def calc_BHB(self, x, p, donor, h_nn, h_nn_mat, C, C_, V_, Vr_, Vri_, 
+                 C_Vri_A_, C_AhlA, C_A_Vrh_, rhs10, block_prereq=None): 
         """For a good approx. ground state, H should be Hermitian pos. semi-def.
-        """        
+        
+        The terms are computed as a few batched tensor contractions (see 
+        calc_BHB_block()), using the tensors from calc_BHB_block_prereq(), 
+        which are computed here if block_prereq is not supplied.
+        """
+        prereq = (h_nn, h_nn_mat, C, C_, V_, Vr_, Vri_, C_Vri_A_, C_AhlA, 
+                  C_A_Vrh_, rhs10)
+        if block_prereq is None:
+            block_prereq = self.calc_BHB_block_prereq(donor, prereq)
+        
+        if self.sanity_checks:
+            B = donor.get_B_from_x(x, donor.Vsh, self.l_sqrt_i, donor.r_sqrt_i)
+            tst = donor.eps_r(donor.r, A1=B)
+            if not np.allclose(tst, 0):
+                print "Sanity check failed: Gauge-fixing violation!"
+        
+        res = self.calc_BHB_block(x[None], p, donor, prereq, block_prereq)[0]
+        
+        if self.sanity_checks:
+            expval = m.adot(x, res) / m.adot(x, x)
+            #print "expval = " + str(expval)
+            if expval < 0:
+                print "Sanity Fail in calc_BHB! H is not pos. semi-definite (" + str(expval) + ")"
+            if not abs(expval.imag) < 1E-9:
+                print "Sanity Fail in calc_BHB! H is not Hermitian (" + str(expval) + ")"
+        
+        return res
+    
+    def calc_BHB_block_prereq(self, donor, prereq):
+        """Computes the momentum-independent tensors for calc_BHB_block().
+        
+        These combine the fixed factors of the terms of calc_BHB(), so that 
+        each term requires at most two matrix multiplications for the whole 
+        block. prereq is the result of calc_BHB_prereq().
+        """
+        h_nn, h_nn_mat, C, C_, V_, Vr_, Vri_, C_Vri_A_, C_AhlA, C_A_Vrh_, rhs10 = prereq
+        
+        A = self.A
+        A_ = donor.A
+        
+        l = np.asarray(self.l)
+        r_ = np.asarray(donor.r)
+        r__sqrt = np.asarray(donor.r_sqrt)
+        
+        K__r = donor.K
+        K_l = self.K_left
+        
+        AH = A.conj().transpose((0, 2, 1))
+        lA = _lmul_stack(self.l, A)
+        
+        #W[s, t] = r_ C34[s, t]^H, F[s] = sum_t A_[t] W[s, t]
+        W3 = np.tensordot(r_, C_Vri_A_.conj(), ((1,), (3,))).transpose((1, 2, 0, 3))
+        F1 = np.tensordot(A_, W3, ((0, 2), (1, 2))).transpose((1, 0, 2))
+        
+        W11 = np.tensordot(r_, C_.conj(), ((1,), (3,))).transpose((1, 2, 0, 3))
+        F9 = np.tensordot(A_, W11, ((0, 2), (1, 2))).transpose((1, 0, 2))
+        
+        F5 = np.tensordot(K__r, Vri_.conj(), ((1,), (2,))).transpose((1, 0, 2))
+        F6 = np.tensordot(r__sqrt, V_.conj(), ((1,), (2,))).transpose((1, 0, 2))
+        F7 = np.tensordot(K__r, A_.conj(), ((1,), (2,))).transpose((1, 0, 2))
+        
+        F12 = np.tensordot(C_, Vr_.conj(), ((1, 3), (0, 2)))
+        
+        LK6 = np.asarray(self.l_sqrt_i.dot(m.H(K_l)))
+        
+        G810 = np.tensordot(A_, F5, ((0, 2), (0, 1))) + rhs10
+        
+        VrC = Vr_.conj()
+        VriH = Vri_.conj().transpose((0, 2, 1))
+        
+        return AH, lA, W3, F1 + F5, F6, W11, F7 + F9, F12, LK6, G810, VrC, VriH
+        
+    def calc_PPinv_block(self, X, p=0, left=False, A1=None, A2=None, r=None, 
+                         pseudo=True):
+        """Applies calc_PPinv() to each of the right-hand sides X[i].
+        
+        If a cached LU factorization is available (see _get_PPinv_LU()), 
+        all right-hand sides are solved at once. Otherwise, with the 
+        'bicgstab' solver, multiple systems are solved together using 
+        matmul.bicgstab_iso_batch() Any that fail to converge are 
+        then solved separately using calc_PPinv().
+        """
+        if A1 is None:
+            A1 = self.A
+            
+        if A2 is None:
+            A2 = self.A
+            
+        if r is None:
+            r = self.r
+            
+        if self.D <= self.PPinv_dense_D:
+            lu = self._get_PPinv_LU(p, pseudo, A1, A2, r)
+        else:
+            lu = None
+            
+        if lu is None:
+            if self._get_PPinv_solver() != 'bicgstab' or X.shape[0] == 1:
+                return np.array([self.calc_PPinv(x, p=p, left=left, A1=A1, 
+                                                 A2=A2, r=r, pseudo=pseudo) 
+                                 for x in X])
+            
+            op = PPInvOp(self, p, left, pseudo, A1, A2, r)
+            
+            res = np.ones(X.shape, dtype=np.result_type(op.dtype, X.dtype))
+            key = (p, left, pseudo, id(A1), id(A2), id(r))
+            x0 = self._PPinv_cache.get(key)
+            if (not x0 is None and x0.shape == X.shape[1:] 
+                and np.can_cast(x0.dtype, res.dtype)):
+                res[:] = x0
+                
+            if self.PPinv_precond:
+                M = op.precond
+            else:
+                M = None
+            
+            res, conv, itr = m.bicgstab_iso_batch(op, res, X, 
+                                                  PPInvOp.apply_stack,
+                                                  max_itr=self.PPinv_itr_max,
+                                                  atol=self.itr_atol, 
+                                                  rtol=self.itr_rtol, M=M)
+            
+            itr_max = itr.max()
+            
+            #Systems that failed are solved separately (retrying with GMRES).
+            for i in np.flatnonzero(~conv):
+                res[i] = self.calc_PPinv(X[i], p=p, left=left, A1=A1, A2=A2, 
+                                         r=r, pseudo=pseudo)
+                conv[i] = self.conv_PPinv
+                itr_max = max(itr_max, self.itr_PPinv)
+            
+            self.itr_PPinv = itr_max
+            self.conv_PPinv = conv.all()
+                
+            return res
+        
+        Xm = X.reshape((X.shape[0], self.D**2)).T
+        if left:
+            res = la.lu_solve(lu, Xm, trans=2)
+        else:
+            res = la.lu_solve(lu, Xm)
+            
+        return res.T.reshape(X.shape)
+        
+    def calc_BHB_block(self, X, p, donor, prereq, block_prereq):
+        """Applies the effective Hamiltonian to a block of vectors X[i].
+        
+        This computes the same result as calc_BHB() for each X[i], but 
+        with the sums over the block done using matrix-matrix 
+        multiplications. block_prereq is the result of 
+        calc_BHB_block_prereq().
+        """
+        h_nn, h_nn_mat, C, C_, V_, Vr_, Vri_, C_Vri_A_, C_AhlA, C_A_Vrh_, rhs10 = prereq
+        AH, lA, W3, F15, F6, W11, F79, F12, LK6, G810, VrC, VriH = block_prereq
+        
         A = self.A
         A_ = donor.A
         
         l = self.l
-        r_ = donor.r
         
         l_sqrt = self.l_sqrt
         l_sqrt_i = self.l_sqrt_i
         
-        r__sqrt = donor.r_sqrt
-        r__sqrt_i = donor.r_sqrt_i
-        
-        K__r = donor.K
-        K_l = self.K_left
-        
         pseudo = donor is self
         
-        B = donor.get_B_from_x(x, donor.Vsh, l_sqrt_i, r__sqrt_i)
+        eip = sp.exp(1.j * p)
         
-        if self.sanity_checks:
-            tst = donor.eps_r(r_, A1=B)
-            if not np.allclose(tst, 0):
-                print "Sanity check failed: Gauge-fixing violation!"
-
-        if self.sanity_checks:
-            B2 = np.zeros_like(B)
-            for s in xrange(self.q):
-                B2[s] = l_sqrt_i.dot(x.dot(Vri_[s]))
-            if not sp.allclose(B, B2, rtol=self.itr_rtol*self.check_fac,
-                               atol=self.itr_atol*self.check_fac):
-                print "Sanity Fail in calc_BHB! Bad Vri!"
-            
-        y = self.eps_l(l, A1=B)  
+        #B[i, s] = l_sqrt_i X[i] Vri_[s]
+        B = np.tensordot(X, Vri_, ((2,), (1,))).transpose((0, 2, 1, 3))
+        B = _lmul_stack(l_sqrt_i, B)
         
+        y = np.tensordot(B.conj(), lA, ((1, 2), (0, 1)))
         if pseudo:
-            y = y - m.adot(r_, y) * l #should just = y due to gauge-fixing
-        M = self.calc_PPinv(y, p=-p, left=True, A1=A_, r=r_, pseudo=pseudo)
-        #print m.adot(r, M)
-        if self.sanity_checks:
-            y2 = M - sp.exp(+1.j * p) * self.eps_l(M, A1=A_)
-            if not sp.allclose(y, y2):
-                print "Sanity Fail in calc_BHB! Bad M. Off by: %g" % (la.norm((y - y2).ravel()) / la.norm(y.ravel()))
-        Mh = m.H(M)
-
-        res = l_sqrt.dot(
-               donor.eps_r_2s(r_, op=None, A1=B, A3=Vri_, C34=C_Vri_A_) #1 OK
-               + sp.exp(+1.j * p) * self.eps_r_2s(r_, op=None, A2=B, A3=Vri_, A4=A_, C34=C_Vri_A_) #3 OK with 4
-              )
+            y -= (np.tensordot(y, np.asarray(donor.r).conj(), ((1, 2), (0, 1)))[:, None, None]
+                  * np.asarray(l))
+        M = self.calc_PPinv_block(y, p=-p, left=True, A1=A_, r=donor.r, 
+                                  pseudo=pseudo)
+        Mh = M.conj().transpose((0, 2, 1))
         
-        res += sp.exp(-1.j * p) * l_sqrt_i.dot(Mh.dot(rhs10)) #10
+        #1, 3, 5
+        T = np.tensordot(B, F15, ((1, 3), (0, 1)))
+        T += eip * _mid_stack(A, np.tensordot(B, W3, ((1, 3), (1, 2))))
+        res = _lmul_stack(l_sqrt, T)
         
-        exp = sp.exp
-        H = m.H
-        for s in xrange(self.q):
-            for t in xrange(self.q):
-                res += l_sqrt_i.dot(C_AhlA[s, t].dot(B[s])).dot(H(Vr_[t])) #2 OK
-                res += exp(-1.j * p) * l_sqrt_i.dot(H(A[t]).dot(l.dot(B[s]))).dot(C_A_Vrh_[s, t]) #4 OK with 3
-                res += exp(-2.j * p) * l_sqrt_i.dot(H(A[s]).dot(Mh.dot(C_[s, t]))).dot(H(Vr_[t])) #12
+        #6
+        res += _lmul_stack(LK6, np.tensordot(B, F6, ((1, 3), (0, 1))))
         
-        res += l_sqrt.dot(self.eps_r(K__r, A1=B, A2=Vri_)) #5 OK
+        #8, 10
+        T = (1 / eip) * np.dot(Mh.reshape((-1, Mh.shape[2])), G810).reshape(res.shape)
         
-        res += l_sqrt_i.dot(m.H(K_l).dot(self.eps_r(r__sqrt, A1=B, A2=V_))) #6
+        #2, 4, 12
+        Z = np.tensordot(C_AhlA, B, ((0, 3), (1, 2)))
+        T += np.tensordot(Z, VrC, ((0, 3), (0, 2))).transpose((1, 0, 2))
         
-        res += sp.exp(-1.j * p) * l_sqrt_i.dot(Mh.dot(donor.eps_r(K__r, A2=Vri_))) #8
+        Z = np.tensordot(_lmul_stack(l, B), C_A_Vrh_, ((1, 3), (0, 2)))
+        T += (1 / eip) * _mid_stack(AH, Z)
         
-        y1 = sp.exp(+1.j * p) * donor.eps_r(K__r, A1=B) #7
-        y2 = sp.exp(+1.j * p) * donor.eps_r_2s(r_, op=None, A1=B, C34=C_) #9
-        y3 = sp.exp(+2.j * p) * donor.eps_r_2s(r_, op=None, A1=A, A2=B, C34=C_) #11
+        T += (1 / eip**2) * _mid_stack(AH, np.tensordot(Mh, F12, ((2,), (1,))))
         
-        y = y1 + y2 + y3
-        if pseudo:
-            y = y - m.adot(l, y) * r_
-        y_pi = self.calc_PPinv(y, p=p, A2=A_, r=r_, pseudo=pseudo)
-        #print m.adot(l, y_pi)
-        if self.sanity_checks:
-            y2 = y_pi - sp.exp(+1.j * p) * self.eps_r(y_pi, A2=A_)
-            if not sp.allclose(y, y2):
-                print "Sanity Fail in calc_BHB! Bad x_pi. Off by: %g" % (la.norm((y - y2).ravel()) / la.norm(y.ravel()))
+        res += _lmul_stack(l_sqrt_i, T)
         
-        res += l_sqrt.dot(self.eps_r(y_pi, A2=Vri_))
+        #7, 9, 11
+        y = eip * np.tensordot(B, F79, ((1, 3), (0, 1)))
+        y += eip**2 * _mid_stack(A, np.tensordot(B, W11, ((1, 3), (1, 2))))
+        if pseudo:
+            y -= (np.tensordot(y, np.asarray(l).conj(), ((1, 2), (0, 1)))[:, None, None]
+                  * np.asarray(donor.r))
+        y_pi = self.calc_PPinv_block(y, p=p, A2=A_, r=donor.r, pseudo=pseudo)
         
-        if self.sanity_checks:
-            expval = m.adot(x, res) / m.adot(x, x)
-            #print "expval = " + str(expval)
-            if expval < 0:
-                print "Sanity Fail in calc_BHB! H is not pos. semi-definite (" + str(expval) + ")"
-            if not abs(expval.imag) < 1E-9:
-                print "Sanity Fail in calc_BHB! H is not Hermitian (" + str(expval) + ")"
+        res += _lmul_stack(l_sqrt, _mid_stack(A, np.tensordot(y_pi, VriH, ((2,), (1,)))))
         
         return res
     
-    def _prepare_excite_op_top_triv(self, p):
-        self.calc_K_l()
-        self.calc_l_r_roots()
-        self.Vsh = self.calc_Vsh(self.r_sqrt)
+    def prepare_excite_top_triv(self):
+        """Computes the momentum-independent quantities for excite_top_triv().
         
-        op = Excite_H_Op(self, self, p)
-
-        return op        
+        The resulting context is also stored and reused automatically by
+        excite_top_triv() until the state is changed.
+        
+        Returns
+        -------
+        ctx : Excite_Context
+            The context, which may be passed to excite_top_triv().
+        """
+        self._excite_ctx = Excite_Context(self, self)
+        
+        return self._excite_ctx
+        
+    def _prepare_excite_op_top_triv(self, p, ctx=None):
+        if ctx is None:
+            ctx = self._excite_ctx
+            
+        if ctx is None or not ctx.is_valid():
+            ctx = self.prepare_excite_top_triv()
+        
+        return ctx.get_op(p)
+    
+    def _excite_eigs(self, op, k, tol, max_itr, v0, which, 
+                     return_eigenvectors, solver):
+        """Finds eigenvalues of op using the given solver.
+        
+        The 'davidson' solver (matmul.block_davidson()) finds k eigenvalues
+        selected by which ('SA', 'LA' or 'SM'), starting from v0 (if given) 
+        and the lowest eigenvectors of the preconditioner model (see 
+        Excite_H_Op.calc_precond()). Here, tol is the tolerance for the 
+        residual norms, with tol = 0 meaning 1E-10, and max_itr limits the 
+        number of Davidson iterations. Note that 'SM' selects interior
+        eigenvalues if the effective Hamiltonian is indefinite (e.g. away 
+        from the ground state), where Davidson converges less reliably than
+        for 'SA'.
+        """
+        if solver == 'eigsh':
+            return las.eigsh(op, which=which, k=k, v0=v0,
+                             return_eigenvectors=return_eigenvectors, 
+                             maxiter=max_itr, tol=tol)
+        elif solver != 'davidson':
+            raise ValueError("Invalid solver: " + str(solver))
+            
+        if not which in ('SM', 'SA', 'LA'):
+            raise ValueError("The davidson solver only supports which='SM', 'SA' or 'LA'")
+            
+        if v0 is None:
+            V0 = op.precond_guess(k)
+        else:
+            if len(v0.shape) == 1:
+                v0 = v0.reshape((v0.shape[0], 1))
+            V0 = np.hstack((v0, op.precond_guess(k)))[:, :max(k, v0.shape[1])]
+            
+        if tol == 0:
+            tol = 1E-10
+        if max_itr is None:
+            max_itr = 300
+        
+        ev, eV, convg, itr = m.block_davidson(op, V0, las.LinearOperator.matmat,
+                                              k=k, M=op.precond, tol=tol, 
+                                              max_itr=max_itr, which=which)
+        if not convg:
+            print "Warning: Davidson did not converge on excitation eigenvalues!"
+            
+        if return_eigenvectors:
+            return ev, eV
+        else:
+            return ev
     
     def excite_top_triv(self, p, k=6, tol=0, max_itr=None, v0=None,
-                        which='SM', return_eigenvectors=False):
-        self.calc_K_l()
-        self.calc_l_r_roots()
-        self.Vsh = self.calc_Vsh(self.r_sqrt)
+                        which='SM', return_eigenvectors=False, ctx=None,
+                        solver='eigsh'):
+        """Computes the lowest topologically trivial excitations.
         
-        op = Excite_H_Op(self, self, p)
-        res = las.eigsh(op, which=which, k=k, v0=v0,
-                         return_eigenvectors=return_eigenvectors, 
-                         maxiter=max_itr, tol=tol)
-                          
-        return res
+        The solver may be 'eigsh' (scipy.sparse.linalg.eigsh) or 'davidson'
+        (see _excite_eigs()).
+        """
+        op = self._prepare_excite_op_top_triv(p, ctx=ctx)
+        
+        return self._excite_eigs(op, k, tol, max_itr, v0, which, 
+                                 return_eigenvectors, solver)
     
-    def excite_top_triv_brute(self, p):
-        self.calc_K_l()
-        self.calc_l_r_roots()
-        self.Vsh = self.calc_Vsh(self.r_sqrt)
+    def excite_top_triv_brute(self, p, ctx=None, block=32, procs=None):
+        """Computes the full excitation spectrum for momentum p.
+        
+        The effective Hamiltonian is built as a dense matrix, one block of
+        columns at a time (see Excite_H_Op.calc_dense()), and diagonalized.
         
-        op = Excite_H_Op(self, self, p)
+        Parameters
+        ----------
+        p : float
+            The momentum.
+        ctx : Excite_Context
+            The momentum-independent context (see prepare_excite_top_triv()).
+        block : int
+            The number of columns computed per matmat() call.
+        procs : int
+            The number of worker processes among which the columns are 
+            split. Defaults to the number of CPUs. If this is 1, the matrix 
+            is built in this process.
+            
+        Returns
+        -------
+        ev : ndarray
+            The eigenvalues, in ascending order.
+        """
+        op = self._prepare_excite_op_top_triv(p, ctx=ctx)
         
-        x = np.empty(((self.q - 1)*self.D**2), dtype=self.typ)
-        y = np.empty_like(x)
+        d = op.shape[0]
         
-        H = np.zeros((x.shape[0], x.shape[0]), dtype=self.typ)
+        if procs is None:
+            procs = mp.cpu_count()
+        procs = max(1, min(procs, d // block))
         
-        #Only fill the lower triangle
-        for i in xrange(x.shape[0]):
-            x.fill(0)
-            x[i] = 1
-            for j in xrange(i + 1):
-                y.fill(0)
-                y[j] = 1
+        if procs == 1:
+            H = op.calc_dense(block=block)
+        else:
+            H = np.empty((d, d), dtype=op.dtype)
+            queue = mp.Queue()
+            workers = []
+            starts = {}
+            for i in xrange(procs):
+                starts[i * d // procs] = i
+                w = mp.Process(target=_excite_dense_worker, 
+                               args=(op, i * d // procs, (i + 1) * d // procs, 
+                                     block, queue))
+                w.daemon = True
+                workers.append(w)
+            
+            try:
+                for w in workers:
+                    w.start()
                 
-                H[i, j] = x.dot(op.matvec(y))
-
-        #print np.allclose(H, m.H(H))
+                finished = set()
+                while len(finished) < procs:
+                    msg = _get_worker_msg(queue, workers, finished)
+                    if msg[0] == 'err':
+                        raise RuntimeError("Error in excite_top_triv_brute worker:\n" 
+                                           + msg[1])
+                    H[:, msg[1]:msg[1] + msg[2].shape[1]] = msg[2]
+                    finished.add(starts[msg[1]])
+            finally:
+                for w in workers:
+                    if w.is_alive():
+                        w.terminate()
+                    if not w.pid is None:
+                        w.join()
                
         return la.eigvalsh(H)
 
-    def excite_top_nontriv(self, donor, p, k=6, tol=0, max_itr=None, v0=None,
-                           which='SM', return_eigenvectors=False, lobpcg=False):
+    def prepare_excite_top_nontriv(self, donor):
+        """Computes the momentum-independent quantities for 
+        excite_top_nontriv().
+        
+        Both states are brought into canonical form, the phase of donor is 
+        aligned with self (this modifies donor.A) and an Excite_Context is 
+        computed for the pair.
+        
+        The resulting context is also stored and reused automatically by
+        excite_top_nontriv() with the same donor until either state is 
+        changed. Changes to h_nn require gen_h_matrix() to be called before
+        the context is detected as invalid.
+        
+        Returns
+        -------
+        ctx : Excite_Context
+            The context, which may be passed to excite_top_nontriv().
+        """
         self.gen_h_matrix()
         donor.gen_h_matrix()
         self.calc_lr()
@@ -1241,39 +2561,188 @@ class EvoMPS_TDVP_Uniform:
             ev = 0
             for s in xrange(self.q):
                 ev += self.A[s] * donor.A[s].conj()
-            donor.A *= ev / abs(ev)
+            phase = ev / abs(ev)
         else:
             opE = EOp(donor, self.A, donor.A, False)
             ev = las.eigs(opE, which='LM', k=1)
-            donor.A *= ev[0] / abs(ev[0])
+            phase = ev[0] / abs(ev[0])
+        if not np.iscomplexobj(donor.A):
+            phase = np.sign(phase.real)
+        donor.A *= phase
         
         self.update()
         donor.update()
-
-        self.calc_K_l()
-        self.calc_l_r_roots()
-        donor.calc_l_r_roots()
-        donor.Vsh = donor.calc_Vsh(donor.r_sqrt)
         
-        op = Excite_H_Op(self, donor, p)
+        self._excite_ctx_nontriv = Excite_Context(self, donor)
+        
+        return self._excite_ctx_nontriv
+        
+    def _prepare_excite_op_top_nontriv(self, donor, p, ctx=None):
+        if ctx is None:
+            ctx = self._excite_ctx_nontriv
+            
+        if ctx is None or not ctx.donor is donor or not ctx.is_valid():
+            ctx = self.prepare_excite_top_nontriv(donor)
+        
+        return ctx.get_op(p)
+
+    def excite_top_nontriv(self, donor, p, k=6, tol=0, max_itr=None, v0=None,
+                           which='SM', return_eigenvectors=False, lobpcg=False,
+                           solver='eigsh', ctx=None):
+        """Computes the lowest topologically nontrivial excitations.
+        
+        These interpolate between self and the ground state donor. The 
+        setup is done by prepare_excite_top_nontriv(), unless a valid 
+        context for donor is available. See excite_top_triv() for the 
+        solver.
+        """
+        op = self._prepare_excite_op_top_nontriv(donor, p, ctx=ctx)
                 
         if lobpcg:  #This seems to cope with real problems only... :(       
             if v0 is None:
-                v0 = np.ones(((self.q - 1) * self.D**2, k), self.typ)
+                v0 = np.ones(((self.q - 1) * self.D**2, k), op.dtype)
                 
             if len(v0.shape) == 1:
                 v0_1 = v0
-                v0 = np.ones(((self.q - 1) * self.D**2, k), self.typ)
+                v0 = np.ones(((self.q - 1) * self.D**2, k), op.dtype)
                 v0[:, 0] = v0_1
     
             res = las.lobpcg(op, v0, largest=False,  verbosityLevel=1)
         else:
-            res = las.eigsh(op, which=which, k=k, v0=v0,
-                            return_eigenvectors=return_eigenvectors, 
-                            maxiter=max_itr, tol=tol)
+            res = self._excite_eigs(op, k, tol, max_itr, v0, which, 
+                                    return_eigenvectors, solver)
                 
         return res
         
+    def _excite_dispersion_serial(self, donor, ps, k=1, tol=0, max_itr=None,
+                                  which='SM', return_eigenvectors=False,
+                                  solver='eigsh'):
+        v0 = None
+        for p in ps:
+            if donor is None:
+                ev, eV = self.excite_top_triv(p, k=k, tol=tol, max_itr=max_itr,
+                                              v0=v0, which=which,
+                                              return_eigenvectors=True,
+                                              solver=solver)
+            else:
+                ev, eV = self.excite_top_nontriv(donor, p, k=k, tol=tol, 
+                                                 max_itr=max_itr, v0=v0, 
+                                                 which=which,
+                                                 return_eigenvectors=True,
+                                                 solver=solver)
+            
+            #continuation: start the next momentum from the current solution
+            if solver == 'davidson':
+                v0 = eV
+            else:
+                v0 = eV.sum(axis=1)
+            
+            if return_eigenvectors:
+                yield p, (ev, eV)
+            else:
+                yield p, ev
+                
+    def excite_dispersion(self, ps, k=1, tol=0, max_itr=None, which='SM',
+                          return_eigenvectors=False, donor=None, procs=None,
+                          solver='eigsh'):
+        """Computes excitation energies for a list of momenta in parallel.
+        
+        The sorted momenta are split into contiguous blocks, one per worker 
+        process. Within a block, the eigenvectors found for one momentum are 
+        used as the starting vector for the next. The worker processes are 
+        forked, so that the ground-state data (including the 
+        momentum-independent context, see prepare_excite_top_triv() and
+        prepare_excite_top_nontriv()) is shared with them read-only, 
+        without copying.
+        
+        This is a generator, which yields the results in the order they 
+        are completed.
+        
+        Parameters
+        ----------
+        ps : sequence of float
+            The momenta.
+        k : int
+            The number of eigenvalues to compute for each momentum.
+        tol : float
+            Tolerance for the eigenvalues (see excite_top_triv()).
+        max_itr : int
+            Maximum number of Lanczos iterations per momentum.
+        which : str
+            Which eigenvalues to compute (see scipy.sparse.linalg.eigsh).
+        return_eigenvectors : bool
+            Whether to also return the eigenvectors.
+        donor : EvoMPS_TDVP_Uniform
+            If given, topologically nontrivial excitations are computed
+            using excite_top_nontriv(). Otherwise excite_top_triv() is used.
+        procs : int
+            The number of worker processes. Defaults to the number of CPUs.
+            If this is 1, the momenta are processed in this process.
+        solver : str
+            The eigensolver, 'eigsh' or 'davidson' (see excite_top_triv()).
+            
+        Yields
+        ------
+        p : float
+            The momentum.
+        ev : ndarray
+            The eigenvalues for momentum p, or a tuple (ev, eV) of
+            eigenvalues and eigenvectors if return_eigenvectors is set.
+        """
+        ps = sorted(ps)
+        if len(ps) == 0:
+            return
+        
+        if procs is None:
+            procs = mp.cpu_count()
+        procs = max(1, min(procs, len(ps)))
+        
+        if donor is None:
+            if self._excite_ctx is None or not self._excite_ctx.is_valid():
+                self.prepare_excite_top_triv()
+        else:
+            ctx = self._excite_ctx_nontriv
+            if ctx is None or not ctx.donor is donor or not ctx.is_valid():
+                self.prepare_excite_top_nontriv(donor)
+        
+        kwargs = dict(k=k, tol=tol, max_itr=max_itr, which=which, 
+                      return_eigenvectors=return_eigenvectors, solver=solver)
+        
+        if procs == 1:
+            for res in self._excite_dispersion_serial(donor, ps, **kwargs):
+                yield res
+            return
+        
+        queue = mp.Queue()
+        workers = []
+        for i in xrange(procs):
+            block = ps[i * len(ps) // procs:(i + 1) * len(ps) // procs]
+            w = mp.Process(target=_excite_dispersion_worker, 
+                           args=(self, i, donor, block, kwargs, queue))
+            w.daemon = True
+            workers.append(w)
+            
+        try:
+            for w in workers:
+                w.start()
+            
+            finished = set()
+            while len(finished) < len(workers):
+                msg = _get_worker_msg(queue, workers, finished)
+                if msg[0] == 'res':
+                    yield msg[1], msg[2]
+                elif msg[0] == 'err':
+                    raise RuntimeError("Error in excite_dispersion worker:\n" 
+                                       + msg[1])
+                else:
+                    finished.add(msg[1])
+        finally:
+            for w in workers:
+                if w.is_alive():
+                    w.terminate()
+                if not w.pid is None:
+                    w.join()
+        
     def find_min_h(self, B, dtau_init, tol=5E-2):
         dtau = dtau_init
         d = 1.0
@@ -1574,7 +3043,7 @@ class EvoMPS_TDVP_Uniform:
         rho = np.empty((self.q, self.q), dtype=self.typ)
         for s in xrange(self.q):
             for t in xrange(self.q):                
-                rho[s, t] = m.adot(self.l, m.mmul(self.A[t], self.r, m.H(self.A[s])))
+                rho[s, t] = m.adot(self.l, m.dot_nnh(self.A[t], self.r, self.A[s]))
         return rho
         
     def apply_op_1s(self, o):
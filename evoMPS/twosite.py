@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Operator-sum forms for two-site operators.
+
+A two-site operator h[s, t, u, v] (acting on ket indices u, v and producing
+s, t) is written as
+
+    h[s, t, u, v] = sum_k O[k, s, u] * P[k, t, v]
+
+which is obtained from a singular value decomposition of h, regarded as a
+matrix with indices (s, u) and (t, v). For physical nearest-neighbour
+Hamiltonians the number of terms k is small (typically 2 to 4), so that
+maps involving h can be computed at a cost of O(k q^2 D^3) instead of
+O(q^4 D^3).
+"""
+
+import scipy as sp
+import scipy.linalg as la
+
+def tabulate(op, q1, q2, dtype=sp.complex128):
+    """Evaluates a two-site operator function on all index combinations.
+
+    Parameters
+    ----------
+    op : function
+        The operator, with signature op(s, t, u, v).
+    q1 : int
+        Dimension of the first site.
+    q2 : int
+        Dimension of the second site.
+
+    dtype : dtype
+        The data type of the result. If this is real, but op has nonzero
+        imaginary parts, the corresponding complex type is used instead.
+
+    Returns
+    -------
+    h : ndarray
+        Array of shape (q1, q2, q1, q2) with h[s, t, u, v] = op(s, t, u, v).
+    """
+    h = sp.zeros((q1, q2, q1, q2), dtype=sp.result_type(dtype, sp.complex64))
+    for s in xrange(q1):
+        for t in xrange(q2):
+            for u in xrange(q1):
+                for v in xrange(q2):
+                    h[s, t, u, v] = op(s, t, u, v)
+    
+    if sp.iscomplexobj(sp.empty(0, dtype=dtype)) or sp.any(h.imag != 0):
+        return h
+    else:
+        return sp.ascontiguousarray(h.real, dtype=dtype)
+
+def op_sum(h, rtol=1E-14):
+    """Decomposes a two-site operator into a sum of tensor products.
+
+    Parameters
+    ----------
+    h : ndarray
+        The operator, with shape (q1, q2, q1, q2).
+    rtol : float
+        Singular values smaller than rtol times the largest one are dropped.
+
+    Returns
+    -------
+    O : ndarray
+        The first-site factors, with shape (k, q1, q1).
+    P : ndarray
+        The second-site factors, with shape (k, q2, q2).
+    """
+    q1, q2 = h.shape[:2]
+
+    hm = h.transpose((0, 2, 1, 3)).reshape((q1 * q1, q2 * q2))
+    U, sv, Vh = la.svd(hm, full_matrices=False)
+
+    if sv[0] == 0:
+        k = 0
+    else:
+        k = sp.count_nonzero(sv > rtol * sv[0])
+
+    O = (U[:, :k] * sv[:k]).T.reshape((k, q1, q1))
+    P = Vh[:k].reshape((k, q2, q2))
+
+    return O, P
+
+def apply_1s(O, A):
+    """Applies a set of single-site operators to the physical index of A.
+
+    Returns OA[k, s] = sum_u O[k, s, u] A[u].
+    """
+    return sp.tensordot(O, A, axes=((2,), (0,)))
+
+def calc_C(OA1, PA2):
+    """Computes C[s, t] = sum_k OA1[k, s].dot(PA2[k, t]).
+
+    With OA1 = apply_1s(O, A1) and PA2 = apply_1s(P, A2) this is
+    C[s, t] = sum_uv h[s, t, u, v] A1[u].dot(A2[v]).
+
+    The sum is done with a single matrix multiplication.
+    """
+    k, q1, D1, Dm = OA1.shape
+    q2, D2 = PA2.shape[1], PA2.shape[3]
+
+    OAm = OA1.transpose((1, 2, 0, 3)).reshape((q1 * D1, k * Dm))
+    PAm = PA2.transpose((0, 2, 1, 3)).reshape((k * Dm, q2 * D2))
+
+    C = sp.dot(OAm, PAm).reshape((q1, D1, q2, D2))
+
+    return C.transpose((0, 2, 1, 3))
+
+def eps_r_2s(x, OA1, PA2, A3, A4):
+    """Computes the two-site right epsilon map using an operator-sum form.
+
+    The result is
+
+    sum_k sum_uv OA1[k, u] PA2[k, v] x A4[v]^dagger A3[u]^dagger
+
+    which, with OA1 = apply_1s(O, A1) and PA2 = apply_1s(P, A2), is
+
+    sum_uvst h[u, v, s, t] A1[s] A2[t] x (A3[u] A4[v])^dagger.
+    """
+    dot = sp.dot
+    res = sp.zeros((OA1.shape[2], A3.shape[1]), dtype=sp.result_type(OA1, A3))
+
+    A3H = [A3s.conj().T for A3s in A3]
+    A4H = [A4s.conj().T for A4s in A4]
+
+    for k in xrange(OA1.shape[0]):
+        tmp = 0
+        for v in xrange(PA2.shape[1]):
+            tmp = tmp + dot(PA2[k, v], x.dot(A4H[v]))
+        for u in xrange(OA1.shape[1]):
+            res += dot(OA1[k, u], dot(tmp, A3H[u]))
+
+    return res
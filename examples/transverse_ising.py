@@ -110,6 +110,12 @@ Set the initial Hamiltonian parameters.
 h = 1.00
 J = 0.75
 
+"""
+Tabulate the nearest-neighbour term so that calc_C() can use tensor
+contractions instead of calling h_nn() repeatedly.
+"""
+s.gen_h_matrix()
+
 """
 We're going to simulate a quench after we find the ground state.
 Set the new J parameter for the real time evolution here.
@@ -277,6 +283,7 @@ for i in xrange(total_steps):
         real_time = True
         s.save_state(grnd_fname)
         J = J_real
+        s.gen_h_matrix() #The Hamiltonian has changed.
         step = realstep * 1.j
         loaded = False
         print 'Starting real time evolution!'
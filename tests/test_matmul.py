@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the iterative solvers in evoMPS.matmul.
+"""
+
+import unittest
+import numpy as np
+
+import evoMPS.matmul as m
+
+def _mv(A, x):
+    return A.dot(x)
+    
+def _mv_stack(A, X):
+    return X.dot(A.T)
+    
+def _vv(x, y):
+    return np.vdot(x, y)
+
+class TestBiCGSTAB(unittest.TestCase):
+    
+    def setUp(self):
+        rnd = np.random.RandomState(7)
+        self.A = rnd.randn(20, 20) + 20 * np.eye(20)
+        self.B = rnd.randn(3, 20)
+    
+    def test_solve(self):
+        b = self.B[0]
+        x, convg, itr = m.bicgstab_iso(self.A, np.zeros(20), b, _mv, _vv,
+                                       atol=1E-13, rtol=1E-13)
+        self.assertTrue(convg)
+        self.assertTrue(np.allclose(x, np.linalg.solve(self.A, b), 
+                                    rtol=0, atol=1E-12))
+    
+    def test_solve_batch(self):
+        x, convg, itr = m.bicgstab_iso_batch(self.A, np.zeros_like(self.B), 
+                                             self.B, _mv_stack,
+                                             atol=1E-13, rtol=1E-13)
+        self.assertTrue(convg.all())
+        self.assertTrue(np.allclose(x, np.linalg.solve(self.A, self.B.T).T,
+                                    rtol=0, atol=1E-12))
+        
+    def test_breakdown_alpha(self):
+        #r0 is orthogonal to A r0, so that alpha = rho / (r0, A r0) is undefined
+        A = np.array([[0., 1.], [1., 0.]], dtype=np.float32)
+        b = np.array([1., 0.], dtype=np.float32)
+        
+        x, convg, itr = m.bicgstab_iso(A, np.zeros_like(b), b, _mv, _vv)
+        self.assertFalse(convg)
+        self.assertTrue(np.isfinite(x).all())
+        
+        X, convg, itr = m.bicgstab_iso_batch(A, np.zeros((2, 2), np.float32),
+                                             np.array([b, [1., 1.]]), 
+                                             _mv_stack)
+        self.assertFalse(convg[0])
+        self.assertTrue(convg[1])
+        self.assertTrue(np.isfinite(X).all())
+        self.assertTrue(np.allclose(X[1], [1., 1.]))
+        
+    def test_breakdown_omega(self):
+        #A s = 0 for the first s, so that omega = (t, s) / (t, t) is undefined
+        A = np.array([[1., 1.], [0., 0.]])
+        b = np.array([1., 1.])
+        
+        x, convg, itr = m.bicgstab_iso(A, np.zeros_like(b), b, _mv, _vv)
+        self.assertFalse(convg)
+        self.assertTrue(np.isfinite(x).all())
+        
+        X, convg, itr = m.bicgstab_iso_batch(A, np.zeros((1, 2)), b[None, :],
+                                             _mv_stack)
+        self.assertFalse(convg[0])
+        self.assertTrue(np.isfinite(X).all())
+
+class TestBlockDavidson(unittest.TestCase):
+    
+    def setUp(self):
+        rnd = np.random.RandomState(11)
+        X = rnd.randn(40, 40) + 1.j * rnd.randn(40, 40)
+        self.A = X + X.conj().T
+        self.ev = np.linalg.eigvalsh(self.A)
+        self.V0 = rnd.randn(40, 3)
+        
+    def _check(self, which, ev_ex):
+        ev, eV, convg, itr = m.block_davidson(self.A, self.V0, _mv, k=3, 
+                                              tol=1E-9, which=which,
+                                              max_itr=1000)
+        self.assertTrue(convg)
+        self.assertTrue(np.allclose(ev, ev_ex, rtol=0, atol=1E-8))
+        self.assertTrue(np.allclose(self.A.dot(eV), eV * ev, rtol=0, 
+                                    atol=1E-8))
+    
+    def test_SA(self):
+        self._check('SA', self.ev[:3])
+        
+    def test_LA(self):
+        self._check('LA', self.ev[-3:])
+        
+    def test_SM(self):
+        #indefinite, with the target eigenvalues near the lower edge
+        self.A = self.A - self.ev[1] * np.eye(40)
+        ev = self.ev - self.ev[1]
+        self._check('SM', np.sort(ev[np.argsort(abs(ev))[:3]]))
+        
+    def test_max_itr(self):
+        self.assertRaises(ValueError, m.block_davidson, self.A, self.V0, _mv,
+                          max_itr=0)
+
+if __name__ == '__main__':
+    unittest.main()
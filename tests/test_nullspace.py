@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for evoMPS.nullspace, comparing the bases and projectors against
+those from the singular value decomposition.
+"""
+
+import unittest
+import numpy as np
+
+import evoMPS.nullspace as ns
+
+def _rand(m, k, seed, rank=None):
+    """A random complex (m, k) matrix, of rank rank if given."""
+    rnd = np.random.RandomState(seed)
+    if rank is None:
+        return rnd.randn(m, k) + 1.j * rnd.randn(m, k)
+    L = rnd.randn(m, rank) + 1.j * rnd.randn(m, rank)
+    R = rnd.randn(rank, k) + 1.j * rnd.randn(rank, k)
+    return L.dot(R)
+
+def _proj(V):
+    return V.dot(V.conj().T)
+
+class TestNullspace(unittest.TestCase):
+
+    def _check(self, A, V, dim):
+        """Checks that V is an orthonormal basis for the nullspace of A."""
+        self.assertEqual(V.shape, (A.shape[1], dim))
+        self.assertTrue(np.allclose(V.conj().T.dot(V), np.eye(dim),
+                                    rtol=0, atol=1E-12))
+        self.assertTrue(np.allclose(A.dot(V), 0, rtol=0, atol=1E-10))
+
+    def test_qrp(self):
+        for A, dim in ((_rand(4, 7, 1), 3), (_rand(4, 7, 2, rank=2), 5),
+                       (_rand(6, 6, 3, rank=4), 2), (np.zeros((3, 5)), 5)):
+            V = ns.nullspace_qrp(A, atol=1E-10)
+            self._check(A, V, dim)
+            self.assertTrue(np.allclose(_proj(V), _proj(ns.nullspace(A, atol=1E-10)),
+                                        rtol=0, atol=1E-10))
+
+    def test_rand(self):
+        np.random.seed(4)
+        A = _rand(4, 7, 2, rank=2)
+        self.assertRaises(ValueError, ns.nullspace_rand, A)
+        self._check(A, ns.nullspace_rand(A, atol=1E-10, rank=2), 5)
+        #an underestimated rank falls back to sampling the full range
+        self._check(A, ns.nullspace_rand(A, atol=1E-10, rank=1, oversample=0), 5)
+        self._check(_rand(4, 7, 1), ns.nullspace_rand(_rand(4, 7, 1), rank=4), 3)
+
+    def test_warm_start(self):
+        np.random.seed(5)
+        L, R = _rand(4, 2, 2), _rand(2, 7, 3)
+        A0 = L.dot(R)
+        A1 = L.dot(R + 1E-7 * _rand(2, 7, 6)) #a nearby matrix of rank 2
+        V0 = ns.nullspace_qrp(A0, atol=1E-10)
+        for method in ('qrp', 'rand'):
+            V = ns.get_nullspace(A1, method=method, V0=V0, atol=1E-10, rank=2)
+            self._check(A1, V, 5)
+            #the basis stays close to V0, not just the subspace
+            self.assertTrue(abs(V - V0).max() < 1E-5)
+
+            #V0 of the wrong shape is ignored
+            V = ns.get_nullspace(A1, method=method, V0=V0[:, :2], atol=1E-10,
+                                 rank=2)
+            self._check(A1, V, 5)
+
+    def test_get_nullspace(self):
+        np.random.seed(6)
+        A = _rand(4, 7, 1)
+        P_ex = _proj(ns.nullspace(A))
+        for method in ('svd', 'qr', 'qrp', 'rand'):
+            V = ns.get_nullspace(A, method=method, rank=4)
+            self._check(A, V, 3)
+            self.assertTrue(np.allclose(_proj(V), P_ex, rtol=0, atol=1E-10))
+        self.assertRaises(ValueError, ns.get_nullspace, A, method='foo')
+
+    def test_stacked(self):
+        A = np.array([_rand(3, 8, seed) for seed in xrange(5)])
+        V = ns.nullspace_stacked(A)
+        self.assertEqual(V.shape, (5, 8, 5))
+        for i in xrange(5):
+            self._check(A[i], V[i], 5)
+            self.assertTrue(np.allclose(_proj(V[i]), _proj(ns.nullspace_qr(A[i])),
+                                        rtol=0, atol=1E-10))
+
+class TestProjector(unittest.TestCase):
+
+    def setUp(self):
+        self.A = np.array([_rand(8, 3, seed) for seed in xrange(4)])
+        rnd = np.random.RandomState(7)
+        self.x = rnd.randn(8, 5) + 1.j * rnd.randn(8, 5)
+
+    def _check(self, P, A):
+        V = ns.nullspace_qr(A.conj().T)
+        P_ex = _proj(V)
+        self.assertEqual(P.rank, V.shape[1])
+        self.assertEqual(P.shape, (8, 8))
+        self.assertTrue(np.allclose(P.dot(self.x), P_ex.dot(self.x),
+                                    rtol=0, atol=1E-12))
+        xh = self.x.conj().T
+        self.assertTrue(np.allclose(P.dot_left(xh), xh.dot(P_ex),
+                                    rtol=0, atol=1E-12))
+
+    def test_projector(self):
+        for A in self.A:
+            self._check(ns.nullspace_projector(A), A)
+            Q = np.linalg.qr(A)[0]
+            self._check(ns.nullspace_projector(Q, orthonormal=True), A)
+
+    def test_projectors(self):
+        P = ns.nullspace_projectors(self.A)
+        self.assertEqual(len(P), self.A.shape[0])
+        for Pi, A in zip(P, self.A):
+            self._check(Pi, A)
+
+if __name__ == '__main__':
+    unittest.main()
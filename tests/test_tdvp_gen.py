@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for evoMPS.tdvp_gen, comparing against brute-force results.
+"""
+
+import unittest
+import numpy as np
+
+import evoMPS.tdvp_gen as tg
+import evoMPS.rk as rk
+
+def _h_ising(J, hx):
+    Z = np.diag([1., -1.])
+    X = np.array([[0., 1.], [1., 0.]])
+    h = -J * np.kron(Z, Z) - hx * np.kron(X, np.eye(2))
+    return h.reshape((2, 2, 2, 2))
+
+def _make_state(N, D, hx, A=None, steps=0):
+    np.random.seed(3)
+    s = tg.EvoMPS_TDVP_Generic(N, [D] * (N + 1), [2] * (N + 1))
+    h = _h_ising(1., hx)
+    s.h_nn = lambda n, s_, t, u, v: h[s_, t, u, v]
+    s.h_ext = None
+    s.sanity_checks = False
+    s.gen_h_matrix()
+    if not A is None:
+        for n in xrange(1, N + 1):
+            s.A[n] = A[n].copy()
+    for i in xrange(steps):
+        s.update()
+        s.take_step(0.05)
+    s.update()
+    return s
+
+class TestAdaptiveRK(unittest.TestCase):
+
+    def setUp(self):
+        self.A0 = _make_state(8, 4, 1.5, steps=40).A
+
+    def _X(self, s):
+        return s.expect_1s(lambda n, s_, t: float(s_ != t), 4).real
+
+    def test_vs_RK4(self):
+        T = 0.3
+        s = _make_state(8, 4, 1., A=self.A0)
+        for i in xrange(100):
+            s.update(restore_rcf=False)
+            s.take_step_RK4(1.j * T / 100)
+        s.update()
+        X_ex = self._X(s)
+
+        for method in ('bs32', 'dp54'):
+            s = _make_state(8, 4, 1., A=self.A0)
+            t = 0
+            dtau = 0.01j
+            while t < T - 1E-12:
+                s.update(restore_rcf=False)
+                if abs(dtau) > T - t:
+                    dtau = dtau * ((T - t) / abs(dtau))
+                eta, dtau_taken, dtau = s.take_step_adaptive(dtau, tol=1E-7,
+                                                             method=method)
+                t += abs(dtau_taken)
+            s.update()
+
+            self.assertTrue(abs(self._X(s) - X_ex) < 1E-6)
+
+    def test_fsal(self):
+        for method in ('bs32', 'dp54'):
+            s = _make_state(8, 4, 1., A=self.A0)
+            cnt = [0]
+            calc_B_all = s.calc_B_all
+            def counting_calc_B_all(*args, **kwargs):
+                cnt[0] += 1
+                return calc_B_all(*args, **kwargs)
+            s.calc_B_all = counting_calc_B_all
+
+            n = len(rk.rk_embedded_tableau(method)[0])
+
+            #the last stage is reused as the first stage of the next step
+            s.update(restore_rcf=False)
+            s.take_step_adaptive(0.001j, method=method)
+            s.update(restore_rcf=False)
+            cnt[0] = 0
+            s.take_step_adaptive(0.001j, method=method)
+            self.assertEqual(cnt[0], n - 1)
+
+            #but not if the gauge has been restored
+            s.update()
+            cnt[0] = 0
+            s.take_step_adaptive(0.001j, method=method)
+            self.assertEqual(cnt[0], n)
+
+class TestCalcBAll(unittest.TestCase):
+
+    def setUp(self):
+        #without restoring the canonical form, l and r are dense
+        s = _make_state(8, 4, 1.5, steps=5)
+        s.update(restore_rcf=False)
+        s.take_step(0.05)
+        s.update(restore_rcf=False)
+        self.s_dense = s
+        self.s_rcf = _make_state(8, 4, 1.5, steps=5)
+        self.assertTrue(len(set(s.D)) > 1) #several groups of shapes
+
+    def test_l_r_roots(self):
+        for s in (self.s_dense, self.s_rcf):
+            roots = s.calc_l_r_roots_all()
+            for n in xrange(1, s.N + 1):
+                for x, x_ex in zip([r[n] for r in roots], s.calc_l_r_roots(n)):
+                    self.assertTrue(np.allclose(np.asarray(x), np.asarray(x_ex),
+                                                rtol=0, atol=1E-10))
+
+    def test_Vsh(self):
+        rnd = np.random.RandomState(2)
+        for s in (self.s_dense, self.s_rcf):
+            r_sqrt = s.calc_l_r_roots_all()[1]
+            for implicit in (False, True):
+                Vsh = s.calc_Vsh_all(r_sqrt, implicit=implicit)
+                for n in xrange(1, s.N + 1):
+                    if s.q[n] * s.D[n] - s.D[n - 1] <= 0:
+                        self.assertTrue(Vsh[n] is None)
+                        continue
+                    Vsh_ex = s.calc_Vsh(n, r_sqrt[n], implicit=implicit)
+                    if implicit:
+                        x = rnd.randn(s.D[n - 1], s.q[n] * s.D[n])
+                        P, P_ex = Vsh[n].dot_left(x), Vsh_ex.dot_left(x)
+                    else:
+                        #the bases may differ by a unitary transformation
+                        V = Vsh[n].reshape((s.q[n] * s.D[n], -1))
+                        V_ex = Vsh_ex.reshape((s.q[n] * s.D[n], -1))
+                        P, P_ex = V.dot(V.conj().T), V_ex.dot(V_ex.conj().T)
+                    self.assertTrue(np.allclose(P, P_ex, rtol=0, atol=1E-10))
+
+    def test_B(self):
+        for s in (self.s_dense, self.s_rcf):
+            for implicit in (False, True):
+                s.implicit_V = implicit
+                B = s.calc_B_all()
+                eta = s.eta.copy()
+                for n in xrange(1, s.N + 1):
+                    B_ex = s.calc_B(n)
+                    if B_ex is None:
+                        self.assertTrue(B[n] is None)
+                    else:
+                        self.assertTrue(np.allclose(B[n], B_ex, rtol=0, 
+                                                    atol=1E-10))
+                        self.assertTrue(abs(eta[n] - s.eta[n]) < 1E-10)
+
+if __name__ == '__main__':
+    unittest.main()
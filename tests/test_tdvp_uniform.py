@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for evoMPS.tdvp_uniform, comparing against brute-force results.
+"""
+
+import unittest
+import numpy as np
+
+import evoMPS.tdvp_uniform as tu
+import evoMPS.rk as rk
+
+def _h_ising(J, hx):
+    Z = np.diag([1., -1.])
+    X = np.array([[0., 1.], [1., 0.]])
+    h = -J * np.kron(Z, Z) - hx * np.kron(X, np.eye(2))
+    return h.reshape((2, 2, 2, 2))
+
+def _make_state(D, typ=np.complex128, hx=1.5, steps=20):
+    np.random.seed(3)
+    s = tu.EvoMPS_TDVP_Uniform(D, 2, typ=typ)
+    h = _h_ising(1., hx)
+    s.h_nn = lambda s_, t, u, v: h[s_, t, u, v]
+    s.gen_h_matrix()
+    for i in xrange(steps):
+        s.update()
+        s.take_step(0.1)
+    s.update()
+    return s
+
+def _PPinv_brute(s, x, p, left, pseudo=True):
+    pinvE = s.pinvE_brute(p, s.A, s.A, s.r, pseudo=pseudo)
+    if left:
+        res = x.reshape((1, s.D**2)).conj().dot(pinvE).conj()
+    else:
+        res = pinvE.dot(x.ravel())
+    return res.reshape((s.D, s.D))
+
+def _h_rand(q, typ, seed=7):
+    """A random two-site operator with some zero entries."""
+    rnd = np.random.RandomState(seed)
+    h = rnd.randn(q, q, q, q)
+    if np.iscomplexobj(np.zeros(0, dtype=typ)):
+        h = h + 1.j * rnd.randn(q, q, q, q)
+    h[rnd.rand(q, q, q, q) < 0.5] = 0
+    return h.astype(typ)
+
+def _rand_A(s, seed=9):
+    rnd = np.random.RandomState(seed)
+    A = rnd.randn(*s.A.shape)
+    if np.iscomplexobj(s.A):
+        A = A + 1.j * rnd.randn(*s.A.shape)
+    s.A[:] = A
+    s.calc_AA()
+
+class TestCalcC(unittest.TestCase):
+    
+    typs = (np.float32, np.float64, np.complex64, np.complex128)
+    
+    def _atol(self, typ):
+        return 1E-4 if np.finfo(typ).eps > 1E-10 else 1E-12
+    
+    @unittest.skipIf(tu.tc is None, "tdvp_common is not built")
+    def test_sparse(self):
+        for typ in self.typs:
+            s = tu.EvoMPS_TDVP_Uniform(4, 3, typ=typ)
+            _rand_A(s)
+            s.h_nn_mat = _h_rand(3, typ)
+            s.gen_h_coo()
+            h_idx, h_val = s.h_nn_coo
+            self.assertEqual(h_val.dtype, typ)
+            self.assertEqual(len(h_val), np.count_nonzero(s.h_nn_mat))
+            
+            C = tu.tc.calc_C_sparse(s.AA, h_idx, h_val, np.empty_like(s.AA))
+            C_ex = np.tensordot(s.h_nn_mat, s.AA, ((2, 3), (0, 1)))
+            self.assertTrue(np.allclose(C, C_ex, rtol=0, atol=self._atol(typ)))
+    
+    def test_h_nn_mat_replaced(self):
+        for typ in self.typs:
+            s = tu.EvoMPS_TDVP_Uniform(4, 3, typ=typ)
+            _rand_A(s)
+            for seed in (7, 8):
+                s.h_nn_mat = _h_rand(3, typ, seed=seed)
+                s.calc_C()
+                C_ex = np.tensordot(s.h_nn_mat, s.AA, ((2, 3), (0, 1)))
+                self.assertTrue(np.allclose(s.C, C_ex, rtol=0, 
+                                            atol=self._atol(typ)))
+
+class TestPPinv(unittest.TestCase):
+
+    def setUp(self):
+        self.s = _make_state(6)
+        self.s.PPinv_dense_D = 0 #always use the iterative solvers
+        rnd = np.random.RandomState(5)
+        self.x = rnd.randn(6, 6) + 1.j * rnd.randn(6, 6)
+
+    def _check(self, solver):
+        s = self.s
+        s.PPinv_solver = solver
+        for p in (0, 0.7):
+            for left in (False, True):
+                res = s.calc_PPinv(self.x, p=p, left=left)
+                self.assertTrue(s.conv_PPinv)
+                self.assertTrue(np.allclose(res, _PPinv_brute(s, self.x, p, left),
+                                            rtol=0, atol=1E-9))
+
+    def test_bicgstab(self):
+        self._check('bicgstab')
+
+    def test_gmres(self):
+        self._check('gmres')
+
+    def test_warm_start(self):
+        s = self.s
+        s.PPinv_solver = 'bicgstab'
+        res1 = s.calc_PPinv(self.x, p=0.7).copy()
+        itr1 = s.itr_PPinv
+        res2 = s.calc_PPinv(self.x, p=0.7)
+        self.assertTrue(s.itr_PPinv < itr1)
+        self.assertTrue(np.allclose(res1, res2, rtol=0, atol=1E-9))
+
+class TestPPinvLU(unittest.TestCase):
+
+    def setUp(self):
+        self.s = _make_state(6)
+        rnd = np.random.RandomState(5)
+        self.x = rnd.randn(6, 6) + 1.j * rnd.randn(6, 6)
+
+    def test_repeated_solve(self):
+        s = self.s
+        for p in (0.7, 1.3): #p = 0 has already been solved for K
+            res = s.calc_PPinv(self.x, p=p)
+            self.assertTrue(s.itr_PPinv > 0) #first solve is iterative
+            for left in (False, True):
+                res = s.calc_PPinv(self.x, p=p, left=left)
+                self.assertEqual(s.itr_PPinv, 0) #LU was used
+                self.assertTrue(np.allclose(res, _PPinv_brute(s, self.x, p, left),
+                                            rtol=0, atol=1E-9))
+
+    def test_invalidate(self):
+        s = self.s
+        s.calc_PPinv(self.x, p=0.7)
+        s.calc_PPinv(self.x, p=0.7)
+        self.assertEqual(s.itr_PPinv, 0)
+        s.A *= 1.01 #in place, so that the identity of A is kept
+        res = s.calc_PPinv(self.x, p=0.7)
+        self.assertTrue(s.itr_PPinv > 0)
+        self.assertTrue(np.allclose(res, _PPinv_brute(s, self.x, 0.7, False),
+                                    rtol=0, atol=1E-9))
+
+class TestExcite(unittest.TestCase):
+
+    def setUp(self):
+        self.s = _make_state(4, steps=60)
+
+    def test_davidson(self):
+        s = self.s
+        for p in (0, 1.):
+            ev_ex = s.excite_top_triv_brute(p, procs=1)
+            for which in ('SA', 'SM'):
+                ev = s.excite_top_triv(p, k=3, which=which, solver='davidson',
+                                       tol=1E-10)
+                self.assertTrue(np.allclose(ev, ev_ex[:3], rtol=0, atol=1E-8))
+
+    def test_calc_dense(self):
+        op = self.s._prepare_excite_op_top_triv(0.5)
+        d = op.shape[0]
+        H = op.calc_dense(block=5) #block does not divide d
+        for j in xrange(d):
+            e = np.zeros((d,), dtype=op.dtype)
+            e[j] = 1
+            self.assertTrue(np.allclose(H[:, j], op.matvec(e), rtol=0, 
+                                        atol=1E-9))
+        self.assertTrue(np.allclose(op.calc_dense(3, 11, block=5), H[:, 3:11],
+                                    rtol=0, atol=1E-9))
+    
+    def test_brute_procs(self):
+        s = self.s
+        for p in (0, 0.5):
+            ev = s.excite_top_triv_brute(p, procs=1)
+            self.assertTrue(ev.shape[0] >= 8) #so that procs=2 is used
+            ev_2 = s.excite_top_triv_brute(p, procs=2, block=4)
+            self.assertTrue(np.allclose(ev, ev_2, rtol=0, atol=1E-9))
+
+    def test_max_itr(self):
+        self.assertRaises(ValueError, self.s.excite_top_triv, 0, k=3,
+                          max_itr=0, solver='davidson')
+
+class TestAdaptiveRK(unittest.TestCase):
+
+    def setUp(self):
+        self.A0 = _make_state(6, hx=1.5, steps=60).A.copy()
+
+    def _quench(self):
+        s = _make_state(6, hx=1., steps=0)
+        s.A[:] = self.A0
+        s.update()
+        return s
+
+    def _X(self, s):
+        return s.expect_1s(lambda s_, t: float(s_ != t)).real
+
+    def test_vs_RK4(self):
+        T = 0.3
+        s = self._quench()
+        for i in xrange(100):
+            s.update(restore_CF=False)
+            s.take_step_RK4(1.j * T / 100)
+        s.update()
+        X_ex = self._X(s)
+
+        for method in ('bs32', 'dp54'):
+            s = self._quench()
+            t = 0
+            dtau = 0.01j
+            while t < T - 1E-12:
+                s.update(restore_CF=False)
+                if abs(dtau) > T - t:
+                    dtau = dtau * ((T - t) / abs(dtau))
+                dtau_taken, dtau = s.take_step_adaptive(dtau, tol=1E-7,
+                                                        method=method)
+                t += abs(dtau_taken)
+            s.update()
+
+            self.assertTrue(abs(self._X(s) - X_ex) < 1E-6)
+
+    def test_fsal(self):
+        for method in ('bs32', 'dp54'):
+            s = self._quench()
+            cnt = [0]
+            calc_B = s.calc_B
+            def counting_calc_B(*args, **kwargs):
+                cnt[0] += 1
+                return calc_B(*args, **kwargs)
+            s.calc_B = counting_calc_B
+
+            n = len(rk.rk_embedded_tableau(method)[0])
+
+            #the last stage is reused as the first stage of the next step
+            s.update(restore_CF=False)
+            s.take_step_adaptive(0.001j, method=method)
+            s.update(restore_CF=False)
+            cnt[0] = 0
+            s.take_step_adaptive(0.001j, method=method)
+            self.assertEqual(cnt[0], n - 1)
+
+            #but not if the gauge has been restored
+            s.update()
+            cnt[0] = 0
+            s.take_step_adaptive(0.001j, method=method)
+            self.assertEqual(cnt[0], n)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for evoMPS.twosite and its use in the uniform and sandwich engines,
+comparing against dense contractions with the tabulated operator.
+"""
+
+import unittest
+import numpy as np
+
+import evoMPS.twosite as ts
+import evoMPS.tdvp_uniform as tu
+import evoMPS.tdvp_sandwich as tsw
+
+def _h_ising(J, hx):
+    Z = np.diag([1., -1.])
+    X = np.array([[0., 1.], [1., 0.]])
+    h = -J * np.kron(Z, Z) - hx * np.kron(X, np.eye(2))
+    return h.reshape((2, 2, 2, 2))
+
+def _h_rand(q, k, seed=4):
+    """A random two-site operator of operator-Schmidt rank k."""
+    rnd = np.random.RandomState(seed)
+    O = rnd.randn(k, q, q) + 1.j * rnd.randn(k, q, q)
+    P = rnd.randn(k, q, q) + 1.j * rnd.randn(k, q, q)
+    return np.einsum('ksu,ktv->stuv', O, P)
+
+def _rand_A(q, D1, D2, seed):
+    rnd = np.random.RandomState(seed)
+    return rnd.randn(q, D1, D2) + 1.j * rnd.randn(q, D1, D2)
+
+def _C_dense(h, A1, A2):
+    AA = np.einsum('uij,vjk->uvik', A1, A2)
+    return np.tensordot(h, AA, ((2, 3), (0, 1)))
+
+def _eps_r_2s_dense(h, x, A1, A2, A3, A4):
+    res = 0
+    for u, v, s, t in np.ndindex(h.shape):
+        if h[u, v, s, t] != 0:
+            res = res + h[u, v, s, t] * A1[s].dot(A2[t]).dot(x).dot(
+                            A3[u].dot(A4[v]).conj().T)
+    return res
+
+class TestTwosite(unittest.TestCase):
+
+    def setUp(self):
+        self.h = _h_rand(3, 2)
+        self.A = [_rand_A(3, 4, 4, seed) for seed in xrange(4)]
+        self.x = _rand_A(1, 4, 4, 5)[0]
+
+    def test_op_sum(self):
+        for h, k in ((self.h, 2), (_h_ising(1., 0.5), 2),
+                     (np.zeros((2, 2, 2, 2)), 0)):
+            O, P = ts.op_sum(h)
+            self.assertEqual(O.shape[0], k)
+            self.assertEqual(P.shape[0], k)
+            self.assertTrue(np.allclose(np.einsum('ksu,ktv->stuv', O, P), h,
+                                        rtol=0, atol=1E-12))
+
+    def test_calc_C(self):
+        A1, A2 = self.A[:2]
+        O, P = ts.op_sum(self.h)
+        C = ts.calc_C(ts.apply_1s(O, A1), ts.apply_1s(P, A2))
+        self.assertTrue(np.allclose(C, _C_dense(self.h, A1, A2),
+                                    rtol=0, atol=1E-11))
+
+    def test_eps_r_2s(self):
+        A1, A2, A3, A4 = self.A
+        O, P = ts.op_sum(self.h)
+        res = ts.eps_r_2s(self.x, ts.apply_1s(O, A1), ts.apply_1s(P, A2),
+                          A3, A4)
+        res_ex = _eps_r_2s_dense(self.h, self.x, A1, A2, A3, A4)
+        self.assertTrue(np.allclose(res, res_ex, rtol=0, atol=1E-10))
+
+class TestUniform(unittest.TestCase):
+
+    def setUp(self):
+        self.s = tu.EvoMPS_TDVP_Uniform(2, 3)
+        self.s.A[:] = _rand_A(3, 2, 2, 1)
+        self.s.calc_AA()
+        self.h = _h_rand(3, 2)
+        self.x = _rand_A(1, 2, 2, 5)[0]
+
+    def test_calc_C(self):
+        s = self.s
+        s.h_nn_mat = self.h
+        s.calc_C()
+        #k * D < q**2, so that the operator-sum form is used
+        self.assertEqual(s.h_nn_opsum[0].shape[0], 2)
+        self.assertTrue(np.allclose(s.C, _C_dense(self.h, s.A, s.A),
+                                    rtol=0, atol=1E-11))
+
+    def test_eps_r_2s(self):
+        s = self.s
+        h = self.h
+        op = lambda u, v, s_, t: h[u, v, s_, t]
+        res_ex = _eps_r_2s_dense(h, self.x, s.A, s.A, s.A, s.A)
+        for i in xrange(2): #the second call uses the cached decomposition
+            res = s.eps_r_2s(self.x, op)
+            self.assertTrue(np.allclose(res, res_ex, rtol=0, atol=1E-10))
+        self.assertEqual(len(s._op_sum_cache), 1)
+
+        res = s.eps_r_2s(self.x, None, C=_C_dense(h, s.A, s.A))
+        self.assertTrue(np.allclose(res, res_ex, rtol=0, atol=1E-10))
+
+class TestSandwich(unittest.TestCase):
+
+    def _make(self, opsum):
+        np.random.seed(3)
+        s = tu.EvoMPS_TDVP_Uniform(2, 2)
+        h = _h_ising(1., 0.8)
+        s.h_nn = lambda s_, t, u, v: h[s_, t, u, v]
+        s.gen_h_matrix()
+        for i in xrange(10):
+            s.update()
+            s.take_step(0.1)
+        s.update()
+
+        sw = tsw.EvoMPS_TDVP_Sandwich(4, s)
+        sw.randomize()
+        sw.update()
+        sw.gen_h_matrix()
+        if not opsum:
+            sw.h_nn_opsum = None
+        return sw, h
+
+    def test_calc_C(self):
+        sw, h = self._make(True)
+        sw_mat, h = self._make(False)
+        sw.calc_C()
+        sw_mat.calc_C()
+        for n in xrange(sw.N + 1):
+            C_ex = _C_dense(h, sw.A[n], sw.A[n + 1])
+            self.assertTrue(np.allclose(sw.C[n], C_ex, rtol=0, atol=1E-11))
+            self.assertTrue(np.allclose(sw_mat.C[n], C_ex, rtol=0, atol=1E-11))
+
+    def test_eps_r_2s(self):
+        sw, h = self._make(True)
+        for n in xrange(sw.N + 1):
+            x = _rand_A(1, sw.D[n + 1], sw.D[n + 1], n)[0]
+            A1, A2 = sw.A[n], sw.A[n + 1]
+            res_ex = _eps_r_2s_dense(h, x, A1, A2, A1, A2)
+            res = sw.eps_r_2s(n, x, sw.h_nn)
+            self.assertTrue(np.allclose(res, res_ex, rtol=0, 
+                                        atol=1E-12 * abs(res_ex).max()))
+
+if __name__ == '__main__':
+    unittest.main()